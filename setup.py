@@ -30,6 +30,7 @@ setup(name='tej',
           'console_scripts': [
               'tej = tej.main:main']},
       install_requires=req,
+      extras_require={'zstd': ['zstandard']},
       description="Trivial Extensible Job-submission system",
       author="Remi Rampin",
       author_email='remirampin@gmail.com',
@@ -1,4 +1,11 @@
+import sys
+
+from tej.cache import *  # noqa
 from tej.errors import *  # noqa
+from tej.pool import *  # noqa
 from tej.submission import *  # noqa
 
+if sys.version_info >= (3, 5):
+    from tej.aio import *  # noqa
+
 __version__ = '0.6'
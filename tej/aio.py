@@ -0,0 +1,508 @@
+"""asyncio interface to tej queues.
+
+This requires Python 3.5 or later.
+"""
+
+import asyncio
+import functools
+import logging
+
+from tej.errors import JobNotFound, QueueDoesntExist, QueueLinkBroken, \
+    RemoteCommandFailure
+from tej.submission import RECV_SIZE, RemoteQueue, check_jobid
+from tej.utils import shell_escape
+
+
+__all__ = ['AsyncRemoteQueue']
+
+
+logger = logging.getLogger('tej')
+
+
+class AsyncRemoteQueue(object):
+    """A job queue on a server, with coroutine methods.
+
+    This has the same methods as `RemoteQueue`, but they are coroutines. The
+    commands are run over SSH channels that are read from the event loop, so
+    that many operations on many queues can be awaited concurrently.
+
+    Note that paramiko doesn't provide a non-blocking interface for some
+    operations; connecting to the server, opening channels, and file
+    transfers (uploading a job, downloading files, installing the runtime)
+    run in the loop's default executor. So do the fallbacks used with older
+    runtimes, such as polling in `wait()` and reading output in `tail()`.
+
+    The arguments are the same as for `RemoteQueue`, with the addition of
+    `loop`, the event loop to use. No connection is made until a method is
+    called. The location of the queue is looked up on the server instead of
+    using the `LocationCache`.
+    """
+    JOB_DONE = RemoteQueue.JOB_DONE
+    JOB_RUNNING = RemoteQueue.JOB_RUNNING
+    JOB_INCOMPLETE = RemoteQueue.JOB_INCOMPLETE
+    JOB_CREATED = RemoteQueue.JOB_CREATED
+    JOB_QUEUED = RemoteQueue.JOB_QUEUED
+
+    queue_class = RemoteQueue
+
+    def __init__(self, destination, queue,
+                 setup_runtime=None, need_runtime=None, pool=None,
+                 status_cache=None, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._args = (destination, queue, setup_runtime, need_runtime, pool)
+        self._status_cache = status_cache
+        self._sync = None
+        self._sync_lock = asyncio.Lock()
+
+    def _run(self, func, *args, **kwargs):
+        """Runs a blocking function in the executor.
+        """
+        return self._loop.run_in_executor(
+            None,
+            functools.partial(func, *args, **kwargs))
+
+    async def _get_sync(self):
+        """Gets the underlying `RemoteQueue`, creating it if needed.
+
+        It holds the connection and implements the blocking operations.
+        """
+        if self._sync is None:
+            async with self._sync_lock:
+                if self._sync is None:
+                    self._sync = await self._run(
+                        self.queue_class, *self._args,
+                        location_cache=False,
+                        status_cache=self._status_cache)
+        return self._sync
+
+    def close(self):
+        """Gives the SSH connection back to the pool.
+        """
+        if self._sync is not None:
+            self._sync.close()
+
+    async def _call(self, cmd, get_output, stdin=None):
+        """Calls a command through the SSH connection.
+
+        Remote stderr gets printed to this program's stderr. Output is captured
+        and may be returned. `stdin` can be bytes to send to the command.
+        """
+        ret, output = await self._call_raw(cmd, get_output, stdin)
+        return ret, output.rstrip(b'\r\n')
+
+    async def _call_raw(self, cmd, get_output, stdin=None):
+        """Calls a command, returning its exit status and complete output.
+
+        Same as `_call()`, but doesn't strip the final line terminator.
+        """
+        sync = await self._get_sync()
+        server_err = sync.server_logger()
+
+        logger.debug("Invoking %r%s%s",
+                     cmd, " (stdout)" if get_output else "",
+                     " (stdin)" if stdin is not None else "")
+        chan = await self._run(sync._open_channel,
+                               '/bin/sh -c %s' % shell_escape(cmd))
+        try:
+            if stdin is not None:
+                await self._run(chan.sendall, stdin)
+                chan.shutdown_write()
+            output = bytearray()
+            done = self._loop.create_future()
+            fd = chan.fileno()
+
+            def readable():
+                while chan.recv_stderr_ready():
+                    server_err.append(chan.recv_stderr(RECV_SIZE))
+                if chan.recv_ready():
+                    data = chan.recv(RECV_SIZE)
+                    if get_output:
+                        output.extend(data)
+                elif chan.eof_received or chan.closed:
+                    self._loop.remove_reader(fd)
+                    if not done.done():
+                        done.set_result(None)
+
+            self._loop.add_reader(fd, readable)
+            try:
+                await done
+            finally:
+                self._loop.remove_reader(fd)
+            if chan.exit_status_ready():
+                ret = chan.recv_exit_status()
+            else:
+                ret = await self._run(chan.recv_exit_status)
+            return ret, bytes(output)
+        finally:
+            server_err.done()
+            chan.close()
+
+    async def check_call(self, cmd):
+        """Calls a command through SSH.
+        """
+        ret, _ = await self._call(cmd, False)
+        if ret != 0:
+            raise RemoteCommandFailure(command=cmd, ret=ret)
+
+    async def check_output(self, cmd):
+        """Calls a command through SSH and returns its output.
+        """
+        ret, output = await self._call(cmd, True)
+        if ret != 0:
+            raise RemoteCommandFailure(command=cmd, ret=ret)
+        logger.debug("Output: %r", output)
+        return output
+
+    async def _resolve_queue(self, queue, depth=0, links=None):
+        """Finds the location of tej's queue directory on the server.
+        """
+        sync = await self._get_sync()
+        if depth == 0:
+            logger.debug("resolve_queue(%s)", queue)
+        answer = await self.check_output(sync._resolve_command(queue))
+        path, link = sync._resolve_answer(queue, answer, depth)
+        if link is not None:
+            if links is not None:
+                links.append(queue)
+            return await self._resolve_queue(link, depth + 1)
+        return path, depth
+
+    async def _get_queue(self):
+        """Gets the actual location of the queue, or None.
+        """
+        sync = await self._get_sync()
+        if sync._queue is None:
+            links = []
+            queue, depth = await self._resolve_queue(sync.queue, links=links)
+            if queue is None and depth > 0:
+                raise QueueLinkBroken
+            sync._links = links
+            sync._queue = queue
+        return sync._queue
+
+    async def setup(self, links=None, force=False, only_links=False):
+        """Installs the runtime at the target location.
+
+        This runs `RemoteQueue.setup()` in the executor.
+        """
+        sync = await self._get_sync()
+        await self._run(sync.setup, links, force, only_links)
+
+    async def submit(self, job_id, directory, script=None, transfer=None,
+                     cache=False, base_job=None, priority=None,
+                     resources=None):
+        """Submits a job to the queue.
+
+        If the runtime is not there, it will be installed. If it is a broken
+        chain of links, error.
+        """
+        sync = await self._get_sync()
+        job_id = sync._make_job_id(job_id, directory)
+        if base_job is not None:
+            check_jobid(base_job)
+        options = sync._submit_options(priority, resources)
+        sync._forget_status(job_id)
+
+        queue = await self._get_queue()
+        if queue is None:
+            queue = await self._run(sync._setup)
+
+        if script is None:
+            script = 'start.sh'
+
+        if (transfer in (None, 'tar') and not cache and base_job is None and
+                await self._run(sync._submit_archive,
+                                queue, job_id, directory, script, options)):
+            logger.info("Submitted job %s", job_id)
+            return job_id
+
+        # Create directory
+        ret, target = await self._call(
+            sync._script_command(queue, 'new_job', job_id),
+            True)
+        target = sync._new_job_result(ret, target)
+
+        # Upload to directory
+        try:
+            await self._run(self._upload, sync, directory, target, transfer,
+                            cache, base_job)
+        except BaseException as e:
+            try:
+                await self.delete(job_id)
+            except BaseException:
+                raise e
+            raise
+        logger.debug("Files uploaded")
+
+        # Submit job
+        await self.check_call(sync._script_command(
+            queue, 'submit', job_id, target, script, *options))
+        logger.info("Submitted job %s", job_id)
+        return job_id
+
+    async def submit_many(self, jobs, parallel=4, transfer=None, cache=False,
+                          priority=None, resources=None):
+        """Submits several jobs to the queue.
+
+        The directories are created and the jobs started with a single command
+        each, see `RemoteQueue.submit_many()`. The uploads run in the
+        executor, at most `parallel` at a time.
+        """
+        sync = await self._get_sync()
+        jobs = sync._submit_many_jobs(jobs)
+        options = sync._submit_options(priority, resources)
+        if not jobs:
+            return []
+        for job_id, _, _ in jobs:
+            sync._forget_status(job_id)
+
+        queue = await self._get_queue()
+        if queue is None:
+            queue = await self._run(sync._setup)
+
+        errors = {}  # job_id -> exception
+
+        # Create directories
+        ret, output = await self._call(
+            sync._script_command(queue, 'new_jobs'),
+            True,
+            ''.join('%s\n' % job_id for job_id, _, _ in jobs).encode('utf-8'))
+        if ret == 127:
+            logger.info("Runtime doesn't support bulk submission, submitting "
+                        "jobs one by one")
+            return await self._run(sync._submit_many_fallback,
+                                   jobs, transfer, cache, priority, resources)
+        targets = sync._new_jobs_result(ret, output, errors)
+
+        # Upload to directories
+        semaphore = asyncio.Semaphore(parallel)
+
+        async def upload(job_id, directory):
+            async with semaphore:
+                try:
+                    await self._run(self._upload, sync, directory,
+                                    targets[job_id], transfer, cache, None)
+                except Exception as e:
+                    errors[job_id] = e
+                    try:
+                        await self.delete(job_id)
+                    except Exception:
+                        logger.warning("Couldn't remove job %s after failed "
+                                       "upload", job_id)
+
+        await asyncio.gather(*[upload(job_id, directory)
+                               for job_id, directory, _ in jobs
+                               if job_id in targets])
+        logger.debug("Files uploaded")
+
+        # Submit jobs
+        to_submit = [(job_id, script) for job_id, _, script in jobs
+                     if job_id in targets and job_id not in errors]
+        if to_submit:
+            ret, output = await self._call(
+                sync._script_command(queue, 'submit_jobs', *options),
+                True,
+                ''.join('%s %s\n' % job for job in to_submit).encode('utf-8'))
+            sync._submit_jobs_result(ret, output, errors)
+
+        return sync._submit_many_results(jobs, targets, errors)
+
+    def _upload(self, sync, directory, target, transfer, cache, base_job):
+        """Uploads a job's directory; runs in the executor.
+        """
+        sync._upload(directory, target, transfer, cache, base_job)
+
+    async def status(self, job_id):
+        """Gets the status of a previously-submitted job.
+        """
+        check_jobid(job_id)
+        sync = await self._get_sync()
+
+        result = sync._cached_status(job_id)
+        if result is not None:
+            return result
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = await self._call(
+            sync._script_command(queue, 'status', job_id),
+            True)
+        return sync._cache_status(job_id, sync._status_result(ret, output))
+
+    async def status_many(self, job_ids):
+        """Gets the status of several jobs, with a single command.
+
+        See `RemoteQueue.status_many()`.
+        """
+        sync = await self._get_sync()
+        job_ids = list(job_ids)
+        for job_id in job_ids:
+            check_jobid(job_id)
+        if not job_ids:
+            return []
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = await self._call(
+            sync._script_command(queue, 'status_many'),
+            True,
+            ''.join('%s\n' % job_id for job_id in job_ids).encode('utf-8'))
+        if ret == 127:
+            logger.info("Runtime doesn't support batch status, getting "
+                        "status of jobs one by one")
+            return [(job_id, await self._status_info(sync, job_id))
+                    for job_id in job_ids]
+        return sync._status_many_result(ret, output, job_ids)
+
+    async def _status_info(self, sync, job_id):
+        """Gets the status of a job as a dictionary, using `status()`.
+        """
+        try:
+            result = await self.status(job_id)
+        except JobNotFound:
+            return None
+        except RemoteCommandFailure as e:
+            if e.ret != 1:
+                raise
+            return {'status': RemoteQueue.JOB_INCOMPLETE}
+        return sync._status_info_result(result)
+
+    async def wait(self, job_ids, timeout=None, return_when='all'):
+        """Waits for jobs to finish.
+
+        This runs a single command that returns once the jobs are finished,
+        see `RemoteQueue.wait()`.
+        """
+        sync = await self._get_sync()
+        job_ids = sync._wait_job_ids(job_ids, return_when)
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = await self._call(
+            sync._script_command(queue, 'wait', return_when,
+                                 '' if timeout is None
+                                 else '%d' % max(0, timeout)),
+            True,
+            ''.join('%s\n' % job_id for job_id in job_ids).encode('utf-8'))
+        if ret == 127:
+            return await self._run(sync._wait_polling,
+                                   job_ids, timeout, return_when)
+        return sync._wait_result(ret, output, job_ids)
+
+    async def events(self, since=0):
+        """Reads the new events from the queue's event log.
+
+        See `RemoteQueue.events()`.
+        """
+        sync = await self._get_sync()
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = await self._call_raw(
+            sync._script_command(queue, 'events', '%d' % since),
+            True)
+        return sync._events_result(ret, output)
+
+    async def tail(self, job_id, stream='stdout', offset=0, max_size=None):
+        """Reads the output of a job from an offset.
+
+        See `RemoteQueue.tail()`. With runtimes that don't have the ``tail``
+        script, this falls back to `RemoteQueue.tail()` in the executor.
+        """
+        sync = await self._get_sync()
+        args = sync._tail_args(job_id, stream, offset, max_size)
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = await self._call_raw(
+            sync._script_command(queue, 'tail', *args),
+            True)
+        if ret == 127:
+            return await self._run(sync._tail_fallback,
+                                   job_id, stream, offset, max_size)
+        return sync._tail_result(ret, output)
+
+    async def download(self, job_id, files, **kwargs):
+        """Downloads files from server.
+
+        This runs in the executor, see `RemoteQueue.download()`.
+        """
+        check_jobid(job_id)
+        sync = await self._get_sync()
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        await self._run(sync.download, job_id, files, **kwargs)
+
+    async def kill(self, job_id):
+        """Kills a job on the server.
+        """
+        check_jobid(job_id)
+        sync = await self._get_sync()
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        sync._forget_status(job_id)
+        ret, output = await self._call(
+            sync._script_command(queue, 'kill', job_id),
+            False)
+        sync._kill_result(ret)
+
+    async def delete(self, job_id):
+        """Deletes a job from the server.
+        """
+        check_jobid(job_id)
+        sync = await self._get_sync()
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        sync._forget_status(job_id)
+        ret, output = await self._call(
+            sync._script_command(queue, 'delete', job_id),
+            False)
+        sync._delete_result(ret)
+
+    async def list(self, status=None, max_age=None, prefix=None, after=None,
+                   limit=None):
+        """Lists the jobs on the server.
+
+        Returns a list of ``(job_id, info)`` pairs. The filters are the same
+        as for `RemoteQueue.list()`.
+        """
+        sync = await self._get_sync()
+        filters = sync._list_filters(status, max_age, prefix, after, limit)
+
+        queue = await self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        output = await self.check_output(
+            sync._script_command(queue, 'list', *filters))
+        return list(sync._filter_list(sync._parse_list(output.splitlines()),
+                                      status, prefix, after, limit))
+
+    async def cleanup(self, kill=False):
+        """Removes the queue and links from the server.
+
+        This runs `RemoteQueue.cleanup()` in the executor.
+        """
+        sync = await self._get_sync()
+        return await self._run(sync.cleanup, kill)
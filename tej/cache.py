@@ -0,0 +1,211 @@
+"""Local caches of information from the server.
+
+Finding where a queue is on the server takes a round trip, plus one for each
+link to follow. The result is stored in a file on this machine, so that the
+next `RemoteQueue` for the same queue (for example the next invocation of the
+command-line tool) can skip that step. Entries are not checked when they are
+read; `RemoteQueue` drops them if the queue turns out to be gone.
+
+The status of jobs can also be kept in memory, see `StatusCache`.
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+__all__ = ['LocationCache', 'get_default_location_cache',
+           'set_default_location_cache', 'StatusCache']
+
+
+logger = logging.getLogger('tej')
+
+
+def cache_directory():
+    """Returns the directory where tej keeps its cache files.
+
+    This is ``$TEJ_CACHE_DIR`` if set, else ``tej`` in ``$XDG_CACHE_HOME`` or
+    ``~/.cache``.
+    """
+    directory = os.environ.get('TEJ_CACHE_DIR')
+    if directory:
+        return directory
+    directory = os.environ.get('XDG_CACHE_HOME')
+    if not directory:
+        directory = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(directory, 'tej')
+
+
+class LocationCache(object):
+    """Persistent mapping of (destination, queue) to the queue's location.
+
+    Each entry records the resolved path of the queue, the protocol version
+    and runtime found there, and the links that were followed to get there.
+    Queues are identified by the destination as a string (without password)
+    and the queue's path as given by the user.
+
+    :param filename: The JSON file the entries are stored in. Defaults to
+    ``queues.json`` in `cache_directory()`.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(cache_directory(), 'queues.json')
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(destination, queue):
+        return '%s %s' % (destination, queue)
+
+    def _read(self):
+        try:
+            with open(self.filename, 'r') as fp:
+                entries = json.load(fp)
+        except (IOError, OSError):
+            return {}
+        except ValueError:
+            logger.warning("Ignoring corrupted cache file %s", self.filename)
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _write(self, entries):
+        try:
+            directory = os.path.dirname(self.filename)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(temp, 'w') as fp:
+                json.dump(entries, fp, indent=2, sort_keys=True)
+            try:
+                os.rename(temp, self.filename)
+            except OSError:
+                # Windows can't rename over an existing file
+                os.remove(self.filename)
+                os.rename(temp, self.filename)
+        except (IOError, OSError) as e:
+            logger.debug("Couldn't write cache file %s: %s", self.filename, e)
+
+    def get(self, destination, queue):
+        """Gets the entry for a queue, or None.
+
+        Returns a dictionary with keys ``path``, ``version``, ``runtime`` and
+        ``links``.
+        """
+        with self._lock:
+            entry = self._read().get(self._key(destination, queue))
+        if not isinstance(entry, dict) or 'path' not in entry:
+            return None
+        return entry
+
+    def set(self, destination, queue, path, version, runtime, links=()):
+        """Records the location of a queue.
+        """
+        with self._lock:
+            entries = self._read()
+            entries[self._key(destination, queue)] = {
+                'path': path,
+                'version': version,
+                'runtime': runtime,
+                'links': list(links)}
+            self._write(entries)
+
+    def invalidate(self, destination, queue):
+        """Removes the entry for a queue, if any.
+        """
+        with self._lock:
+            entries = self._read()
+            if entries.pop(self._key(destination, queue), None) is not None:
+                self._write(entries)
+
+
+_default_location_cache = LocationCache()
+
+
+def get_default_location_cache():
+    """Returns the cache used by default by `RemoteQueue`.
+    """
+    return _default_location_cache
+
+
+def set_default_location_cache(cache):
+    """Replaces the cache used by default by `RemoteQueue`.
+
+    Setting it to None disables the cache.
+    """
+    global _default_location_cache
+    _default_location_cache = cache
+
+
+class StatusCache(object):
+    """In-memory cache of the status of jobs.
+
+    Once a job is finished, its status can't change until it is deleted, so
+    it is kept for as long as the cache exists. The status of other jobs is
+    only kept for `running_ttl` seconds.
+
+    Pass it to `RemoteQueue` to use it; the queue will invalidate the entries
+    of the jobs it kills, deletes or submits. Note that changes made by other
+    clients, such as deleting a job and submitting a new one with the same
+    identifier, are not noticed.
+
+    :param running_ttl: Number of seconds for which the status of a job that
+    is not finished is kept. 0 means it is not cached at all.
+    :param finished: The status value that never expires.
+    """
+    def __init__(self, running_ttl=2.0, finished='finished'):
+        self.running_ttl = running_ttl
+        self.finished = finished
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (result, expiration time or None)
+
+    def get(self, key):
+        """Gets a status from the cache, or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires = entry
+                if expires is None or expires > time.time():
+                    self.hits += 1
+                    return result
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        """Stores the status of a job.
+
+        `result` is a tuple, with the status of the job first.
+        """
+        if result[0] == self.finished:
+            expires = None
+        elif self.running_ttl > 0:
+            expires = time.time() + self.running_ttl
+        else:
+            return
+        with self._lock:
+            self._entries[key] = result, expires
+
+    def invalidate(self, key):
+        """Removes the status of a job from the cache.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes everything from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
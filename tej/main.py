@@ -6,18 +6,25 @@ from __future__ import unicode_literals
 import argparse
 import codecs
 import functools
+import json
 import locale
 import logging
 import sys
+import time
 
 from tej import __version__ as tej_version
 from tej.errors import Error, JobNotFound
+from tej.pool import get_default_pool
 from tej.submission import DEFAULT_TEJ_DIR, RemoteQueue
 
 
 logger = logging.getLogger('tej')
 
 
+# Maximum number of bytes of output requested at once by 'tej logs'
+LOGS_CHUNK_SIZE = 1 << 20
+
+
 def setup_logging(verbosity):
     levels = [logging.CRITICAL, logging.WARNING, logging.INFO, logging.DEBUG]
     level = levels[min(verbosity, 3)]
@@ -50,26 +57,63 @@ def needs_job_id(f):
 
 
 def _setup(args):
-    queue = RemoteQueue(args.destination, args.queue,
-                        setup_runtime=args.runtime)
-    queue.setup(args.make_link, args.force, args.only_links)
+    with RemoteQueue(args.destination, args.queue,
+                     setup_runtime=args.runtime) as queue:
+        queue.setup(args.make_link, args.force, args.only_links)
+
+
+def _resources(args):
+    return {'cpus': args.cpus,
+            'memory': args.memory,
+            'walltime': args.walltime,
+            'queue': args.pbs_queue,
+            'directives': args.directive,
+            'cpuset': args.cpuset,
+            'nice': args.nice,
+            'ionice': args.ionice,
+            'cpu_limit': args.cpu_limit}
 
 
 def _submit(args):
-    queue = RemoteQueue(args.destination, args.queue)
-    job_id = queue.submit(args.id, args.directory, args.script)
+    with RemoteQueue(args.destination, args.queue) as queue:
+        job_id = queue.submit(args.id, args.directory, args.script,
+                              transfer=args.transfer, cache=args.cache,
+                              base_job=args.base_job, priority=args.priority,
+                              resources=_resources(args))
     print(job_id)
 
 
+def _submit_many(args):
+    with RemoteQueue(args.destination, args.queue) as queue:
+        results = queue.submit_many([(None, directory, args.script)
+                                     for directory in args.directories],
+                                    parallel=args.parallel,
+                                    transfer=args.transfer,
+                                    cache=args.cache,
+                                    priority=args.priority,
+                                    resources=_resources(args))
+    failed = False
+    for job_id, error in results:
+        if error is None:
+            print(job_id)
+        else:
+            logger.error("%s: %s", job_id, error)
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
 @needs_job_id
 def _status(args):
     try:
-        queue = RemoteQueue(args.destination, args.queue)
-        status, directory, arg = queue.status(args.id)
+        with RemoteQueue(args.destination, args.queue) as queue:
+            status, directory, arg = queue.status(args.id)
         if status == RemoteQueue.JOB_DONE:
             sys.stdout.write("finished")
         elif status == RemoteQueue.JOB_RUNNING:
             sys.stdout.write("running")
+        elif status == RemoteQueue.JOB_QUEUED:
+            sys.stdout.write("queued")
         else:  # pragma: no cover
             raise RuntimeError("Got unknown job status %r" % status)
         if arg is not None:
@@ -79,25 +123,105 @@ def _status(args):
         print("not found")
 
 
+def _status_many(args):
+    job_ids = args.ids
+    if not job_ids:
+        job_ids = [line.decode('utf-8').strip() for line in sys.stdin]
+        job_ids = [job_id for job_id in job_ids if job_id]
+    with RemoteQueue(args.destination, args.queue) as queue:
+        for job_id, info in queue.status_many(job_ids):
+            _write_record(job_id, info)
+
+
+def _write_record(job_id, info):
+    """Prints a job's information as a line of JSON.
+    """
+    if info is None:
+        record = {'status': 'not found'}
+    else:
+        record = dict(info)
+        if 'directory' in record:
+            record['directory'] = str(record['directory'])
+    record['id'] = job_id
+    sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _wait(args):
+    with RemoteQueue(args.destination, args.queue) as queue:
+        done, jobs = queue.wait(args.ids, timeout=args.timeout,
+                                return_when='any' if args.any else 'all')
+    for job_id, info in jobs:
+        if info is None:
+            sys.stdout.write("%s not found\n" % job_id)
+        elif 'exit_code' in info:
+            sys.stdout.write("%s %s %s\n" % (
+                job_id, info['status'], info['exit_code']))
+        else:
+            sys.stdout.write("%s %s\n" % (job_id, info['status']))
+    if not done:
+        logger.error("Timed out")
+        sys.exit(2)
+
+
 @needs_job_id
 def _download(args):
-    RemoteQueue(args.destination, args.queue).download(args.id, args.files,
-                                                       directory='.')
+    with RemoteQueue(args.destination, args.queue) as queue:
+        queue.download(args.id, args.files,
+                       directory='.',
+                       parallel=args.parallel,
+                       transfer=args.transfer,
+                       include=args.include,
+                       exclude=args.exclude)
+
+
+@needs_job_id
+def _logs(args):
+    stream = 'stderr' if args.stderr else 'stdout'
+    out = sys.stdout.buffer
+    offset = args.offset
+    with RemoteQueue(args.destination, args.queue) as queue:
+        while True:
+            data, offset, status = queue.tail(args.id, stream, offset,
+                                              LOGS_CHUNK_SIZE)
+            out.write(data)
+            out.flush()
+            if len(data) == LOGS_CHUNK_SIZE:
+                continue
+            if not args.follow or status in (RemoteQueue.JOB_DONE,
+                                             RemoteQueue.JOB_INCOMPLETE):
+                break
+            # PBS reports jobs waiting in its queue as submitted
+            if status not in (RemoteQueue.JOB_RUNNING, RemoteQueue.JOB_QUEUED,
+                              'submitted'):
+                logger.critical("Job %s is %s, it won't produce output",
+                                args.id, status)
+                sys.exit(1)
+            time.sleep(args.interval)
 
 
 @needs_job_id
 def _kill(args):
-    RemoteQueue(args.destination, args.queue).kill(args.id)
+    with RemoteQueue(args.destination, args.queue) as queue:
+        queue.kill(args.id)
 
 
 @needs_job_id
 def _delete(args):
-    RemoteQueue(args.destination, args.queue).delete(args.id)
+    with RemoteQueue(args.destination, args.queue) as queue:
+        queue.delete(args.id)
 
 
 def _list(args):
-    for job_id, info in RemoteQueue(args.destination, args.queue).list():
-        sys.stdout.write("%s %s\n" % (job_id, info['status']))
+    with RemoteQueue(args.destination, args.queue) as queue:
+        for job_id, info in queue.list(status=args.status or None,
+                                       max_age=args.max_age,
+                                       prefix=args.prefix,
+                                       after=args.after,
+                                       limit=args.limit):
+            if args.json:
+                _write_record(job_id, info)
+            else:
+                sys.stdout.write("%s %s\n" % (job_id, info['status']))
 
 
 def main():
@@ -127,6 +251,47 @@ def main():
                  "If unspecified, will auto-detect what is appropriate, and "
                  "fallback on 'default'.")
 
+    # Upload mode
+    def add_transfer_option(opt):
+        opt.add_argument(
+            '--transfer', action='store', choices=['scp', 'tar'],
+            help="how to upload the job directory: 'scp' copies each file, "
+                 "'tar' sends a single compressed archive. If unspecified, "
+                 "'tar' is used for directories with many files.")
+        opt.add_argument(
+            '--cache', action='store_true',
+            help="keep large files in a cache on the server, and don't "
+                 "upload them again if they are already there. Those files "
+                 "will be read-only.")
+
+    # Resources
+    def add_resource_options(opt):
+        opt.add_argument('--cpus', action='store', type=int,
+                         help="number of cores the job needs")
+        opt.add_argument('--memory', action='store',
+                         help="memory the job needs, for example 4gb")
+        opt.add_argument('--walltime', action='store',
+                         help="maximum run time of the job, as "
+                              "[[hours:]minutes:]seconds")
+        opt.add_argument('--pbs-queue', action='store',
+                         help="PBS queue to submit the job to")
+        opt.add_argument('--cpuset', action='store',
+                         help="CPUs to run the job on, for example 0-3,8 "
+                              "(default runtime)")
+        opt.add_argument('--nice', action='store', type=int,
+                         help="nice level of the job (default runtime)")
+        opt.add_argument('--ionice', action='store',
+                         help="I/O scheduling class of the job: idle, "
+                              "best-effort or realtime, optionally followed "
+                              "by :LEVEL (default runtime)")
+        opt.add_argument('--cpu-limit', action='store', type=float,
+                         help="number of CPUs worth of time the job can use "
+                              "(default runtime)")
+        opt.add_argument('--directive', action='append',
+                         help="extra line for the PBS job file, for example "
+                              "'-l software=matlab' (can be given multiple "
+                              "times)")
+
     # Destination selection
     def add_destination_option(opt):
         opt.add_argument('destination', action='store',
@@ -164,15 +329,48 @@ def main():
         help="Submits a job to a remote machine")
     add_destination_option(parser_submit)
     add_runtime_option(parser_submit)
+    add_transfer_option(parser_submit)
+    add_resource_options(parser_submit)
     parser_submit.add_argument('--id', action='store',
                                help="Identifier for the new job")
     parser_submit.add_argument('--script', action='store',
                                help="Relative name of the script in the "
                                     "directory")
+    parser_submit.add_argument('--base-job', action='store',
+                               help="Identifier of a previous job; files "
+                                    "that didn't change since are copied on "
+                                    "the server instead of uploaded")
+    parser_submit.add_argument('--priority', action='store', type=int,
+                               help="Priority of the job, from -9999 to "
+                                    "9999; higher starts first (PBS clamps "
+                                    "it to -1024..1023)")
     parser_submit.add_argument('directory', action='store',
                                help="Job directory to upload")
     parser_submit.set_defaults(func=_submit)
 
+    # Submit-many action
+    parser_submit_many = subparsers.add_parser(
+        'submit-many',
+        help="Submits several jobs to a remote machine")
+    add_destination_option(parser_submit_many)
+    add_runtime_option(parser_submit_many)
+    add_transfer_option(parser_submit_many)
+    add_resource_options(parser_submit_many)
+    parser_submit_many.add_argument('--script', action='store',
+                                    help="Relative name of the script in the "
+                                         "directories")
+    parser_submit_many.add_argument('--parallel', action='store', type=int,
+                                    default=4,
+                                    help="Number of concurrent uploads")
+    parser_submit_many.add_argument('--priority', action='store', type=int,
+                                    help="Priority of the jobs, from -9999 "
+                                         "to 9999; higher starts first (PBS "
+                                         "clamps it to -1024..1023)")
+    parser_submit_many.add_argument('directories', action='store',
+                                    nargs=argparse.ONE_OR_MORE,
+                                    help="Job directories to upload")
+    parser_submit_many.set_defaults(func=_submit_many)
+
     # Status action
     parser_status = subparsers.add_parser(
         'status',
@@ -182,6 +380,30 @@ def main():
                                help="Identifier of the running job")
     parser_status.set_defaults(func=_status)
 
+    # Status-many action
+    parser_status_many = subparsers.add_parser(
+        'status-many',
+        help="Gets the status of several jobs, as JSON lines")
+    add_destination_option(parser_status_many)
+    parser_status_many.add_argument('ids', action='store', nargs='*',
+                                    help="Identifiers of the jobs; read from "
+                                         "stdin if none are given")
+    parser_status_many.set_defaults(func=_status_many)
+
+    # Wait action
+    parser_wait = subparsers.add_parser(
+        'wait',
+        help="Waits for jobs to finish")
+    add_destination_option(parser_wait)
+    parser_wait.add_argument('--any', action='store_true',
+                             help="return as soon as one of the jobs is "
+                                  "finished")
+    parser_wait.add_argument('--timeout', action='store', type=int,
+                             help="maximum number of seconds to wait")
+    parser_wait.add_argument('ids', action='store', nargs='+',
+                             help="identifiers of the jobs")
+    parser_wait.set_defaults(func=_wait)
+
     # Download action
     parser_download = subparsers.add_parser(
         'download',
@@ -189,11 +411,45 @@ def main():
     add_destination_option(parser_download)
     parser_download.add_argument('--id', action='store',
                                  help="Identifier of the job")
+    parser_download.add_argument('--parallel', action='store', type=int,
+                                 default=4,
+                                 help="Number of concurrent downloads")
+    parser_download.add_argument(
+        '--transfer', action='store', choices=['scp', 'tar'],
+        help="how to download the files: 'scp' copies each file, 'tar' "
+             "receives a single compressed archive. If unspecified, 'tar' is "
+             "used for directories.")
+    parser_download.add_argument('--include', action='append',
+                                 help="Only download files matching this "
+                                 "pattern (can be repeated)")
+    parser_download.add_argument('--exclude', action='append',
+                                 help="Don't download files matching this "
+                                 "pattern (can be repeated)")
     parser_download.add_argument('files', action='store',
                                  nargs=argparse.ONE_OR_MORE,
                                  help="Files to download")
     parser_download.set_defaults(func=_download)
 
+    # Logs action
+    parser_logs = subparsers.add_parser(
+        'logs',
+        help="Shows the output of a job")
+    add_destination_option(parser_logs)
+    parser_logs.add_argument('--id', action='store',
+                             help="Identifier of the job")
+    parser_logs.add_argument('--stderr', action='store_true',
+                             help="Show stderr instead of stdout")
+    parser_logs.add_argument('-f', '--follow', action='store_true',
+                             help="Keep showing new output until the job is "
+                                  "finished")
+    parser_logs.add_argument('--offset', action='store', type=int, default=0,
+                             help="Offset in bytes from which to start")
+    parser_logs.add_argument('--interval', action='store', type=float,
+                             default=2,
+                             help="Seconds between checks for new output "
+                                  "with --follow")
+    parser_logs.set_defaults(func=_logs)
+
     # Kill action
     parser_kill = subparsers.add_parser(
         'kill',
@@ -217,6 +473,22 @@ def main():
         'list',
         help="Lists remote jobs")
     add_destination_option(parser_list)
+    parser_list.add_argument('--status', action='append',
+                             help="only list jobs with this status (can be "
+                                  "given multiple times)")
+    parser_list.add_argument('--max-age', action='store', type=int,
+                             help="only list jobs created in the last N "
+                                  "seconds")
+    parser_list.add_argument('--prefix', action='store',
+                             help="only list jobs whose identifier starts "
+                                  "with this")
+    parser_list.add_argument('--after', action='store',
+                             help="only list jobs after this identifier")
+    parser_list.add_argument('--limit', action='store', type=int,
+                             help="maximum number of jobs to list")
+    parser_list.add_argument('--json', action='store_true',
+                             help="print all the information about the jobs, "
+                                  "as JSON lines")
     parser_list.set_defaults(func=_list)
 
     args = parser.parse_args()
@@ -228,6 +500,10 @@ def main():
         # No need to show a traceback here, this is not an internal error
         logger.critical(e)
         sys.exit(1)
+    finally:
+        # The queues gave their connections back to the pool, which keeps
+        # them open for reuse; there won't be any here
+        get_default_pool().close_all()
     sys.exit(0)
 
 
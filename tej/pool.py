@@ -0,0 +1,195 @@
+"""Process-wide pool of SSH connections.
+
+Opening an SSH connection means a TCP connect, a key exchange and an
+authentication, which is much slower than opening a new channel on an existing
+transport. `RemoteQueue` objects therefore borrow their connections from a
+`ConnectionPool`, so that many queues pointing at the same server share a few
+multiplexed transports.
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import logging
+import threading
+import time
+
+from tej.utils import iteritems, listvalues
+
+
+__all__ = ['ConnectionPool', 'get_default_pool', 'set_default_pool']
+
+
+logger = logging.getLogger('tej')
+
+
+def destination_key(destination):
+    """Turns a destination dictionary into a hashable key.
+    """
+    return tuple(sorted(iteritems(destination)))
+
+
+class _PooledConnection(object):
+    """An SSH client in the pool, with its reference count.
+    """
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.refs = 0
+        self.last_used = time.time()
+
+
+class ConnectionPool(object):
+    """A pool of SSH connections, keyed by destination.
+
+    Connections are reference-counted: `acquire()` hands out a client and
+    `release()` gives it back. A connection that nobody holds is kept open for
+    `idle_timeout` seconds, in case another queue wants to connect to the same
+    server, and closed after that.
+
+    :param max_transports: Maximum number of connections opened to a single
+    destination. Once this is reached, new users will share the least loaded
+    existing connection instead of opening another one.
+    :param max_shares: Number of users a connection can have before another
+    one gets opened (if `max_transports` allows).
+    :param idle_timeout: Number of seconds after which an unused connection
+    gets closed.
+    :param keepalive_interval: Interval in seconds at which keepalive packets
+    are sent on the connections, so that idle connections are not dropped by
+    the server or firewalls, and dead ones get noticed. 0 disables them.
+    """
+    def __init__(self, max_transports=4, max_shares=8, idle_timeout=300,
+                 keepalive_interval=60):
+        if max_transports < 1:
+            raise ValueError("max_transports should be at least 1")
+        self.max_transports = max_transports
+        self.max_shares = max_shares
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self._lock = threading.Lock()
+        self._connections = {}  # key -> [_PooledConnection]
+        self._clients = {}  # id(client) -> _PooledConnection
+
+    def acquire(self, destination, connect, group=None):
+        """Gets a connection to the given destination.
+
+        :param destination: The destination dictionary, as returned by
+        `parse_ssh_destination()`.
+        :param connect: Function called without arguments to open a new
+        connection if needed. It should return a connected SSHClient.
+        :param group: Additional value to put in the key; connections are only
+        shared between users providing the same group. This allows different
+        `connect` functions to not share their connections.
+        """
+        key = destination_key(destination), group
+        with self._lock:
+            self._expire()
+            entries = self._connections.setdefault(key, [])
+            entry = None
+            if entries:
+                entry = min(entries, key=lambda e: e.refs)
+                if (entry.refs >= self.max_shares and
+                        len(entries) < self.max_transports):
+                    entry = None
+            if entry is not None:
+                entry.refs += 1
+                entry.last_used = time.time()
+                logger.debug("Reusing connection to %s (%d users)",
+                             destination['hostname'], entry.refs)
+                return entry.client
+
+        # Connects without holding the lock, this can take a while
+        client = connect()
+        transport = client.get_transport()
+        if self.keepalive_interval and transport is not None:
+            transport.set_keepalive(self.keepalive_interval)
+        with self._lock:
+            entries = self._connections.setdefault(key, [])
+            if len(entries) >= self.max_transports:
+                # Other threads connected in the meantime, uses one of their
+                # connections so as not to go over max_transports
+                entry = min(entries, key=lambda e: e.refs)
+                entry.refs += 1
+                entry.last_used = time.time()
+                extra = client
+            else:
+                entry = _PooledConnection(key, client)
+                entry.refs = 1
+                entries.append(entry)
+                self._clients[id(client)] = entry
+                extra = None
+        if extra is not None:
+            logger.debug("Closing extra connection to %s",
+                         destination['hostname'])
+            extra.close()
+        return entry.client
+
+    def release(self, client):
+        """Gives back a connection obtained from `acquire()`.
+        """
+        with self._lock:
+            entry = self._clients.get(id(client))
+            if entry is None:
+                return
+            entry.refs -= 1
+            entry.last_used = time.time()
+            self._expire()
+
+    def discard(self, client):
+        """Removes a connection from the pool, for example if it died.
+
+        The client gets closed. Other users of this connection will get an
+        error next time they use it, and should acquire a new one.
+        """
+        with self._lock:
+            entry = self._clients.pop(id(client), None)
+            if entry is not None:
+                self._connections[entry.key].remove(entry)
+                if not self._connections[entry.key]:
+                    del self._connections[entry.key]
+        client.close()
+
+    def _expire(self):
+        """Closes connections that have been unused for too long.
+
+        Must be called with the lock held.
+        """
+        limit = time.time() - self.idle_timeout
+        for key, entries in list(iteritems(self._connections)):
+            for entry in list(entries):
+                if entry.refs <= 0 and entry.last_used <= limit:
+                    logger.debug("Closing idle connection")
+                    entries.remove(entry)
+                    del self._clients[id(entry.client)]
+                    entry.client.close()
+            if not entries:
+                del self._connections[key]
+
+    def close_all(self):
+        """Closes every connection in the pool, whether in use or not.
+        """
+        with self._lock:
+            entries = listvalues(self._clients)
+            self._connections = {}
+            self._clients = {}
+        for entry in entries:
+            entry.client.close()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._clients)
+
+
+_default_pool = ConnectionPool()
+
+
+def get_default_pool():
+    """Returns the process-wide pool used by default by `RemoteQueue`.
+    """
+    return _default_pool
+
+
+def set_default_pool(pool):
+    """Replaces the process-wide pool used by default by `RemoteQueue`.
+    """
+    global _default_pool
+    _default_pool = pool
@@ -23,3 +23,526 @@ format_timedelta(){
         echo "$minutes:$seconds"
     fi
 }
+
+
+# Reads the queue's configuration file, tej.conf
+# Arguments: path of the queue
+# The file has lines in the form key=value; lines starting with # are ignored
+# Sets conf_log_level (debug, info, warning, error or none; default info),
+# conf_log_max_size (size in bytes from which tej.log is rotated; default
+# 1048576, 0 for no limit), conf_log_keep (number of rotated logs kept;
+# default 3), conf_max_slots (number of slots for running jobs; default 0,
+# no limit), conf_cpu_affinity (1 to pin jobs to the CPUs matching their
+# slots; default 0), conf_limits (how the memory and CPU limits of jobs are
+# enforced: systemd, cgroup, ulimit or none; default auto, the first that
+# works), conf_cgroup_root (a cgroup v2 directory the user can create
+# cgroups in; default none) and conf_start_timeout (seconds after which a job
+# whose start wrapper didn't run is given up on; default 60)
+read_config(){
+    conf_log_level=info
+    conf_log_max_size=1048576
+    conf_log_keep=3
+    conf_max_slots=0
+    conf_cpu_affinity=0
+    conf_limits=auto
+    conf_cgroup_root=''
+    conf_start_timeout=60
+    if [ -f "$1/tej.conf" ]; then
+        while IFS=' =' read -r key value || [ -n "$key" ]; do
+            case "$key" in
+                log_level) conf_log_level="$value" ;;
+                log_max_size) conf_log_max_size="$value" ;;
+                log_keep) conf_log_keep="$value" ;;
+                max_slots) conf_max_slots="$value" ;;
+                cpu_affinity) conf_cpu_affinity="$value" ;;
+                limits) conf_limits="$value" ;;
+                cgroup_root) conf_cgroup_root="$value" ;;
+                start_timeout) conf_start_timeout="$value" ;;
+            esac
+        done < "$1/tej.conf"
+    fi
+    case "$conf_log_max_size" in
+        ''|*[!0-9]*) conf_log_max_size=1048576 ;;
+    esac
+    case "$conf_log_keep" in
+        ''|*[!0-9]*) conf_log_keep=3 ;;
+    esac
+    case "$conf_max_slots" in
+        ''|*[!0-9]*) conf_max_slots=0 ;;
+    esac
+    case "$conf_start_timeout" in
+        ''|*[!0-9]*) conf_start_timeout=60 ;;
+    esac
+}
+
+
+# Sets up logging to tej.log for a command
+# Arguments: path of the queue, name of the command
+# Records are single lines: time, level, command, then the message, usually
+# key=value pairs
+log_init(){
+    case "$1" in
+        /*) log_file="$1/tej.log" ;;
+        *) log_file="$PWD/$1/tej.log" ;;
+    esac
+    log_command="$2"
+    log_time=''
+    log_checked=''
+    read_config "$1"
+    case "$conf_log_level" in
+        debug) log_threshold=0 ;;
+        warning) log_threshold=2 ;;
+        error) log_threshold=3 ;;
+        none) log_threshold=4 ;;
+        *) log_threshold=1 ;;
+    esac
+}
+
+
+# Appends a record to tej.log, if its level is enabled
+# Arguments: level (debug, info, warning or error), message
+# The time is taken from $EPOCHSECONDS if the shell has it; otherwise date is
+# only run for the first record of the command, set log_time='' to update it
+log_message(){
+    case "$1" in
+        debug) log_level=0 ;;
+        info) log_level=1 ;;
+        warning) log_level=2 ;;
+        *) log_level=3 ;;
+    esac
+    if [ "$log_level" -lt "$log_threshold" ]; then
+        return 0
+    fi
+    if [ -n "${EPOCHSECONDS:-}" ]; then
+        log_time="$EPOCHSECONDS"
+    elif [ -z "$log_time" ]; then
+        log_time="$(date +%s)"
+    fi
+    if [ -z "$log_checked" ]; then
+        log_checked=1
+        rotate_log
+    fi
+    printf '%s %s %s %s\n' "$log_time" "$1" "$log_command" "$2" >> "$log_file"
+}
+
+
+# Rotates tej.log if it is larger than conf_log_max_size
+# The previous logs are kept as tej.log.1 (most recent) to tej.log.N
+rotate_log(){
+    if [ "$conf_log_max_size" = 0 ] || ! [ -f "$log_file" ]; then
+        return 0
+    fi
+    log_size=$(wc -c < "$log_file")
+    if [ "$((log_size))" -lt "$conf_log_max_size" ]; then
+        return 0
+    fi
+    i="$conf_log_keep"
+    while [ "$i" -gt 1 ]; do
+        if [ -f "$log_file.$((i - 1))" ]; then
+            mv -f "$log_file.$((i - 1))" "$log_file.$i"
+        fi
+        i=$((i - 1))
+    done
+    if [ "$conf_log_keep" -gt 0 ]; then
+        mv -f "$log_file" "$log_file.1" 2>/dev/null || true
+    else
+        rm -f "$log_file"
+    fi
+}
+
+
+# Appends a line to the event log, events.log in the queue
+# Arguments: path of the queue, event, job ID, optional value
+# Events are created, submitted, started (value is the pid or PBS id),
+# finished (value is the exit code) and deleted
+log_event(){
+    echo "$(date +%s) $2 $3${4:+ $4}" >> "$1/events.log"
+}
+
+
+# Creates the directory for a new job
+# Arguments: job ID, creation date
+# Returns 0 if created, 4 if the job already exists, 1 on error
+create_job(){
+    job_root="jobs/$1"
+    if ! mkdir "$job_root" 2>/dev/null; then
+        if [ -d "$job_root" ]; then
+            return 4
+        else
+            return 1
+        fi
+    fi
+    (echo "created"; echo ''; echo "$2"; echo '') > "$job_root/status"
+    log_event . created "$1"
+}
+
+
+# Writes the resources requested for a job to its resources file
+# Arguments: job directory, then key=value pairs: cpus (number of cores),
+# memory (for example 512mb or 4gb), walltime ([[hours:]minutes:]seconds),
+# queue (name of the PBS queue), directive (extra #PBS line, can be
+# repeated), and for the default runtime cpuset (CPUs to run on, for example
+# 0-3,8, which have to be usable), nice (-20 to 19), ionice (class idle,
+# best-effort or realtime, optionally followed by a colon and a level from 0
+# to 7; realtime needs privileges, else best-effort is used) and cpu_limit
+# (number of CPUs worth of time the job can use, for example 1.5)
+# Returns 1 if a pair is invalid
+write_resources(){
+    resources_file="$1/resources"
+    shift
+    if [ $# = 0 ]; then
+        return 0
+    fi
+    : > "$resources_file.tmp"
+    for pair in "$@"; do
+        value="${pair#*=}"
+        unit="${value##*[0-9]}"
+        case "$pair" in
+            cpus=*)
+                case "$value" in ''|*[!0-9]*|0) value='' ;; esac
+                ;;
+            memory=*)
+                case "${value%"$unit"}" in ''|*[!0-9]*) value='' ;; esac
+                case "$unit" in
+                    ''|b|kb|mb|gb|tb|B|KB|MB|GB|TB) ;;
+                    *) value='' ;;
+                esac
+                ;;
+            walltime=*)
+                case "$value" in ''|*[!0-9:]*) value='' ;; esac
+                ;;
+            queue=*)
+                case "$value" in ''|*[!A-Za-z0-9_.@-]*) value='' ;; esac
+                ;;
+            directive=*)
+                case "$value" in *'
+'*) value='' ;; esac
+                ;;
+            cpuset=*)
+                case "$value" in ''|*[!0-9,-]*) value='' ;; esac
+                # Checks that these CPUs exist and can be used, now rather
+                # than when the job starts
+                if [ -n "$value" ] && command -v taskset >/dev/null 2>&1 &&
+                        ! taskset -c "$value" true >/dev/null 2>&1; then
+                    value=''
+                fi
+                ;;
+            nice=*)
+                case "${value#-}" in ''|*[!0-9]*) value='' ;; esac
+                ;;
+            ionice=*)
+                case "$value" in
+                    idle|best-effort|realtime) ;;
+                    best-effort:[0-7]|realtime:[0-7]) ;;
+                    *) value='' ;;
+                esac
+                ;;
+            cpu_limit=*)
+                case "$value" in
+                    ''|*[!0-9.]*|*.*.*|.*|*.) value='' ;;
+                esac
+                ;;
+            *)
+                value=''
+                ;;
+        esac
+        if [ -z "$value" ]; then
+            echo "Invalid resource '$pair'" >&2
+            rm -f "$resources_file.tmp"
+            return 1
+        fi
+        echo "$pair" >> "$resources_file.tmp"
+    done
+    mv -f "$resources_file.tmp" "$resources_file"
+}
+
+
+# Converts an amount of memory from a resources file to bytes
+# Arguments: amount, for example 512mb
+memory_bytes(){
+    unit="${1##*[0-9]}"
+    number="${1%"$unit"}"
+    case "$unit" in
+        kb|KB) echo $((number * 1024)) ;;
+        mb|MB) echo $((number * 1048576)) ;;
+        gb|GB) echo $((number * 1073741824)) ;;
+        tb|TB) echo $((number * 1099511627776)) ;;
+        *) echo "$number" ;;
+    esac
+}
+
+
+# Reads the resources file of a job, see write_resources
+# Arguments: job directory
+# Sets res_cpus (default 1), res_memory, res_walltime, res_queue,
+# res_directives (one per line), res_cpuset, res_nice, res_ionice and
+# res_cpu_limit
+read_resources(){
+    res_cpus=1; res_memory=''; res_walltime=''; res_queue=''; res_directives=''
+    res_cpuset=''; res_nice=''; res_ionice=''; res_cpu_limit=''
+    if [ -f "$1/resources" ]; then
+        while read -r pair; do
+            case "$pair" in
+                cpus=*) res_cpus="${pair#*=}" ;;
+                memory=*) res_memory="${pair#*=}" ;;
+                walltime=*) res_walltime="${pair#*=}" ;;
+                queue=*) res_queue="${pair#*=}" ;;
+                directive=*) res_directives="$res_directives${pair#*=}
+" ;;
+                cpuset=*) res_cpuset="${pair#*=}" ;;
+                nice=*) res_nice="${pair#*=}" ;;
+                ionice=*) res_ionice="${pair#*=}" ;;
+                cpu_limit=*) res_cpu_limit="${pair#*=}" ;;
+            esac
+        done < "$1/resources"
+    fi
+}
+
+
+# Reads a job's status file
+# Arguments: job ID
+# Must be called from the queue's directory
+# Sets status (incomplete if unknown), arg, the dates from the file, and
+# job_date, the date the job was created or submitted, or else started
+read_job_status(){
+    status=''; arg=''; date1=''; date2=''
+    if [ -f "jobs/$1/status" ]; then
+        exec 3<"jobs/$1/status"
+        read status 0<&3 || true
+        read arg 0<&3 || true
+        read date1 0<&3 || true
+        read date2 0<&3 || true
+        exec 3<&-
+    fi
+    case "$status" in
+        created|queued|running|finished)
+            job_date="$date1"
+            ;;
+        *)
+            status=incomplete
+            job_date=''
+            ;;
+    esac
+}
+
+
+# Prints the information read by read_job_status, in the format of list
+# Arguments: job ID
+print_job_status(){
+    echo "$1"
+    case "$status" in
+        created)
+            echo "    status: created"
+            [ -z "$date1" ] || echo "    created: $date1"
+            ;;
+        queued)
+            echo "    status: queued"
+            [ -z "$arg" ] || echo "    priority: $arg"
+            [ -z "$date1" ] || echo "    submitted: $date1"
+            ;;
+        running)
+            echo "    status: running"
+            [ -z "$arg" ] || echo "    pid: $arg"
+            [ -z "$date1" ] || echo "    started: $date1"
+            ;;
+        finished)
+            echo "    status: finished"
+            [ -z "$arg" ] || echo "    exit_code: $arg"
+            [ -z "$date1" ] || echo "    started: $date1"
+            [ -z "$date2" ] || echo "    finished: $date2"
+            ;;
+        *)
+            echo "    status: incomplete"
+            ;;
+    esac
+    echo "    directory: $PWD/jobs/$1/stage"
+}
+
+
+# Prints the information from a job's status file, in the format of list
+# Arguments: job ID
+# Must be called from the queue's directory
+# Returns 0, or 3 if there is no such job
+print_job_record(){
+    if ! [ -d "jobs/$1" ]; then
+        echo "$1"
+        echo "    status: not found"
+        return 3
+    fi
+    read_job_status "$1"
+    print_job_status "$1"
+}
+
+
+# Scheduler
+# Submitted jobs wait in the pending directory until there are enough free
+# slots to run them (max_slots in tej.conf). Entries are named after the
+# priority and the order of submission, so that listing them gives the order
+# in which to start them, and contain the job ID and the script. Running jobs
+# have a file in the active directory with the number of slots they use, and
+# the CPUs they are pinned to if cpu_affinity is set (slots are then CPUs 0 to
+# max_slots - 1). Jobs are marked as running, without a pid, as soon as they
+# are dispatched; start then adds its own pid to the active file, records the
+# job's pid in its status, and frees the slots once the job is done, before
+# marking it as finished. The slots of jobs whose start wrapper and process are
+# gone, or whose start wrapper didn't run within start_timeout seconds, are
+# freed, and these jobs are marked as finished with exit code -2.
+# The functions below must be called from the queue's directory.
+
+
+# Takes the scheduler lock, waiting for it if needed
+lock_scheduler(){
+    while ! mkdir scheduler.lock 2>/dev/null; do
+        # Removes the lock if the process that held it is gone
+        if [ -f scheduler.lock/pid ] && read lock_pid < scheduler.lock/pid &&
+                ! kill -0 "$lock_pid" 2>/dev/null; then
+            rm -Rf scheduler.lock
+        else
+            sleep 1
+        fi
+    done
+    echo $$ > scheduler.lock/pid
+}
+
+
+# Releases the scheduler lock
+unlock_scheduler(){
+    rm -Rf scheduler.lock
+}
+
+
+# Sets slots to the number of slots a job needs, the number of CPUs from its
+# resources file
+# Arguments: job ID
+job_slots(){
+    read_resources "jobs/$1"
+    slots="$res_cpus"
+}
+
+
+# Sets cpus to a list of free CPUs to pin a job to, if cpu_affinity is set
+# Arguments: number of CPUs
+# Uses used_cpus, the CPUs already in use, as a comma-separated list
+allocate_cpus(){
+    cpus=''
+    if [ "$conf_cpu_affinity" != 1 ] || [ "$conf_max_slots" = 0 ] ||
+            ! command -v taskset >/dev/null 2>&1; then
+        return 0
+    fi
+    cpu=0
+    needed="$1"
+    while [ "$cpu" -lt "$conf_max_slots" ] && [ "$needed" -gt 0 ]; do
+        case ",$used_cpus," in
+            *",$cpu,"*) ;;
+            *)
+                cpus="$cpus${cpus:+,}$cpu"
+                needed=$((needed - 1))
+                ;;
+        esac
+        cpu=$((cpu + 1))
+    done
+    # Doesn't pin the job if these CPUs can't be used
+    if [ -n "$cpus" ] && ! taskset -c "$cpus" true 2>/dev/null; then
+        log_message warning "cpus=$cpus unavailable"
+        cpus=''
+    fi
+}
+
+
+# Returns 0 if the job of an active file is lost: its start wrapper and its
+# process are gone, or start didn't run within start_timeout seconds
+# Uses active_start, the pid of start from the active file, and arg and date1
+# from read_job_status
+active_lost(){
+    if [ -n "$active_start" ] && kill -0 "$active_start" 2>/dev/null; then
+        return 1
+    elif [ -n "$arg" ]; then
+        ! kill -0 "$arg" 2>/dev/null
+    elif [ -n "$active_start" ]; then
+        return 0
+    else
+        [ $(($(date +%s) - ${date1:-0})) -ge "$conf_start_timeout" ]
+    fi
+}
+
+
+# Adds a job to the pending directory, and marks it as queued
+# Arguments: job ID, script, priority (higher starts first, -9999 to 9999)
+# Must be called with the scheduler lock held
+enqueue_job(){
+    mkdir -p pending active
+    seq=0
+    if [ -f pending/.seq ]; then
+        read seq < pending/.seq
+    fi
+    seq=$((seq + 1))
+    echo "$seq" > pending/.seq
+    entry="$(printf '%05d-%010d' $((10000 - $3)) "$seq")"
+    printf '%s\n%s\n' "$1" "$2" > "pending/$entry"
+    echo "$entry" > "jobs/$1/pending"
+    (echo "queued"; echo "$3"; date +%s; echo '') > "jobs/$1/status.tmp"
+    mv -f "jobs/$1/status.tmp" "jobs/$1/status"
+}
+
+
+# Starts pending jobs, in order, while there are enough free slots
+# Must be called with the scheduler lock held
+schedule_jobs(){
+    read_config .
+    used=0
+    used_cpus=''
+    for active in active/*; do
+        if ! [ -f "$active" ]; then
+            continue
+        fi
+        # Drops the entries of jobs that are gone or that are finished
+        read_job_status "${active#active/}"
+        if [ "$status" = finished ] || ! [ -d "jobs/${active#active/}" ]; then
+            rm -f "$active"
+            continue
+        fi
+        active_start=''
+        { read active_slots; read active_cpus || true;
+          read active_start || true; } < "$active"
+        if [ "$status" = running ] && active_lost; then
+            active_id="${active#active/}"
+            rm -f "$active"
+            (echo "finished"; echo "-2"; echo "$date1"; date +%s) \
+                > "jobs/$active_id/status.tmp"
+            mv -f "jobs/$active_id/status.tmp" "jobs/$active_id/status"
+            log_event . finished "$active_id" -2
+            log_message warning "job=$active_id lost"
+            continue
+        fi
+        used=$((used + active_slots))
+        used_cpus="$used_cpus${active_cpus:+,$active_cpus}"
+    done
+    for entry in pending/*; do
+        if ! [ -f "$entry" ]; then
+            continue
+        fi
+        { read -r pending_id; read -r pending_script; } < "$entry"
+        job_slots "$pending_id"
+        # A job needing more slots than there are still runs, by itself
+        if [ "$conf_max_slots" -gt 0 ] && [ "$used" -gt 0 ] &&
+                [ $((used + slots)) -gt "$conf_max_slots" ]; then
+            break
+        fi
+        # Jobs that asked for specific CPUs are pinned by start
+        if [ -n "$res_cpuset" ]; then
+            cpus=''
+        else
+            allocate_cpus "$slots"
+        fi
+        printf '%s\n%s\n' "$slots" "$cpus" > "active/$pending_id"
+        rm -f "$entry" "jobs/$pending_id/pending"
+        (echo "running"; echo ''; date +%s; echo '') \
+            > "jobs/$pending_id/status.tmp"
+        mv -f "jobs/$pending_id/status.tmp" "jobs/$pending_id/status"
+        used=$((used + slots))
+        used_cpus="$used_cpus${cpus:+,$cpus}"
+        (cd "jobs/$pending_id/stage" &&
+         nohup ${cpus:+taskset -c "$cpus"} ../../../commands/start \
+             "$pending_script" > /dev/null 2>&1 < /dev/null &)
+    done
+}
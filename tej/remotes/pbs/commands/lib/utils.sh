@@ -23,3 +23,593 @@ format_timedelta(){
         echo "$minutes:$seconds"
     fi
 }
+
+
+# Reads the queue's configuration file, tej.conf
+# Arguments: path of the queue
+# The file has lines in the form key=value; lines starting with # are ignored
+# Sets conf_log_level (debug, info, warning, error or none; default info),
+# conf_log_max_size (size in bytes from which tej.log is rotated; default
+# 1048576, 0 for no limit), conf_log_keep (number of rotated logs kept;
+# default 3), conf_pbs_array (the qsub option submitting job arrays, -t or
+# -J, or "no" to submit jobs one by one; default auto, guessed from qsub) and
+# conf_qstat_interval (minimum number of seconds between two checks of the
+# jobs with qstat; default 60)
+read_config(){
+    conf_log_level=info
+    conf_log_max_size=1048576
+    conf_log_keep=3
+    conf_pbs_array=auto
+    conf_qstat_interval=60
+    if [ -f "$1/tej.conf" ]; then
+        while IFS=' =' read -r key value || [ -n "$key" ]; do
+            case "$key" in
+                log_level) conf_log_level="$value" ;;
+                log_max_size) conf_log_max_size="$value" ;;
+                log_keep) conf_log_keep="$value" ;;
+                pbs_array) conf_pbs_array="$value" ;;
+                qstat_interval) conf_qstat_interval="$value" ;;
+            esac
+        done < "$1/tej.conf"
+    fi
+    case "$conf_log_max_size" in
+        ''|*[!0-9]*) conf_log_max_size=1048576 ;;
+    esac
+    case "$conf_log_keep" in
+        ''|*[!0-9]*) conf_log_keep=3 ;;
+    esac
+    case "$conf_qstat_interval" in
+        ''|*[!0-9]*) conf_qstat_interval=60 ;;
+    esac
+}
+
+
+# Sets up logging to tej.log for a command
+# Arguments: path of the queue, name of the command
+# Records are single lines: time, level, command, then the message, usually
+# key=value pairs
+log_init(){
+    case "$1" in
+        /*) log_file="$1/tej.log" ;;
+        *) log_file="$PWD/$1/tej.log" ;;
+    esac
+    log_command="$2"
+    log_time=''
+    log_checked=''
+    read_config "$1"
+    case "$conf_log_level" in
+        debug) log_threshold=0 ;;
+        warning) log_threshold=2 ;;
+        error) log_threshold=3 ;;
+        none) log_threshold=4 ;;
+        *) log_threshold=1 ;;
+    esac
+}
+
+
+# Appends a record to tej.log, if its level is enabled
+# Arguments: level (debug, info, warning or error), message
+# The time is taken from $EPOCHSECONDS if the shell has it; otherwise date is
+# only run for the first record of the command, set log_time='' to update it
+log_message(){
+    case "$1" in
+        debug) log_level=0 ;;
+        info) log_level=1 ;;
+        warning) log_level=2 ;;
+        *) log_level=3 ;;
+    esac
+    if [ "$log_level" -lt "$log_threshold" ]; then
+        return 0
+    fi
+    if [ -n "${EPOCHSECONDS:-}" ]; then
+        log_time="$EPOCHSECONDS"
+    elif [ -z "$log_time" ]; then
+        log_time="$(date +%s)"
+    fi
+    if [ -z "$log_checked" ]; then
+        log_checked=1
+        rotate_log
+    fi
+    printf '%s %s %s %s\n' "$log_time" "$1" "$log_command" "$2" >> "$log_file"
+}
+
+
+# Rotates tej.log if it is larger than conf_log_max_size
+# The previous logs are kept as tej.log.1 (most recent) to tej.log.N
+rotate_log(){
+    if [ "$conf_log_max_size" = 0 ] || ! [ -f "$log_file" ]; then
+        return 0
+    fi
+    log_size=$(wc -c < "$log_file")
+    if [ "$((log_size))" -lt "$conf_log_max_size" ]; then
+        return 0
+    fi
+    i="$conf_log_keep"
+    while [ "$i" -gt 1 ]; do
+        if [ -f "$log_file.$((i - 1))" ]; then
+            mv -f "$log_file.$((i - 1))" "$log_file.$i"
+        fi
+        i=$((i - 1))
+    done
+    if [ "$conf_log_keep" -gt 0 ]; then
+        mv -f "$log_file" "$log_file.1" 2>/dev/null || true
+    else
+        rm -f "$log_file"
+    fi
+}
+
+
+# Appends a line to the event log, events.log in the queue
+# Arguments: path of the queue, event, job ID, optional value
+# Events are created, submitted, started (value is the pid or PBS id),
+# finished (value is the exit code) and deleted
+log_event(){
+    echo "$(date +%s) $2 $3${4:+ $4}" >> "$1/events.log"
+}
+
+
+# Creates the directory for a new job
+# Arguments: job ID, creation date
+# Returns 0 if created, 4 if the job already exists, 1 on error
+create_job(){
+    job_root="jobs/$1"
+    if ! mkdir "$job_root" 2>/dev/null; then
+        if [ -d "$job_root" ]; then
+            return 4
+        else
+            return 1
+        fi
+    fi
+    (echo "created"; echo ''; echo "$2"; echo ''; echo '') > "$job_root/status"
+    log_event . created "$1"
+}
+
+
+# Writes the resources requested for a job to its resources file
+# Arguments: job directory, then key=value pairs: cpus (number of cores),
+# memory (for example 512mb or 4gb), walltime ([[hours:]minutes:]seconds),
+# queue (name of the PBS queue), directive (extra #PBS line, can be
+# repeated), and for the default runtime cpuset (CPUs to run on, for example
+# 0-3,8), nice (-20 to 19), ionice (class idle, best-effort or realtime,
+# optionally followed by a colon and a level from 0 to 7) and cpu_limit
+# (number of CPUs worth of time the job can use, for example 1.5)
+# Returns 1 if a pair is invalid
+write_resources(){
+    resources_file="$1/resources"
+    shift
+    if [ $# = 0 ]; then
+        return 0
+    fi
+    : > "$resources_file.tmp"
+    for pair in "$@"; do
+        value="${pair#*=}"
+        unit="${value##*[0-9]}"
+        case "$pair" in
+            cpus=*)
+                case "$value" in ''|*[!0-9]*|0) value='' ;; esac
+                ;;
+            memory=*)
+                case "${value%"$unit"}" in ''|*[!0-9]*) value='' ;; esac
+                case "$unit" in
+                    ''|b|kb|mb|gb|tb|B|KB|MB|GB|TB) ;;
+                    *) value='' ;;
+                esac
+                ;;
+            walltime=*)
+                case "$value" in ''|*[!0-9:]*) value='' ;; esac
+                ;;
+            queue=*)
+                case "$value" in ''|*[!A-Za-z0-9_.@-]*) value='' ;; esac
+                ;;
+            directive=*)
+                case "$value" in *'
+'*) value='' ;; esac
+                ;;
+            cpuset=*)
+                case "$value" in ''|*[!0-9,-]*) value='' ;; esac
+                ;;
+            nice=*)
+                case "${value#-}" in ''|*[!0-9]*) value='' ;; esac
+                ;;
+            ionice=*)
+                case "$value" in
+                    idle|best-effort|realtime) ;;
+                    best-effort:[0-7]|realtime:[0-7]) ;;
+                    *) value='' ;;
+                esac
+                ;;
+            cpu_limit=*)
+                case "$value" in
+                    ''|*[!0-9.]*|*.*.*|.*|*.) value='' ;;
+                esac
+                ;;
+            *)
+                value=''
+                ;;
+        esac
+        if [ -z "$value" ]; then
+            echo "Invalid resource '$pair'" >&2
+            rm -f "$resources_file.tmp"
+            return 1
+        fi
+        echo "$pair" >> "$resources_file.tmp"
+    done
+    mv -f "$resources_file.tmp" "$resources_file"
+}
+
+
+# Reads the resources file of a job, see write_resources
+# Arguments: job directory
+# Sets res_cpus (default 1), res_memory, res_walltime, res_queue,
+# res_directives (one per line), res_cpuset, res_nice, res_ionice and
+# res_cpu_limit
+read_resources(){
+    res_cpus=1; res_memory=''; res_walltime=''; res_queue=''; res_directives=''
+    res_cpuset=''; res_nice=''; res_ionice=''; res_cpu_limit=''
+    if [ -f "$1/resources" ]; then
+        while read -r pair; do
+            case "$pair" in
+                cpus=*) res_cpus="${pair#*=}" ;;
+                memory=*) res_memory="${pair#*=}" ;;
+                walltime=*) res_walltime="${pair#*=}" ;;
+                queue=*) res_queue="${pair#*=}" ;;
+                directive=*) res_directives="$res_directives${pair#*=}
+" ;;
+                cpuset=*) res_cpuset="${pair#*=}" ;;
+                nice=*) res_nice="${pair#*=}" ;;
+                ionice=*) res_ionice="${pair#*=}" ;;
+                cpu_limit=*) res_cpu_limit="${pair#*=}" ;;
+            esac
+        done < "$1/resources"
+    fi
+}
+
+
+# Reads a job's status file
+# Arguments: job ID
+# Must be called from the queue's directory
+# Sets status (incomplete if unknown), arg, the dates from the file, and
+# job_date, the date the job was created or submitted, or else started
+read_job_status(){
+    status=''; arg=''; date1=''; date2=''; date3=''
+    if [ -f "jobs/$1/status" ]; then
+        exec 3<"jobs/$1/status"
+        read status 0<&3 || true
+        read arg 0<&3 || true
+        read date1 0<&3 || true
+        read date2 0<&3 || true
+        read date3 0<&3 || true
+        exec 3<&-
+    fi
+    case "$status" in
+        submitted|running)
+            job_date="$date1"
+            read_pbs_id "$1"
+            ;;
+        created|finished)
+            job_date="$date1"
+            ;;
+        *)
+            status=incomplete
+            job_date=''
+            ;;
+    esac
+}
+
+
+# Sets arg to the PBS id of a submitted or running job, if it is empty, from
+# the pbs_id file where the ID is recorded once qsub returns
+# Arguments: job ID
+# Must be called from the queue's directory
+read_pbs_id(){
+    if [ -z "$arg" ] && [ -f "jobs/$1/pbs_id" ]; then
+        read arg < "jobs/$1/pbs_id" || true
+    fi
+}
+
+
+# Prints the information read by read_job_status, in the format of list
+# Arguments: job ID
+print_job_status(){
+    echo "$1"
+    case "$status" in
+        created)
+            echo "    status: created"
+            [ -z "$date1" ] || echo "    created: $date1"
+            ;;
+        submitted)
+            echo "    status: submitted"
+            [ -z "$arg" ] || echo "    pbs_id: $arg"
+            [ -z "$date1" ] || echo "    submitted: $date1"
+            ;;
+        running)
+            echo "    status: running"
+            [ -z "$arg" ] || echo "    pbs_id: $arg"
+            [ -z "$date1" ] || echo "    submitted: $date1"
+            [ -z "$date2" ] || echo "    started: $date2"
+            ;;
+        finished)
+            echo "    status: finished"
+            [ -z "$arg" ] || echo "    exit_code: $arg"
+            [ -z "$date1" ] || echo "    submitted: $date1"
+            [ -z "$date2" ] || echo "    started: $date2"
+            [ -z "$date3" ] || echo "    finished: $date3"
+            ;;
+        *)
+            echo "    status: incomplete"
+            ;;
+    esac
+    echo "    directory: $PWD/jobs/$1/stage"
+}
+
+
+# Prints the information from a job's status file, in the format of list
+# Arguments: job ID
+# Must be called from the queue's directory
+# Returns 0, or 3 if there is no such job
+print_job_record(){
+    if ! [ -d "jobs/$1" ]; then
+        echo "$1"
+        echo "    status: not found"
+        return 3
+    fi
+    read_job_status "$1"
+    print_job_status "$1"
+}
+
+
+# Validates the priority of a job, and clamps it to the range PBS accepts
+# Uses and sets priority; returns 1 if it is not an integer
+check_priority(){
+    case "${priority#-}" in
+        ''|*[!0-9]*)
+            return 1
+            ;;
+    esac
+    # PBS priorities go from -1024 to 1023
+    if [ "$priority" -gt 1023 ]; then
+        priority=1023
+    elif [ "$priority" -lt -1024 ]; then
+        priority=-1024
+    fi
+}
+
+
+# Prints the #PBS lines requesting the resources of a job
+# Arguments: job directory
+resource_directives(){
+    read_resources "$1"
+    if [ "$res_cpus" = 1 ]; then
+        echo "#PBS -l nodes=1"
+    else
+        echo "#PBS -l nodes=1:ppn=$res_cpus"
+    fi
+    [ -z "$res_memory" ] || echo "#PBS -l mem=$res_memory"
+    [ -z "$res_walltime" ] || echo "#PBS -l walltime=$res_walltime"
+    [ -z "$res_queue" ] || echo "#PBS -q $res_queue"
+    printf '%s' "$res_directives" | while read -r directive; do
+        echo "#PBS ${directive#\#PBS }"
+    done
+}
+
+
+# Writes the PBS job file of a job, tej_job.sh in the job's directory
+# Arguments: absolute path of the job's directory, command or script path
+# (relative to the stage directory), priority
+# The job file can also be run with sh by the job file of an array, the
+# directives are then ignored
+write_job_script(){
+    cat >"$1/tej_job.sh"<<END
+#PBS -V
+#PBS -o localhost:\${PBS_O_WORKDIR}/_pbs_stdout
+#PBS -e localhost:\${PBS_O_WORKDIR}/_pbs_stderr
+$(resource_directives "$1")
+#PBS -N $(basename "$1")
+#PBS -S /bin/sh
+#PBS -p $3
+
+cd '$1'
+
+exec 3<status
+read status <&3
+read pbs_id <&3
+read submitted_date <&3
+exec 3<&-
+# The ID is not in the status file, it is recorded by submit once qsub returns
+pbs_id="\${pbs_id:-\$PBS_JOBID}"
+
+script='$2'
+cd "stage"
+if [ -f "./\$script" ]; then
+  chmod +x "./\$script"
+  script="./\$script"
+fi
+started_date=\$(date "+%s")
+(echo "running"; echo "\$pbs_id"; echo "\$submitted_date"; echo "\$started_date"; echo '') > ../status.tmp
+mv -f ../status.tmp ../status
+echo "\$started_date started $(basename "$1") \$pbs_id" >> ../../../events.log
+# Output is written directly to the stage directory, so it can be read while
+# the job runs
+sh -c "\$script" >_stdout 2>_stderr </dev/null && exitcode=0 || exitcode=\$?
+(echo "finished"; echo "\$exitcode"; echo "\$submitted_date"; echo "\$started_date"; date "+%s") > ../status.tmp
+mv -f ../status.tmp ../status
+rm -f '../../../active/$(basename "$1")'
+echo "\$(date +%s) finished $(basename "$1") \$exitcode" >> ../../../events.log
+# Exits with the job's code, so that PBS reports it too
+exit \$exitcode
+END
+}
+
+
+# Marks a job as submitted, before it is given to qsub, so that its job file
+# doesn't find it still created if it starts right away
+# Arguments: job directory
+mark_submitted(){
+    cp "$1/status" "$1/status.created"
+    rm -f "$1/pbs_id"
+    mkdir -p "$1/../../active"
+    touch "$1/../../active/$(basename "$1")"
+    (echo "submitted"; echo ''; date "+%s"; echo ''; echo '') > "$1/status.tmp"
+    mv -f "$1/status.tmp" "$1/status"
+}
+
+
+# Records the PBS id of a job once qsub returned, in its pbs_id file
+# The status file is left to the job file, that might already be running; it
+# gets the ID from PBS_JOBID
+# Arguments: job directory, PBS id
+record_pbs_id(){
+    rm -f "$1/status.created"
+    echo "$2" > "$1/pbs_id.tmp"
+    mv -f "$1/pbs_id.tmp" "$1/pbs_id"
+}
+
+
+# Puts back the created status of a job after qsub failed
+# Arguments: job directory
+unmark_submitted(){
+    read pbs_status < "$1/status" || true
+    if [ "$pbs_status" = submitted ]; then
+        mv -f "$1/status.created" "$1/status"
+    else
+        rm -f "$1/status.created"
+    fi
+}
+
+
+# Prints the qsub option submitting a job array: -t (Torque) or -J (PBS Pro)
+# Prints nothing if arrays are disabled by conf_pbs_array
+array_option(){
+    case "$conf_pbs_array" in
+        -t|t) echo "-t" ;;
+        -J|J) echo "-J" ;;
+        no) ;;
+        *)
+            if qsub --version 2>&1 | grep -qi "pbs_version"; then
+                echo "-J"
+            else
+                echo "-t"
+            fi
+            ;;
+    esac
+}
+
+
+# Checks the jobs that are submitted or running against PBS, with a single
+# qstat call for all of them, and marks the ones that PBS no longer runs as
+# finished
+# The jobs to check are the ones listed in the active directory, where they
+# are added when submitted and removed when finished; queues from older
+# versions, without the active/.index file, are scanned once to fill it
+# These are jobs that ended without their job file recording it, for example
+# killed for exceeding their walltime or lost with their node; they get the
+# exit status reported by PBS, or -2 if there is none
+# Does nothing if the last check was less than conf_qstat_interval seconds
+# ago; must be called from the queue's directory
+reconcile_jobs(){
+    reconcile_date=$(date +%s)
+    if [ -f qstat.stamp ]; then
+        read reconcile_last < qstat.stamp || true
+        case "$reconcile_last" in
+            ''|*[!0-9]*) ;;
+            *)
+                if [ $((reconcile_date - reconcile_last)) -lt "$conf_qstat_interval" ]; then
+                    return 0
+                fi
+                ;;
+        esac
+    fi
+    echo "$reconcile_date" > qstat.stamp
+
+    if ! [ -f active/.index ]; then
+        mkdir -p active
+        for reconcile_dir in jobs/*; do
+            [ -d "$reconcile_dir" ] || continue
+            read_job_status "${reconcile_dir#jobs/}"
+            case "$status" in
+                submitted|running) touch "active/${reconcile_dir#jobs/}" ;;
+            esac
+        done
+        touch active/.index
+    fi
+
+    reconcile_ifs="$IFS"
+    IFS=' '
+    reconcile_ids=''
+    reconcile_jobs=''
+    for reconcile_entry in active/*; do
+        [ -f "$reconcile_entry" ] || continue
+        reconcile_job="${reconcile_entry#active/}"
+        read_job_status "$reconcile_job"
+        if ! [ -d "jobs/$reconcile_job" ]; then
+            rm -f "$reconcile_entry"
+            continue
+        fi
+        case "$status" in
+            submitted|running)
+                if [ -n "$arg" ]; then
+                    reconcile_ids="$reconcile_ids $arg"
+                    # Jobs are matched on the part of the ID before the
+                    # server's name, which qstat might print differently
+                    reconcile_jobs="$reconcile_jobs$reconcile_job ${arg%%.*}
+"
+                fi
+                ;;
+            *)
+                rm -f "$reconcile_entry"
+                ;;
+        esac
+    done
+    if [ -z "$reconcile_ids" ]; then
+        IFS="$reconcile_ifs"
+        return 0
+    fi
+
+    # Reads the jobs, then the output of qstat (with the errors, which
+    # report the jobs PBS has forgotten) after a separator line
+    # The IDs are split on spaces but not expanded, array IDs such as 7[1]
+    # being glob patterns
+    reconcile_ended="$({ printf '%s@@\n' "$reconcile_jobs";
+                         set -f
+                         qstat -f $reconcile_ids 2>&1 </dev/null || true; } |
+        awk '
+            !qstat {
+                if ($0 == "@@") qstat = 1
+                else jobs[$2] = $1
+                next
+            }
+            /^Job Id:/ { key = $3; sub(/\..*/, "", key); next }
+            /^[ \t]*job_state = / { state[key] = $3; next }
+            /^[ \t]*exit_status = / { code[key] = $3; next }
+            /Unknown Job Id/ {
+                other = $NF; sub(/\..*/, "", other); state[other] = "U"; next
+            }
+            /Job has finished/ {
+                other = $2; sub(/\..*/, "", other); state[other] = "F"; next
+            }
+            END {
+                for (key in jobs) {
+                    if (state[key] == "C" || state[key] == "F" ||
+                            state[key] == "U") {
+                        exit_code = (key in code) ? code[key] : -2
+                        print jobs[key], exit_code, state[key]
+                    }
+                }
+            }')"
+    IFS="$reconcile_ifs"
+
+    echo "$reconcile_ended" | while read -r reconcile_job reconcile_code reconcile_state; do
+        [ -n "$reconcile_job" ] || continue
+        # The job file might have recorded the end of the job in the meantime
+        read_job_status "$reconcile_job"
+        case "$status" in
+            submitted|running) ;;
+            *) continue ;;
+        esac
+        (echo "finished"; echo "$reconcile_code"; echo "$date1"; echo "$date2"; echo "$reconcile_date") > "jobs/$reconcile_job/status.tmp"
+        mv -f "jobs/$reconcile_job/status.tmp" "jobs/$reconcile_job/status"
+        rm -f "active/$reconcile_job"
+        log_event . finished "$reconcile_job" "$reconcile_code"
+        log_message warning "job=$reconcile_job pbs_id=$arg state=$reconcile_state exit_code=$reconcile_code lost"
+    done
+}
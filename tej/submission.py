@@ -1,7 +1,12 @@
 from __future__ import absolute_import, division, unicode_literals
 
+import collections
+import datetime
+import functools
 import getpass
 import logging
+import math
+import os
 import paramiko
 import pkg_resources
 import random
@@ -10,20 +15,32 @@ from rpaths import PosixPath, Path
 import scp
 import select
 import socket
+import stat
+import threading
+import time
 
-from tej.errors import InvalidDestination, QueueDoesntExist, \
+from tej.errors import Error, InvalidDestination, QueueDoesntExist, \
     QueueLinkBroken, QueueExists, JobAlreadyExists, JobNotFound, \
     JobStillRunning, RemoteCommandFailure
-from tej.utils import unicode_, string_types, iteritems, irange, shell_escape
+from tej.cache import get_default_location_cache
+from tej.pool import get_default_pool
+from tej.transfer import CACHE_MIN_SIZE, COMPRESSIONS, TAR_THRESHOLD, \
+    ChunkReader, CountingWriter, directory_stats, extract_command, hash_file, \
+    list_directory, match_filters, read_tar, write_tar, zstandard
+from tej.utils import unicode_, string_types, iteritems, izip, irange, \
+    listvalues, parallel_map, shell_escape
 
 
 __all__ = ['DEFAULT_TEJ_DIR',
            'parse_ssh_destination', 'destination_as_string',
-           'ServerLogger', 'RemoteQueue']
+           'ServerLogger', 'JobEvent', 'RemoteQueue']
 
 
 DEFAULT_TEJ_DIR = '~/.tej'
 
+# Size of the reads from SSH channels
+RECV_SIZE = 65536
+
 
 logger = logging.getLogger('tej')
 
@@ -131,6 +148,66 @@ class ServerLogger(object):
         self.logger.info(data)
 
 
+class _Agent(object):
+    """A long-lived ``commands/agent`` process on the server.
+
+    The agent runs the runtime's scripts on request, which avoids opening a
+    new channel and starting a new shell for each command.
+    """
+    def __init__(self, queue, chan, token):
+        self.queue = queue
+        self.chan = chan
+        self.token = token.encode('ascii')
+        self.ready = False
+        self.lock = threading.Lock()
+        self._rest = b''
+        self._lines = collections.deque()
+
+    def _read_line(self, server_err):
+        """Reads a line from the agent's stdout.
+        """
+        while not self._lines:
+            select.select([self.chan], [], [])
+            while self.chan.recv_stderr_ready():
+                server_err.append(self.chan.recv_stderr(RECV_SIZE))
+            if self.chan.recv_ready():
+                lines = (self._rest + self.chan.recv(RECV_SIZE)).split(b'\n')
+                self._rest = lines.pop()
+                self._lines.extend(lines)
+            elif self.chan.eof_received or self.chan.closed:
+                raise EOFError("Agent exited")
+        return self._lines.popleft()
+
+    def call(self, name, args, server_err, callback):
+        """Runs a command through the agent, returning its exit status.
+
+        `callback` gets called with each line of output (without the line
+        terminator). Must be called with the lock held.
+        """
+        request = ' '.join([name] + [shell_escape(arg) for arg in args])
+        self.chan.sendall((request + '\n').encode('utf-8'))
+        if not self.ready:
+            if self._read_line(server_err) != self.token + b' ready':
+                raise EOFError("Agent didn't start")
+            self.ready = True
+        end = self.token + b' '
+        previous = None
+        while True:
+            line = self._read_line(server_err)
+            if line.startswith(end):
+                # The agent writes a newline before the token, so the previous
+                # line is empty unless the output wasn't terminated
+                if previous and callback is not None:
+                    callback(previous)
+                return int(line[len(end):])
+            if previous is not None and callback is not None:
+                callback(previous)
+            previous = line
+
+    def close(self):
+        self.chan.close()
+
+
 JOB_ID_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ" \
                "abcdefghijklmnopqrstuvwxyz" \
                "0123456789_-+=@%:.,"
@@ -141,16 +218,149 @@ def check_jobid(job_id):
         raise ValueError("Invalid job identifier")
 
 
+_MEMORY_UNITS = [('tb', 1 << 40), ('gb', 1 << 30), ('mb', 1 << 20),
+                 ('kb', 1 << 10)]
+
+_MEMORY_RE = re.compile(r'^[0-9]+([kmgt]?b)?$')
+_WALLTIME_RE = re.compile(r'^[0-9]+(:[0-9]+){0,2}$')
+_QUEUE_RE = re.compile(r'^[A-Za-z0-9_.@-]+$')
+_CPUSET_RE = re.compile(r'^[0-9]+(-[0-9]+)?(,[0-9]+(-[0-9]+)?)*$')
+_IONICE_RE = re.compile(r'^(idle|(best-effort|realtime)(:[0-7])?)$')
+
+
+def _resource_args(resources):
+    """Turns a dictionary of resources into arguments for the submit scripts.
+
+    See `RemoteQueue.submit()` for the keys.
+    """
+    args = []
+    for key, value in sorted(iteritems(resources)):
+        if value is None:
+            continue
+        if key == 'cpus':
+            if int(value) != value or value < 1:
+                raise ValueError("Invalid number of CPUs %r" % (value,))
+            value = '%d' % value
+        elif key == 'memory':
+            if isinstance(value, string_types):
+                value = value.strip().lower()
+            else:
+                size = int(value)
+                value = '%db' % size
+                for unit, factor in _MEMORY_UNITS:
+                    if size > 0 and size % factor == 0:
+                        value = '%d%s' % (size // factor, unit)
+                        break
+            if not _MEMORY_RE.match(value):
+                raise ValueError("Invalid amount of memory %r" % (value,))
+        elif key == 'walltime':
+            if isinstance(value, datetime.timedelta):
+                value = value.total_seconds()
+            if not isinstance(value, string_types):
+                seconds = int(math.ceil(value))
+                value = '%d:%02d:%02d' % (seconds // 3600,
+                                          seconds // 60 % 60,
+                                          seconds % 60)
+            if not _WALLTIME_RE.match(value):
+                raise ValueError("Invalid walltime %r" % (value,))
+        elif key == 'queue':
+            if not _QUEUE_RE.match(value):
+                raise ValueError("Invalid PBS queue %r" % (value,))
+        elif key == 'cpuset':
+            if not isinstance(value, string_types):
+                value = ','.join('%d' % cpu for cpu in value)
+            if not _CPUSET_RE.match(value):
+                raise ValueError("Invalid CPU set %r" % (value,))
+        elif key == 'nice':
+            if int(value) != value or not -20 <= value <= 19:
+                raise ValueError("Invalid nice level %r" % (value,))
+            value = '%d' % value
+        elif key == 'ionice':
+            if not _IONICE_RE.match(value):
+                raise ValueError("Invalid ionice class %r" % (value,))
+        elif key == 'cpu_limit':
+            if not value >= 0.01:
+                raise ValueError("Invalid CPU limit %r" % (value,))
+            value = ('%.2f' % value).rstrip('0').rstrip('.')
+        elif key == 'directives':
+            if isinstance(value, string_types):
+                value = [value]
+            for directive in value:
+                if not directive or '\n' in directive:
+                    raise ValueError("Invalid directive %r" % (directive,))
+                args.append('directive=%s' % directive)
+            continue
+        else:
+            raise ValueError("Unknown resource %r" % (key,))
+        args.append('%s=%s' % (key, value))
+    return args
+
+
+class _StaleLocation(Exception):
+    """The location of the queue from the cache is no longer valid.
+    """
+
+
+def _retry_stale_location(method):
+    """Decorator running a method again if the cached queue location is stale.
+
+    `RemoteQueue._check_location()` raises `_StaleLocation` after discarding
+    the location, so the second run will look the queue up again.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except _StaleLocation:
+            logger.info("Queue is no longer at cached location, looking it "
+                        "up again")
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class _Progress(object):
+    """Aggregates the progress of concurrent transfers for a callback.
+    """
+    def __init__(self, total, callback):
+        self.total = total
+        self.received = 0
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def add(self, size):
+        with self._lock:
+            self.received += size
+            if self._callback is not None:
+                elapsed = time.time() - self._start
+                self._callback(self.received, self.total,
+                               self.received / elapsed if elapsed > 0 else 0)
+
+
+class JobEvent(collections.namedtuple('JobEvent',
+                                      ['time', 'event', 'job_id', 'value'])):
+    """A change in the state of a job, from `RemoteQueue.events()`.
+
+    `time` is a UNIX timestamp. `event` is one of ``'created'``,
+    ``'submitted'``, ``'started'``, ``'finished'`` or ``'deleted'``. `value` is
+    the process or PBS identifier for ``'started'`` (and ``'submitted'`` with
+    PBS), the exit code for ``'finished'``, and None otherwise.
+    """
+    __slots__ = ()
+
+
 class RemoteQueue(object):
     JOB_DONE = 'finished'
     JOB_RUNNING = 'running'
     JOB_INCOMPLETE = 'incomplete'
     JOB_CREATED = 'created'
+    JOB_QUEUED = 'queued'
 
     PROTOCOL_VERSION = 0, 2
 
     def __init__(self, destination, queue,
-                 setup_runtime=None, need_runtime=None):
+                 setup_runtime=None, need_runtime=None, pool=None,
+                 agent=False, location_cache=None, status_cache=None):
         """Creates a queue object, that represents a job queue on a server.
 
         :param destination: The address of the server, used to SSH into it.
@@ -166,6 +376,21 @@ class RemoteQueue(object):
         the queue already exists on the server and this argument is not None,
         the installed runtime will be matched against it, and a failure will be
         reported if it is not one of the provided values.
+        :param pool: The `ConnectionPool` to get SSH connections from. If None
+        (default), the process-wide pool from `get_default_pool()` is used, so
+        that queues on the same server share their connections.
+        :param agent: Whether to run the runtime's scripts through a long-lived
+        agent process on the server, instead of starting a new shell for each
+        command. If the runtime doesn't have the agent, tej falls back on
+        running the scripts directly.
+        :param location_cache: The `LocationCache` recording where the queue
+        is on the server, so that it doesn't need to be looked up every time.
+        If None (default), the one from `get_default_location_cache()` is
+        used; False disables it.
+        :param status_cache: A `StatusCache` in which to keep the status of
+        jobs, so that `status()` and `download()` don't need to ask the server
+        about finished jobs again. If None (default), every call asks the
+        server.
         """
         if isinstance(destination, string_types):
             self.destination = parse_ssh_destination(destination)
@@ -183,9 +408,40 @@ class RemoteQueue(object):
             self.need_runtime = None
         self.queue = PosixPath(queue)
         self._queue = None
+        self._queue_cached = False
+        self._links = []
+        self._version = self._runtime = None
+        if location_cache is None:
+            location_cache = get_default_location_cache()
+        self._location_cache = location_cache or None
+        self.status_cache = status_cache
+        if pool is None:
+            pool = get_default_pool()
+        self._pool = pool
         self._ssh = None
+        self._reconnect_lock = threading.Lock()
+        self.use_agent = agent
+        self._agent = None
+        self._compression = None
         self._connect()
 
+    def close(self):
+        """Gives the SSH connection back to the pool.
+
+        The connection will be closed once no other queue is using it and it
+        has been idle for a while.
+        """
+        self._close_agent()
+        if self._ssh is not None:
+            self._pool.release(self._ssh)
+            self._ssh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def server_logger(self):
         """Handles messages from the server.
 
@@ -206,8 +462,8 @@ class RemoteQueue(object):
         ssh.set_missing_host_key_policy(paramiko.RejectPolicy())
         return ssh
 
-    def _connect(self):
-        """Connects via SSH.
+    def _new_connection(self):
+        """Opens a new SSH connection.
         """
         ssh = self._ssh_client()
         logger.debug("Connecting with %s",
@@ -215,7 +471,19 @@ class RemoteQueue(object):
                                for k, v in iteritems(self.destination)))
         ssh.connect(**self.destination)
         logger.debug("Connected to %s", self.destination['hostname'])
-        self._ssh = ssh
+        return ssh
+
+    def _connect(self):
+        """Gets an SSH connection from the pool.
+
+        Connections are only shared between queues using the same
+        `_ssh_client()` method, since subclasses can override it to change the
+        client's settings.
+        """
+        ssh_client = type(self)._ssh_client
+        group = getattr(ssh_client, '__func__', ssh_client)
+        self._ssh = self._pool.acquire(self.destination, self._new_connection,
+                                       group)
 
     def get_client(self):
         """Gets the SSH client.
@@ -223,58 +491,151 @@ class RemoteQueue(object):
         This will check that the connection is still alive first, and reconnect
         if necessary.
         """
-        if self._ssh is None:
+        ssh = self._ssh
+        if ssh is None:
+            with self._reconnect_lock:
+                if self._ssh is None:
+                    self._connect()
+        elif not self._is_alive(ssh):
+            # This is only a local check; a connection that died silently will
+            # be noticed by the keepalives, or when opening a channel fails
+            self._reconnect(ssh)
+        return self._ssh
+
+    @staticmethod
+    def _is_alive(ssh):
+        """Checks whether the transport of an SSH client is still active.
+        """
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _reconnect(self, dead):
+        """Drops the given dead connection and gets a new one.
+
+        Several threads can share this queue (see `submit_many()`), so only the
+        first one to notice that the connection died replaces it; the others
+        use the new one.
+        """
+        with self._reconnect_lock:
+            if self._ssh is not dead:
+                return
+            logger.warning("Lost connection, reconnecting...")
+            self._pool.discard(dead)
+            self._ssh = None
             self._connect()
-            return self._ssh
-        else:
-            try:
-                chan = self._ssh.get_transport().open_session()
-            except (socket.error, paramiko.SSHException):
-                logger.warning("Lost connection, reconnecting...")
-                self._ssh.close()
-                self._connect()
-            else:
-                chan.close()
-            return self._ssh
+
+    def _open_channel(self, cmd):
+        """Opens a channel and starts a command on it.
+
+        If that fails because the connection was lost, reconnects and tries
+        again once. The command can't have run at that point, so this is safe.
+        Other errors, such as the server refusing to open more sessions, are
+        raised without touching the connection, which other queues might be
+        using.
+        """
+        ssh = self.get_client()
+        try:
+            chan = ssh.get_transport().open_session()
+            chan.exec_command(cmd)
+        except (socket.error, EOFError, paramiko.SSHException):
+            if self._is_alive(ssh):
+                raise
+            self._reconnect(ssh)
+            chan = self._ssh.get_transport().open_session()
+            chan.exec_command(cmd)
+        return chan
 
     def get_scp_client(self):
         return scp.SCPClient(self.get_client().get_transport())
 
-    def _call(self, cmd, get_output):
-        """Calls a command through the SSH connection.
+    def _read_channel(self, chan, server_err):
+        """Reads from a channel until EOF, generating chunks of its stdout.
 
-        Remote stderr gets printed to this program's stderr. Output is captured
-        and may be returned.
+        Stderr is handed to `server_err` as it arrives, so that the remote
+        command can't get stuck writing to it.
+        """
+        while True:
+            select.select([chan], [], [])
+            while chan.recv_stderr_ready():
+                server_err.append(chan.recv_stderr(RECV_SIZE))
+            if chan.recv_ready():
+                yield chan.recv(RECV_SIZE)
+            elif chan.eof_received or chan.closed:
+                while chan.recv_stderr_ready():
+                    server_err.append(chan.recv_stderr(RECV_SIZE))
+                break
+
+    def _call_stream(self, cmd, callback, stdin=None):
+        """Calls a command, handing its output to `callback` as it arrives.
+
+        `callback` gets called with each chunk of stdout (bytes), as it is
+        received; if it is None, the output is discarded. Returns the exit
+        status of the command.
+
+        `stdin` can be bytes to send to the command, or a function that will
+        be called with the channel to write to it. The command's stdin gets
+        closed afterwards.
         """
         server_err = self.server_logger()
 
-        chan = self.get_client().get_transport().open_session()
+        logger.debug("Invoking %r%s%s",
+                     cmd, " (stdout)" if callback is not None else "",
+                     " (stdin)" if stdin is not None else "")
+        chan = self._open_channel('/bin/sh -c %s' % shell_escape(cmd))
         try:
-            logger.debug("Invoking %r%s",
-                         cmd, " (stdout)" if get_output else "")
-            chan.exec_command('/bin/sh -c %s' % shell_escape(cmd))
-            output = b''
-            while True:
-                r, w, e = select.select([chan], [], [])
-                if chan not in r:
-                    continue  # pragma: no cover
-                recvd = False
-                while chan.recv_stderr_ready():
-                    data = chan.recv_stderr(1024)
-                    server_err.append(data)
-                    recvd = True
-                while chan.recv_ready():
-                    data = chan.recv(1024)
-                    if get_output:
-                        output += data
-                    recvd = True
-                if not recvd and chan.exit_status_ready():
-                    break
-            output = output.rstrip(b'\r\n')
-            return chan.recv_exit_status(), output
+            if stdin is not None:
+                if callable(stdin):
+                    stdin(chan)
+                else:
+                    chan.sendall(stdin)
+                chan.shutdown_write()
+            for data in self._read_channel(chan, server_err):
+                if callback is not None:
+                    callback(data)
+            ret = chan.recv_exit_status()
+        finally:
+            server_err.done()
+            chan.close()
+        if ret == 127:
+            self._check_location()
+        return ret
+
+    def _call_reader(self, cmd, consume):
+        """Calls a command, handing its output to `consume` as a file object.
+
+        `consume` is called once, with a file-like object reading the
+        command's stdout as it arrives; what it doesn't read is discarded.
+        Returns the exit status of the command.
+        """
+        server_err = self.server_logger()
+
+        logger.debug("Invoking %r (reader)", cmd)
+        chan = self._open_channel('/bin/sh -c %s' % shell_escape(cmd))
+        try:
+            reader = ChunkReader(self._read_channel(chan, server_err))
+            consume(reader)
+            while reader.read(RECV_SIZE):
+                pass
+            ret = chan.recv_exit_status()
         finally:
             server_err.done()
             chan.close()
+        if ret == 127:
+            self._check_location()
+        return ret
+
+    def _call(self, cmd, get_output, stdin=None):
+        """Calls a command through the SSH connection.
+
+        Remote stderr gets printed to this program's stderr. Output is captured
+        and may be returned.
+        """
+        if get_output:
+            output = bytearray()
+            ret = self._call_stream(cmd, output.extend, stdin)
+            return ret, bytes(output).rstrip(b'\r\n')
+        else:
+            return self._call_stream(cmd, None, stdin), b''
 
     def check_call(self, cmd):
         """Calls a command through SSH.
@@ -292,6 +653,35 @@ class RemoteQueue(object):
         logger.debug("Output: %r", output)
         return output
 
+    def check_output_lines(self, cmd):
+        """Calls a command through SSH and iterates on the lines of its output.
+
+        Lines are generated as they are received (without the line
+        terminator), so the whole output is never held in memory.
+        RemoteCommandFailure is raised at the end if the command failed.
+        """
+        server_err = self.server_logger()
+
+        logger.debug("Invoking %r (stdout lines)", cmd)
+        chan = self._open_channel('/bin/sh -c %s' % shell_escape(cmd))
+        try:
+            rest = b''
+            for data in self._read_channel(chan, server_err):
+                lines = (rest + data).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line.rstrip(b'\r')
+            if rest:
+                yield rest.rstrip(b'\r')
+            ret = chan.recv_exit_status()
+        finally:
+            server_err.done()
+            chan.close()
+        if ret == 127:
+            self._check_location()
+        if ret != 0:
+            raise RemoteCommandFailure(command=cmd, ret=ret)
+
     def _resolve_queue(self, queue, depth=0, links=None):
         """Finds the location of tej's queue directory on the server.
 
@@ -303,21 +693,38 @@ class RemoteQueue(object):
         """
         if depth == 0:
             logger.debug("resolve_queue(%s)", queue)
-        answer = self.check_output(
-            'if [ -d %(queue)s ]; then '
-            '    cd %(queue)s; echo "dir"; cat version; pwd; '
-            'elif [ -f %(queue)s ]; then '
-            '    cat %(queue)s; '
-            'else '
-            '    echo no; '
-            'fi' % {
-                'queue': escape_queue(queue)})
+        answer = self.check_output(self._resolve_command(queue))
+        path, link = self._resolve_answer(queue, answer, depth)
+        if link is not None:
+            if links is not None:
+                links.append(queue)
+            return self._resolve_queue(link, depth + 1)
+        return path, depth
+
+    def _resolve_command(self, queue):
+        """Builds the command used by `_resolve_queue()`.
+        """
+        return ('if [ -d %(queue)s ]; then '
+                '    cd %(queue)s; echo "dir"; cat version; pwd; '
+                'elif [ -f %(queue)s ]; then '
+                '    cat %(queue)s; '
+                'else '
+                '    echo no; '
+                'fi' % {
+                    'queue': escape_queue(queue)})
+
+    def _resolve_answer(self, queue, answer, depth):
+        """Interprets the output of the `_resolve_command()` command.
+
+        Returns a tuple ``(path, link)``; `path` is the location of the queue
+        if it was found, `link` is the location pointed to if this is a link.
+        """
         if answer == b'no':
             if depth > 0:
                 logger.debug("Broken link at depth=%d", depth)
             else:
                 logger.debug("Path doesn't exist")
-            return None, depth
+            return None, None
         elif answer.startswith(b'dir\n'):
             version, runtime, path = answer[4:].split(b'\n', 2)
             try:
@@ -332,6 +739,8 @@ class RemoteQueue(object):
                         "version %s" % '.'.join('%s' % e for e in version))
             path = PosixPath(path)
             runtime = runtime.decode('ascii', 'replace')
+            self._version = '.'.join('%d' % e for e in version)
+            self._runtime = runtime
             if self.need_runtime is not None:
                 if (self.need_runtime is not None and
                         runtime not in self.need_runtime):
@@ -340,13 +749,11 @@ class RemoteQueue(object):
                             "runtime %s" % runtime)
             logger.debug("Found directory at %s, depth=%d, runtime=%s",
                          path, depth, runtime)
-            return path, depth
+            return path, None
         elif answer.startswith(b'tejdir: '):
             new = queue.parent / answer[8:]
             logger.debug("Found link to %s, recursing", new)
-            if links is not None:
-                links.append(queue)
-            return self._resolve_queue(new, depth + 1)
+            return None, new
         else:  # pragma: no cover
             logger.debug("Server returned %r", answer)
             raise RemoteCommandFailure(msg="Queue resolution command failed "
@@ -355,14 +762,112 @@ class RemoteQueue(object):
     def _get_queue(self):
         """Gets the actual location of the queue, or None.
         """
-        if self._queue is None:
+        if self._queue is None and not self._load_location():
             self._links = []
             queue, depth = self._resolve_queue(self.queue, links=self._links)
             if queue is None and depth > 0:
                 raise QueueLinkBroken
             self._queue = queue
+            if queue is not None and self._location_cache is not None:
+                self._location_cache.set(
+                    self._cache_destination(), str(self.queue),
+                    str(queue), self._version, self._runtime,
+                    [str(link) for link in self._links])
         return self._queue
 
+    def _cache_destination(self):
+        """Identifies the server in the `LocationCache`.
+        """
+        return destination_as_string(dict(
+            (k, v) for k, v in iteritems(self.destination)
+            if k != 'password'))
+
+    def _status_key(self, job_id):
+        """Identifies a job in the `StatusCache`.
+        """
+        return self._cache_destination(), str(self.queue), job_id
+
+    def _cached_status(self, job_id):
+        """Gets the status of a job from the `StatusCache`, or None.
+        """
+        if self.status_cache is None:
+            return None
+        result = self.status_cache.get(self._status_key(job_id))
+        if result is not None:
+            logger.debug("Using cached status for job %s", job_id)
+        return result
+
+    def _cache_status(self, job_id, result):
+        """Records the status of a job in the `StatusCache`.
+        """
+        if self.status_cache is not None:
+            self.status_cache.put(self._status_key(job_id), result)
+        return result
+
+    def _forget_status(self, job_id):
+        """Removes the status of a job from the `StatusCache`.
+        """
+        if self.status_cache is not None:
+            self.status_cache.invalidate(self._status_key(job_id))
+
+    def _load_location(self):
+        """Sets the location of the queue from the cache, if possible.
+        """
+        if self._location_cache is None:
+            return False
+        entry = self._location_cache.get(self._cache_destination(),
+                                         str(self.queue))
+        if entry is None:
+            return False
+        try:
+            version = tuple(int(e) for e in entry['version'].split('.'))
+        except (AttributeError, ValueError):
+            return False
+        if version[:2] != self.PROTOCOL_VERSION:
+            return False
+        if (self.need_runtime is not None and
+                entry['runtime'] not in self.need_runtime):
+            return False
+        logger.debug("Using cached location %s for queue %s",
+                     entry['path'], self.queue)
+        self._queue = PosixPath(entry['path'])
+        self._links = [PosixPath(link) for link in entry['links']]
+        self._version = entry['version']
+        self._runtime = entry['runtime']
+        self._queue_cached = True
+        return True
+
+    def _forget_location(self, queue=None):
+        """Removes the location of a queue from the cache.
+
+        :param queue: The path of the queue, as given by the user. Defaults to
+        this queue.
+        """
+        if queue is None:
+            queue = self.queue
+            self._queue_cached = False
+        if self._location_cache is not None:
+            self._location_cache.invalidate(self._cache_destination(),
+                                            str(queue))
+
+    def _check_location(self):
+        """Checks the location of the queue after a command wasn't found.
+
+        If the location came from the cache and the queue is no longer there,
+        it is discarded, and `_StaleLocation` is raised.
+        """
+        if not self._queue_cached:
+            return
+        self._queue_cached = False
+        ret = self._call_stream(
+            '[ -d %s ]' % shell_escape(self._queue / 'commands'),
+            None)
+        if ret != 0:
+            self._forget_location()
+            self._close_agent()
+            self._queue = None
+            raise _StaleLocation
+
     def setup(self, links=None, force=False, only_links=False):
         """Installs the runtime at the target location.
 
@@ -377,6 +882,7 @@ class RemoteQueue(object):
         if only_links:
             logger.info("Only creating links")
             for link in links:
+                self._forget_location(link)
                 self.check_call('echo "tejdir:" %(queue)s > %(link)s' % {
                                 'queue': escape_queue(self.queue),
                                 'link': escape_queue(link)})
@@ -406,6 +912,7 @@ class RemoteQueue(object):
         queue = self._setup()
 
         for link in links:
+            self._forget_location(link)
             self.check_call('echo "tejdir:" %(queue)s > %(link)s' % {
                 'queue': escape_queue(queue),
                 'link': escape_queue(link)})
@@ -459,20 +966,142 @@ class RemoteQueue(object):
         logger.debug("Post-setup script done")
 
         self._queue = queue
+        self._forget_location()
         return queue
 
-    def submit(self, job_id, directory, script=None):
-        """Submits a job to the queue.
+    def _script_command(self, queue, name, *args):
+        """Builds the command line calling one of the runtime's scripts.
+        """
+        return ' '.join([shell_escape(queue / 'commands' / name)] +
+                        [shell_escape(arg) for arg in args])
 
-        If the runtime is not there, it will be installed. If it is a broken
-        chain of links, error.
+    def _get_agent(self, queue):
+        """Gets the agent for this queue, starting it if needed.
+
+        Returns None if the agent is disabled or not available.
+        """
+        if not self.use_agent:
+            return None
+        if self._agent is not None and self._agent.queue != queue:
+            self._close_agent()
+        if self._agent is None:
+            token = 'tej-agent-%s' % make_unique_name()
+            cmd = '/bin/sh %s' % self._script_command(queue, 'agent', token)
+            logger.debug("Starting agent")
+            chan = self._open_channel(cmd)
+            self._agent = _Agent(queue, chan, token)
+        return self._agent
+
+    def _close_agent(self):
+        if self._agent is not None:
+            self._agent.close()
+            self._agent = None
+
+    def _call_script(self, queue, name, args, callback):
+        """Calls one of the runtime's scripts.
+
+        This goes through the agent if it is enabled, falling back on running
+        the script directly. `callback` gets called with each line of output;
+        if it is None, the output is discarded. Returns the exit status.
+        """
+        agent = self._get_agent(queue)
+        if agent is not None:
+            server_err = self.server_logger()
+            logger.debug("Invoking %r via agent", [name] + list(args))
+            with agent.lock:
+                try:
+                    return agent.call(name, args, server_err, callback)
+                except (socket.error, EOFError, paramiko.SSHException):
+                    self._close_agent()
+                    if agent.ready:
+                        raise RemoteCommandFailure(msg="Lost connection to "
+                                                       "agent")
+                    logger.info("Agent is not available, running commands "
+                                "directly")
+                    self.use_agent = False
+                finally:
+                    server_err.done()
+
+        if callback is None:
+            return self._call_stream(self._script_command(queue, name, *args),
+                                     None)
+        rest = [b'']
+
+        def lines(data):
+            data = (rest[0] + data).split(b'\n')
+            rest[0] = data.pop()
+            for line in data:
+                callback(line)
+
+        ret = self._call_stream(self._script_command(queue, name, *args),
+                                lines)
+        if rest[0]:
+            callback(rest[0])
+        return ret
+
+    def _script_output(self, queue, name, *args):
+        """Calls one of the runtime's scripts and returns its output.
+
+        Returns a tuple ``(ret, output)``, like `_call()`.
+        """
+        output = []
+        ret = self._call_script(queue, name, args, output.append)
+        return ret, b'\n'.join(output).rstrip(b'\r\n')
+
+    def _make_job_id(self, job_id, directory):
+        """Checks the job identifier, or makes one up if it is None.
         """
         if job_id is None:
-            job_id = '%s_%s_%s' % (Path(directory).unicodename,
-                                   self.destination['username'],
-                                   make_unique_name())
+            return '%s_%s_%s' % (Path(directory).unicodename,
+                                 self.destination['username'],
+                                 make_unique_name())
         else:
             check_jobid(job_id)
+            return job_id
+
+    @_retry_stale_location
+    def submit(self, job_id, directory, script=None, transfer=None,
+               cache=False, base_job=None, priority=None, resources=None):
+        """Submits a job to the queue.
+
+        If the runtime is not there, it will be installed. If it is a broken
+        chain of links, error.
+
+        :param transfer: How to upload the directory; ``'scp'`` copies the
+        files with SCP, ``'tar'`` sends them as a single compressed tar stream.
+        If None (default), the directory is sent as a tar stream to a single
+        command that creates and starts the job, or if the runtime doesn't
+        support this, tar is used if the directory contains many files.
+        :param cache: If True, large files are stored in a cache on the
+        server, and files that are already there don't get uploaded again.
+        They get hard-linked into the job's directory, and are thus read-only.
+        :param base_job: The identifier of a previous job, submitted from a
+        similar directory. Files that are unchanged from that job's directory
+        are copied on the server instead of being uploaded again.
+        :param priority: An integer from -9999 to 9999; if the runtime limits
+        the number of jobs running at once, jobs with a higher priority start
+        first (default 0). With PBS, this is the job's priority for ``qsub``;
+        values outside of -1024 to 1023 are clamped to that range.
+        :param resources: A dictionary of the resources the job needs. Keys
+        are ``cpus`` (number of cores), ``memory`` (in bytes, or a string such
+        as ``'4gb'``), ``walltime`` (in seconds, as a `datetime.timedelta` or
+        a string such as ``'2:00:00'``), ``queue`` (the PBS queue) and
+        ``directives`` (a list of extra lines for the PBS job file, such as
+        ``'-l software=matlab'``). With the default runtime, a job uses as many
+        slots as it has CPUs, and the following keys control how it runs:
+        ``cpuset`` (the CPUs to run on, as a list or a string such as
+        ``'0-3,8'``), ``nice`` (-20 to 19), ``ionice`` (``'idle'``,
+        ``'best-effort'`` or ``'realtime'``, optionally followed by a level
+        such as ``'best-effort:7'``) and ``cpu_limit`` (how many CPUs worth of
+        time the job can use, such as 1.5). ``memory`` and ``cpu_limit`` are
+        enforced with ``systemd-run`` or cgroups if possible, else the memory
+        is limited with ``ulimit``.
+        """
+        job_id = self._make_job_id(job_id, directory)
+        if base_job is not None:
+            check_jobid(base_job)
+        options = self._submit_options(priority, resources)
+        self._forget_status(job_id)
 
         queue = self._get_queue()
         if queue is None:
@@ -481,24 +1110,19 @@ class RemoteQueue(object):
         if script is None:
             script = 'start.sh'
 
+        if (transfer in (None, 'tar') and not cache and base_job is None and
+                self._submit_archive(queue, job_id, directory, script,
+                                     options)):
+            logger.info("Submitted job %s", job_id)
+            return job_id
+
         # Create directory
-        ret, target = self._call('%s %s' % (
-                                 shell_escape(queue / 'commands/new_job'),
-                                 job_id),
-                                 True)
-        if ret == 4:
-            raise JobAlreadyExists
-        elif ret != 0:
-            raise JobNotFound("Couldn't create job")
-        target = PosixPath(target)
-        logger.debug("Server created directory %s", target)
+        ret, target = self._script_output(queue, 'new_job', job_id)
+        target = self._new_job_result(ret, target)
 
         # Upload to directory
         try:
-            scp_client = self.get_scp_client()
-            scp_client.put(str(Path(directory)),
-                           str(target),
-                           recursive=True)
+            self._upload(directory, target, transfer, cache, base_job)
         except BaseException as e:
             try:
                 self.delete(job_id)
@@ -508,46 +1132,967 @@ class RemoteQueue(object):
         logger.debug("Files uploaded")
 
         # Submit job
-        self.check_call('%s %s %s %s' % (
-                        shell_escape(queue / 'commands/submit'),
-                        job_id, shell_escape(target),
-                        shell_escape(script)))
+        ret = self._call_script(queue, 'submit',
+                                (job_id, target, script) + options,
+                                None)
+        if ret != 0:
+            raise RemoteCommandFailure(command='commands/submit', ret=ret)
         logger.info("Submitted job %s", job_id)
         return job_id
 
+    def _submit_options(self, priority, resources):
+        """Gives the optional arguments of the submission scripts.
+
+        These are the priority, then the resources as ``key=value`` pairs.
+        """
+        args = tuple(_resource_args(resources)) if resources else ()
+        if args:
+            return ('%d' % (priority or 0),) + args
+        elif priority is not None:
+            return ('%d' % priority,)
+        return ()
+
+    def _submit_archive(self, queue, job_id, directory, script, options=()):
+        """Creates, uploads and starts a job with a single command.
+
+        The directory is sent as a tar stream to the ``submit_archive`` script,
+        which creates the job, extracts the files and submits it. Returns
+        False if the runtime doesn't have that script.
+
+        The server replies with the compression to use before reading the
+        archive, falling back to gzip if it doesn't have zstd, so this doesn't
+        need a separate command to find out.
+        """
+        if self._compression is not None:
+            compression = self._compression
+        else:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        stats = []
+
+        def write(chan):
+            line = b''
+            while not line.endswith(b'\n'):
+                data = chan.recv(1)
+                if not data:
+                    # The command exited early, for example it doesn't exist
+                    return
+                line += data
+            used = line.decode('ascii').strip()
+            if compression == 'zstd':
+                self._compression = used
+            writer = CountingWriter(chan.sendall)
+            try:
+                stats.extend(write_tar(writer, Path(directory), used))
+            except socket.error:
+                # The command exited without reading the whole archive
+                return
+            stats.extend([writer.bytes, used])
+
+        ret, _ = self._call(
+            self._script_command(queue, 'submit_archive',
+                                 job_id, script, compression, *options),
+            False,
+            write)
+        if ret == 127:
+            logger.info("Runtime can't submit archives, using separate "
+                        "commands")
+            return False
+        elif ret == 4:
+            raise JobAlreadyExists
+        elif ret != 0:
+            raise RemoteCommandFailure(command='commands/submit_archive',
+                                       ret=ret)
+        elif len(stats) != 4:
+            raise RemoteCommandFailure(msg="Couldn't send the job's files")
+        files, size, sent, used = stats
+        logger.info("Uploaded %d files (%d bytes, %d bytes sent with %s) "
+                    "with submission", files, size, sent, used)
+        return True
+
+    def _new_job_result(self, ret, output):
+        """Interprets the result of the ``new_job`` script.
+        """
+        if ret == 4:
+            raise JobAlreadyExists
+        elif ret != 0:
+            raise JobNotFound("Couldn't create job")
+        target = PosixPath(output)
+        logger.debug("Server created directory %s", target)
+        return target
+
+    def _upload(self, directory, target, mode=None, cache=False,
+                base_job=None):
+        """Uploads a job's directory to the target directory on the server.
+
+        :param mode: ``'scp'`` to copy the files with SCP, ``'tar'`` to send
+        them as a single compressed tar stream. If None, tar is used if the
+        directory contains many files.
+        :param cache: Whether to go through the server's cache for large
+        files, see `_upload_cached()`.
+        :param base_job: Job to copy unchanged files from, see
+        `_upload_delta()`.
+        :returns: A tuple ``(files, size)``.
+        """
+        directory = Path(directory)
+        if base_job is not None:
+            result = self._upload_delta(directory, target, base_job, cache)
+            if result is not None:
+                return result
+        if cache:
+            result = self._upload_cached(directory, target)
+            if result is not None:
+                return result
+        if mode is None:
+            files, size = directory_stats(directory)
+            if files >= TAR_THRESHOLD:
+                mode = 'tar'
+            else:
+                mode = 'scp'
+        if mode == 'tar':
+            return self._upload_tar(directory, target)
+        elif mode == 'scp':
+            files, size = directory_stats(directory)
+            scp_client = self.get_scp_client()
+            scp_client.put(str(directory),
+                           str(target),
+                           recursive=True)
+            logger.info("Uploaded %d files (%d bytes) with SCP", files, size)
+            return files, size
+        else:
+            raise ValueError("Unknown transfer mode %r" % mode)
+
+    def _tar_compression(self):
+        """Selects the compression to use for tar streams.
+
+        zstd is used if it is available both locally and on the server.
+        """
+        if self._compression is None:
+            if (zstandard is not None and
+                    self._call('command -v zstd', False)[0] == 0):
+                self._compression = 'zstd'
+            else:
+                self._compression = 'gzip'
+        return self._compression
+
+    def _upload_tar(self, directory, target, names=None):
+        """Uploads files as a tar stream to a ``tar`` process on the server.
+
+        :param names: The files to upload, relative to `directory`. If None,
+        the whole directory gets uploaded.
+        """
+        compression = self._tar_compression()
+        return self._send_tar(extract_command(target, compression),
+                              compression, directory, names)
+
+    def _send_tar(self, cmd, compression, directory, names=None,
+                  arcnames=None):
+        """Sends files as a tar stream to the stdin of a command.
+        """
+        stats = []
+
+        def write(chan):
+            writer = CountingWriter(chan.sendall)
+            stats.extend(write_tar(writer, directory, compression,
+                                   names, arcnames))
+            stats.append(writer.bytes)
+
+        ret, _ = self._call(cmd, False, write)
+        if ret != 0:
+            raise RemoteCommandFailure(command=cmd, ret=ret)
+        files, size, sent = stats
+        logger.info("Uploaded %d files (%d bytes, %d bytes sent with %s) "
+                    "as tar stream", files, size, sent, compression)
+        return files, size
+
+    def _upload_cached(self, directory, target, names=None):
+        """Uploads a job's directory, using the server's cache.
+
+        The server keeps a content-addressed cache of the large files (the
+        ``blobs`` directory in the queue). Only the files that are not already
+        there get sent; they are then hard-linked into the job's directory.
+        Note that this makes those files read-only. The small files are sent
+        as a tar stream.
+
+        :param names: The files to upload, relative to `directory`. If None,
+        the whole directory gets uploaded.
+
+        Returns None if the runtime doesn't have a cache.
+        """
+        queue = self._get_queue()
+        if names is None:
+            dirs, files = list_directory(directory)
+        else:
+            dirs, files = [], []
+            for name in names:
+                if os.path.isdir(os.path.join(str(directory), name)):
+                    dirs.append(name)
+                else:
+                    files.append(name)
+        cached, small = [], list(dirs)
+        for name in files:
+            path = os.path.join(str(directory), name)
+            if (os.path.isfile(path) and
+                    os.path.getsize(path) >= CACHE_MIN_SIZE and
+                    '\n' not in name):
+                cached.append((hash_file(path), name))
+            else:
+                small.append(name)
+
+        files = size = 0
+        if cached:
+            # Finds out which files are missing from the cache
+            ret, output = self._call(
+                self._script_command(queue, 'missing_blobs'),
+                True,
+                ''.join('%s\n' % h for h in set(h for h, _ in cached))
+                .encode('ascii'))
+            if ret == 127:
+                logger.info("Runtime doesn't have a cache")
+                return None
+            elif ret != 0:
+                raise RemoteCommandFailure(command='commands/missing_blobs',
+                                           ret=ret)
+            missing = set(output.decode('ascii').split())
+
+            # Adds them
+            if missing:
+                names = {}
+                for h, name in cached:
+                    if h in missing:
+                        names.setdefault(h, name)
+                compression = self._tar_compression()
+                files, size = self._send_tar(
+                    self._script_command(queue, 'add_blobs', compression),
+                    compression, directory,
+                    listvalues(names), list(names))
+
+            # Links them into the job's directory
+            ret, output = self._call(
+                self._script_command(queue, 'link_blobs', target),
+                True,
+                ''.join('%s %s\n' % entry for entry in cached)
+                .encode('utf-8'))
+            if ret != 0:
+                raise RemoteCommandFailure(command='commands/link_blobs',
+                                           ret=ret)
+            # Files can't be linked if they were removed from the cache since
+            small.extend(output.decode('utf-8').splitlines())
+            uploaded = sum(1 for h, _ in cached if h in missing)
+            logger.info("Reused %d files from the cache, uploaded %d",
+                        len(cached) - uploaded, uploaded)
+
+        if small:
+            more_files, more_size = self._upload_tar(directory, target, small)
+            files += more_files
+            size += more_size
+        return files, size
+
+    def _upload_delta(self, directory, target, base_job, cache=False):
+        """Uploads a job's directory, reusing files from a previous job.
+
+        The files in the base job's directory are listed; files with the same
+        size and modification time as the local ones are assumed unchanged,
+        files with only the same size are compared using their hash. Unchanged
+        files are copied on the server, and only the others are uploaded.
+
+        Returns None if the runtime can't list a job's files.
+        """
+        queue = self._get_queue()
+        ret, output = self._call(
+            self._script_command(queue, 'manifest', base_job),
+            True)
+        if ret == 127:
+            logger.info("Runtime can't list job files, uploading everything")
+            return None
+        elif ret == 3:
+            raise JobNotFound("Base job %s doesn't exist" % base_job)
+        elif ret != 0:
+            raise RemoteCommandFailure(command='commands/manifest', ret=ret)
+        remote = {}
+        for line in output.decode('utf-8').splitlines():
+            size, mtime, path = line.split(' ', 2)
+            remote[path] = (int(size),
+                            None if mtime == '-' else int(float(mtime)))
+
+        dirs, files = list_directory(directory)
+        unchanged, to_hash, changed = [], [], []
+        for name in files:
+            st = os.stat(os.path.join(str(directory), name))
+            base = remote.get(name)
+            if (base is None or base[0] != st.st_size or '\n' in name or
+                    not stat.S_ISREG(st.st_mode)):
+                changed.append(name)
+            elif base[1] == int(st.st_mtime):
+                unchanged.append(name)
+            else:
+                to_hash.append(name)
+
+        # Compares the hashes of files that might have changed
+        if to_hash:
+            ret, output = self._call(
+                self._script_command(queue, 'hash_files', base_job),
+                True,
+                ''.join('%s\n' % name for name in to_hash).encode('utf-8'))
+            hashes = {}
+            if ret == 0:
+                for line in output.decode('utf-8').splitlines():
+                    h, path = line.split(' ', 1)
+                    hashes[path] = h
+            else:
+                logger.warning("Couldn't hash files on the server")
+            for name in to_hash:
+                if (name in hashes and hashes[name] ==
+                        hash_file(os.path.join(str(directory), name))):
+                    unchanged.append(name)
+                else:
+                    changed.append(name)
+
+        # Copies unchanged files from the base job
+        if unchanged:
+            ret, output = self._call(
+                self._script_command(queue, 'copy_files', base_job, target),
+                True,
+                ''.join('%s\n' % name for name in unchanged).encode('utf-8'))
+            if ret != 0:
+                raise RemoteCommandFailure(command='commands/copy_files',
+                                           ret=ret)
+            failed = output.decode('utf-8').splitlines()
+            changed.extend(failed)
+        else:
+            failed = []
+        logger.info("Copied %d unchanged files from job %s, %d are new or "
+                    "changed",
+                    len(unchanged) - len(failed), base_job, len(changed))
+
+        names = dirs + changed
+        if not names:
+            return 0, 0
+        if cache:
+            result = self._upload_cached(directory, target, names)
+            if result is not None:
+                return result
+        return self._upload_tar(directory, target, names)
+
+    @_retry_stale_location
+    def submit_many(self, jobs, parallel=4, transfer=None, cache=False,
+                    priority=None, resources=None):
+        """Submits several jobs to the queue.
+
+        All the job directories are created with a single command, they are
+        uploaded concurrently, and all the jobs are then started with a single
+        command.
+
+        :param jobs: An iterable of ``(job_id, directory, script)`` tuples, the
+        same as the arguments to `submit()`. `job_id` and `script` can be None.
+        :param parallel: The maximum number of concurrent uploads.
+        :param transfer: How to upload the directories, see `submit()`.
+        :param cache: Whether to use the server's cache, see `submit()`.
+        :param priority: The priority of the jobs, see `submit()`.
+        :param resources: The resources needed by each job, see `submit()`.
+        :returns: A list of ``(job_id, error)`` pairs, in the same order as
+        `jobs`; `error` is None if the job was submitted, or the exception
+        that caused the submission to fail.
+        """
+        jobs = self._submit_many_jobs(jobs)
+        options = self._submit_options(priority, resources)
+        if not jobs:
+            return []
+        for job_id, _, _ in jobs:
+            self._forget_status(job_id)
+
+        queue = self._get_queue()
+        if queue is None:
+            queue = self._setup()
+
+        errors = {}  # job_id -> exception
+
+        # Create directories
+        ret, output = self._call(
+            self._script_command(queue, 'new_jobs'),
+            True,
+            ''.join('%s\n' % job_id for job_id, _, _ in jobs).encode('utf-8'))
+        if ret == 127:
+            logger.info("Runtime doesn't support bulk submission, submitting "
+                        "jobs one by one")
+            return self._submit_many_fallback(jobs, transfer, cache,
+                                              priority, resources)
+        targets = self._new_jobs_result(ret, output, errors)
+
+        # Upload to directories
+        to_upload = [(job_id, directory) for job_id, directory, _ in jobs
+                     if job_id in targets]
+
+        def upload(job):
+            job_id, directory = job
+            try:
+                self._upload(directory, targets[job_id], transfer, cache)
+            except BaseException:
+                try:
+                    self.delete(job_id)
+                except BaseException:
+                    logger.warning("Couldn't remove job %s after failed "
+                                   "upload", job_id)
+                raise
+
+        uploads = parallel_map(upload, to_upload, parallel)
+        for (job_id, _), (_, error) in izip(to_upload, uploads):
+            if error is not None:
+                errors[job_id] = error
+        logger.debug("Files uploaded")
+
+        # Submit jobs
+        to_submit = [(job_id, script) for job_id, _, script in jobs
+                     if job_id in targets and job_id not in errors]
+        if to_submit:
+            ret, output = self._call(
+                self._script_command(queue, 'submit_jobs', *options),
+                True,
+                ''.join('%s %s\n' % job for job in to_submit).encode('utf-8'))
+            self._submit_jobs_result(ret, output, errors)
+
+        return self._submit_many_results(jobs, targets, errors)
+
+    def _submit_many_jobs(self, jobs):
+        """Checks the jobs passed to `submit_many()`, filling in defaults.
+        """
+        jobs = [(self._make_job_id(job_id, directory), directory,
+                 'start.sh' if script is None else script)
+                for job_id, directory, script in jobs]
+        for job_id, directory, script in jobs:
+            if '\n' in script:
+                raise ValueError("Invalid script for job %s" % job_id)
+        if len(set(job_id for job_id, _, _ in jobs)) != len(jobs):
+            raise ValueError("Duplicate job identifiers")
+        return jobs
+
+    def _new_jobs_result(self, ret, output, errors):
+        """Interprets the result of the ``new_jobs`` script.
+
+        Returns a dictionary of the created jobs' directories; the jobs that
+        couldn't be created are added to `errors`.
+        """
+        if ret != 0:
+            raise RemoteCommandFailure(command='commands/new_jobs', ret=ret)
+        targets = {}
+        for line in output.splitlines():
+            line = line.decode('utf-8').split(' ', 2)
+            ret, job_id = int(line[0]), line[1]
+            try:
+                targets[job_id] = self._new_job_result(
+                    ret, line[2] if len(line) == 3 else None)
+            except Error as e:
+                errors[job_id] = e
+        return targets
+
+    def _submit_jobs_result(self, ret, output, errors):
+        """Interprets the result of the ``submit_jobs`` script.
+
+        The jobs that couldn't be started are added to `errors`.
+        """
+        if ret != 0:
+            raise RemoteCommandFailure(command='commands/submit_jobs',
+                                       ret=ret)
+        for line in output.splitlines():
+            ret, job_id = line.decode('utf-8').split(' ', 1)
+            if ret != '0':
+                errors[job_id] = RemoteCommandFailure(
+                    command='commands/submit', ret=int(ret))
+
+    def _submit_many_results(self, jobs, targets, errors):
+        """Builds the list returned by `submit_many()`.
+        """
+        results = []
+        for job_id, _, _ in jobs:
+            error = errors.get(job_id)
+            if error is None and job_id not in targets:
+                error = RemoteCommandFailure(msg="Job was not created")
+            if error is None:
+                logger.info("Submitted job %s", job_id)
+            else:
+                logger.warning("Couldn't submit job %s: %s", job_id, error)
+            results.append((job_id, error))
+        return results
+
+    def _submit_many_fallback(self, jobs, transfer, cache, priority,
+                              resources):
+        """Submits jobs one by one, for runtimes without bulk submission.
+        """
+        results = []
+        for job_id, directory, script in jobs:
+            try:
+                self.submit(job_id, directory, script, transfer, cache,
+                            priority=priority, resources=resources)
+            except (Error, RemoteCommandFailure) as e:
+                results.append((job_id, e))
+            else:
+                results.append((job_id, None))
+        return results
+
+    @_retry_stale_location
     def status(self, job_id):
         """Gets the status of a previously-submitted job.
+
+        The status is `JOB_RUNNING`, `JOB_DONE`, or `JOB_QUEUED` if the
+        runtime has limited the number of jobs running at once and this one
+        is waiting for its turn.
+
+        If the queue has a `StatusCache`, the result is taken from it if
+        possible.
         """
         check_jobid(job_id)
 
+        result = self._cached_status(job_id)
+        if result is not None:
+            return result
+
         queue = self._get_queue()
         if queue is None:
             raise QueueDoesntExist
 
-        ret, output = self._call('%s %s' % (
-                                 shell_escape(queue / 'commands/status'),
-                                 job_id),
-                                 True)
+        ret, output = self._script_output(queue, 'status', job_id)
+        return self._cache_status(job_id, self._status_result(ret, output))
+
+    def _status_result(self, ret, output):
+        """Interprets the result of the ``status`` script.
+        """
         if ret == 0:
             directory, result = output.splitlines()
             result = result.decode('utf-8')
             return RemoteQueue.JOB_DONE, PosixPath(directory), result
         elif ret == 2:
-            directory = output.splitlines()[0]
-            return RemoteQueue.JOB_RUNNING, PosixPath(directory), None
+            lines = output.splitlines()
+            if lines[1:2] == [b'queued']:
+                return RemoteQueue.JOB_QUEUED, PosixPath(lines[0]), None
+            return RemoteQueue.JOB_RUNNING, PosixPath(lines[0]), None
         elif ret == 3:
             raise JobNotFound
         else:
             raise RemoteCommandFailure(command="commands/status",
                                        ret=ret)
 
+    @_retry_stale_location
+    def status_many(self, job_ids):
+        """Gets the status of several jobs, with a single command.
+
+        :returns: A list of ``(job_id, info)`` pairs, in the same order as
+        `job_ids`. `info` is None if there is no such job, else a dictionary
+        with the same keys as returned by `list()`.
+        """
+        job_ids = list(job_ids)
+        for job_id in job_ids:
+            check_jobid(job_id)
+        if not job_ids:
+            return []
+
+        queue = self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = self._call(
+            self._script_command(queue, 'status_many'),
+            True,
+            ''.join('%s\n' % job_id for job_id in job_ids).encode('utf-8'))
+        if ret == 127:
+            logger.info("Runtime doesn't support batch status, getting "
+                        "status of jobs one by one")
+            return [(job_id, self._status_info(job_id))
+                    for job_id in job_ids]
+        return self._status_many_result(ret, output, job_ids)
+
+    def _status_many_result(self, ret, output, job_ids):
+        """Interprets the result of the ``status_many`` script.
+        """
+        if ret != 0:
+            raise RemoteCommandFailure(command='commands/status_many',
+                                       ret=ret)
+        records = dict(self._parse_list(output.splitlines()))
+        return [(job_id, records.get(job_id)) for job_id in job_ids]
+
+    def _status_info(self, job_id):
+        """Gets the status of a job as a dictionary, using `status()`.
+        """
+        try:
+            result = self.status(job_id)
+        except JobNotFound:
+            return None
+        except RemoteCommandFailure as e:
+            if e.ret != 1:
+                raise
+            return {'status': RemoteQueue.JOB_INCOMPLETE}
+        return self._status_info_result(result)
+
+    def _status_info_result(self, result):
+        """Turns the result of `status()` into a dictionary like `list()`'s.
+        """
+        status, directory, arg = result
+        info = {'status': status, 'directory': directory}
+        if arg is not None:
+            info['exit_code'] = int(arg)
+        return info
+
+    @_retry_stale_location
+    def wait(self, job_ids, timeout=None, return_when='all'):
+        """Waits for jobs to finish.
+
+        The waiting happens on the server, in a single command that returns
+        as soon as the jobs are finished, so there is no need to poll.
+
+        :param job_ids: The identifier of a job, or a list of identifiers.
+        :param timeout: The maximum number of seconds to wait. If None
+        (default), wait until the jobs are finished.
+        :param return_when: ``'all'`` to wait until all the jobs are finished,
+        ``'any'`` to return as soon as one of them is.
+        :returns: A tuple ``(done, jobs)``. `done` is False if the timeout
+        expired. `jobs` is a list of ``(job_id, info)`` pairs, like
+        `status_many()` returns.
+        """
+        job_ids = self._wait_job_ids(job_ids, return_when)
+
+        queue = self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        ret, output = self._call(
+            self._script_command(queue, 'wait', return_when,
+                                 '' if timeout is None
+                                 else '%d' % max(0, timeout)),
+            True,
+            ''.join('%s\n' % job_id for job_id in job_ids).encode('utf-8'))
+        if ret == 127:
+            logger.info("Runtime can't wait for jobs, polling")
+            return self._wait_polling(job_ids, timeout, return_when)
+        return self._wait_result(ret, output, job_ids)
+
+    def _wait_job_ids(self, job_ids, return_when):
+        """Checks the arguments of `wait()`.
+        """
+        if isinstance(job_ids, string_types):
+            job_ids = [job_ids]
+        else:
+            job_ids = list(job_ids)
+        for job_id in job_ids:
+            check_jobid(job_id)
+        if not job_ids:
+            raise ValueError("No job to wait for")
+        if return_when not in ('all', 'any'):
+            raise ValueError("return_when should be 'all' or 'any'")
+        return job_ids
+
+    def _wait_result(self, ret, output, job_ids):
+        """Interprets the result of the ``wait`` script.
+        """
+        if ret == 3:
+            raise JobNotFound
+        elif ret not in (0, 2):
+            raise RemoteCommandFailure(command='commands/wait', ret=ret)
+        records = dict(self._parse_list(output.splitlines()))
+        return ret == 0, [(job_id, records.get(job_id)) for job_id in job_ids]
+
+    def _wait_polling(self, job_ids, timeout, return_when, interval=5):
+        """Waits for jobs by polling their status, for older runtimes.
+        """
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            jobs = self.status_many(job_ids)
+            if any(info is None for _, info in jobs):
+                raise JobNotFound
+            finished = sum(1 for _, info in jobs
+                           if info['status'] == RemoteQueue.JOB_DONE)
+            if (finished == len(jobs) or
+                    (return_when == 'any' and finished > 0)):
+                return True, jobs
+            if timeout is not None:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False, jobs
+                time.sleep(min(interval, remaining))
+            else:
+                time.sleep(interval)
+
+    @_retry_stale_location
+    def events(self, since=0):
+        """Reads the new events from the queue's event log.
+
+        Each change in the state of a job is appended to a log on the server.
+        A client can stay up to date by calling this method repeatedly,
+        passing the offset returned by the previous call; only the new part of
+        the log gets transferred.
+
+        :param since: The offset in the log from which to read, in bytes.
+        :returns: A tuple ``(events, offset)``, where `events` is a list of
+        `JobEvent` and `offset` should be passed to the next call. If the log
+        was reset on the server, it is read from the start.
+        """
+        queue = self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        # Not using _call(), which would strip the final line terminator
+        output = bytearray()
+        ret = self._call_stream(
+            self._script_command(queue, 'events', '%d' % since),
+            output.extend)
+        return self._events_result(ret, bytes(output))
+
+    def _events_result(self, ret, output):
+        """Interprets the result of the ``events`` script.
+        """
+        if ret != 0:
+            raise RemoteCommandFailure(command='commands/events', ret=ret)
+        return self._parse_events(output)
+
+    @_retry_stale_location
+    def tail(self, job_id, stream='stdout', offset=0, max_size=None):
+        """Reads the output of a job from an offset.
+
+        Only the part of the file after `offset` is transferred, so the output
+        of a running job can be followed by calling this repeatedly, passing
+        the offset returned by the previous call.
+
+        :param stream: ``'stdout'`` or ``'stderr'``.
+        :param offset: The offset in the file from which to read, in bytes.
+        :param max_size: The maximum number of bytes to read. If None
+        (default), reads until the end of the file.
+        :returns: A tuple ``(data, offset, status)``, where `data` is bytes,
+        `offset` should be passed to the next call, and `status` is the status
+        of the job when the file was read; once it is `JOB_DONE`, the output
+        is complete. If the file got shorter, it is read from the start.
+        """
+        args = self._tail_args(job_id, stream, offset, max_size)
+
+        queue = self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        # Not using _call(), which would strip the final line terminator
+        output = bytearray()
+        ret = self._call_stream(
+            self._script_command(queue, 'tail', *args),
+            output.extend)
+        if ret == 127:
+            logger.info("Runtime doesn't support reading output, using tail")
+            return self._tail_fallback(job_id, stream, offset, max_size)
+        return self._tail_result(ret, bytes(output))
+
+    def _tail_args(self, job_id, stream, offset, max_size):
+        """Checks the arguments of `tail()` and builds the script's arguments.
+        """
+        check_jobid(job_id)
+        if stream not in ('stdout', 'stderr'):
+            raise ValueError("Unknown stream %r" % stream)
+        args = [job_id, stream, '%d' % offset]
+        if max_size is not None:
+            args.append('%d' % max_size)
+        return args
+
+    def _tail_result(self, ret, output):
+        """Interprets the result of the ``tail`` script.
+        """
+        if ret == 3:
+            raise JobNotFound
+        elif ret != 0:
+            raise RemoteCommandFailure(command='commands/tail', ret=ret)
+        status, offset, data = output.split(b'\n', 2)
+        offset = int(offset)
+        return data, offset + len(data), status.decode('utf-8')
+
+    def _tail_fallback(self, job_id, stream, offset, max_size):
+        """Reads the output of a job using `status()` and ``tail``.
+        """
+        status, directory, arg = self.status(job_id)
+        cmd = 'tail -c +%d %s 2>/dev/null' % (
+            offset + 1, shell_escape(directory / ('_%s' % stream)))
+        if max_size is not None:
+            cmd += ' | head -c %d' % max_size
+        output = bytearray()
+        self._call_stream(cmd, output.extend)
+        data = bytes(output)
+        return data, offset + len(data), status
+
+    def _parse_events(self, output):
+        """Parses the output of the ``events`` script.
+        """
+        offset, _, data = output.partition(b'\n')
+        offset = int(offset)
+        # The last line might not be complete yet, it will be read next time
+        end = data.rfind(b'\n') + 1
+        events = []
+        for line in data[:end].splitlines():
+            fields = line.decode('utf-8').split(' ', 3)
+            if len(fields) < 3:
+                continue
+            try:
+                time_ = int(fields[0])
+            except ValueError:
+                continue
+            value = fields[3] if len(fields) == 4 else None
+            if value is not None and fields[1] == 'finished':
+                try:
+                    value = int(value)
+                except ValueError:
+                    pass
+            events.append(JobEvent(time_, fields[1], fields[2], value))
+        return events, offset + end
+
+    @_retry_stale_location
     def download(self, job_id, files, **kwargs):
         """Downloads files from server.
+
+        The files are listed on the server with a single command, that also
+        checks that the job exists, and are then fetched concurrently over
+        separate SCP channels.
+
+        :param files: The name of a file, or a list of names, relative to the
+        job's directory.
+        :param destination: Where to put the file, if a single one is given.
+        :param directory: The local directory to put the files in.
+        :param recursive: Whether to download directories (default True).
+        :param parallel: The maximum number of concurrent transfers (default
+        4).
+        :param progress: A function called as data is received, with the
+        number of bytes received so far, the total number of bytes (None if
+        unknown), and the throughput in bytes per second. It is called from
+        the threads doing the transfers.
+        :param transfer: How to download the files; ``'scp'`` copies each
+        file with SCP, ``'tar'`` has the server send everything as a single
+        tar stream, which is extracted as it arrives. If None (default),
+        directories are downloaded as tar streams and other files with SCP.
+        Tar streams can only be used with `directory`.
+        :param include: A list of patterns; only the files matching one of
+        them are downloaded. The patterns are matched against the paths
+        relative to the job's directory, and ``*`` also matches ``/``.
+        :param exclude: A list of patterns; files matching one of them are not
+        downloaded.
+        :param compression: The compression to use for tar streams,
+        ``'zstd'``, ``'gzip'`` or ``'none'``. If None (default), zstd is used
+        if available on both ends, else gzip.
         """
         check_jobid(job_id)
 
-        if not files:
+        parallel = kwargs.pop('parallel', 4)
+        progress = kwargs.pop('progress', None)
+        transfer = kwargs.pop('transfer', None)
+        include = kwargs.pop('include', None)
+        exclude = kwargs.pop('exclude', None)
+        compression = kwargs.pop('compression', None)
+        if transfer not in (None, 'scp', 'tar'):
+            raise ValueError("Unknown transfer mode %r" % transfer)
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %r" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard module")
+        options = self._download_options(files, kwargs)
+        if options is None:
             return
+        files, destination, directory, recursive = options
+        if transfer == 'tar' and not directory:
+            raise ValueError("Downloading as a tar stream needs 'directory'")
+
+        queue = self._get_queue()
+        if queue is None:
+            raise QueueDoesntExist
+
+        if transfer == 'tar':
+            if not destination.is_dir():
+                destination.mkdir(parents=True)
+            if self._download_tar(queue, job_id, files, destination,
+                                  include, exclude, compression,
+                                  _Progress(None, progress)) is not None:
+                return
+            logger.info("Runtime doesn't support downloading as tar stream, "
+                        "using SCP")
+
+        ret, output = self._call(
+            self._script_command(queue, 'download_list', job_id,
+                                 '1' if recursive else '0', *files),
+            True)
+        if ret == 127:
+            if include or exclude:
+                raise RemoteCommandFailure(
+                    msg="Runtime doesn't support filtering downloads",
+                    command='commands/download_list', ret=ret)
+            logger.info("Runtime doesn't support listing files, downloading "
+                        "them one by one")
+            # Might raise JobNotFound
+            status, target, result = self.status(job_id)
+            self._download_files(self.get_scp_client(), target, *options)
+            return
+        elif ret == 3:
+            raise JobNotFound
+        elif ret != 0:
+            raise RemoteCommandFailure(command='commands/download_list',
+                                       ret=ret)
+        lines = output.decode('utf-8').split('\n')
+        logger.debug("Job %s is %s", job_id, lines[0])
+        target = PosixPath(lines[1])
+        entries = lines[2:]
+        transfers, directories = self._download_plan(
+            entries, destination, directory, recursive, include, exclude)
+        progress = _Progress(sum(size for _, _, size in transfers), progress)
+        for local in directories:
+            if not local.is_dir():
+                local.mkdir(parents=True)
+
+        # Directories are sent as tar streams
+        if transfer is None and directory:
+            tar_paths = [entry.split(' ', 2)[2] for entry in entries
+                         if entry.startswith('d ')]
+            if tar_paths and self._download_tar(
+                    queue, job_id, tar_paths, destination,
+                    include, exclude, compression, progress) is not None:
+                prefixes = tuple(path.rstrip('/') + '/' for path in tar_paths)
+                transfers = [entry for entry in transfers
+                             if not entry[0].startswith(prefixes)]
+
+        self._download_parallel(target, transfers, parallel, progress)
+
+    def _download_tar(self, queue, job_id, paths, destination,
+                      include, exclude, compression, progress):
+        """Downloads files from the job's directory as a tar stream.
+
+        The archive is extracted into `destination` as it is received.
+        Returns None if the runtime doesn't support it, else a tuple
+        ``(files, size)``.
+        """
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'gzip'
+        args = (['include=%s' % pattern for pattern in include or ()] +
+                ['exclude=%s' % pattern for pattern in exclude or ()] +
+                ['--'] + list(paths))
+        stats = []
+
+        def extract(reader):
+            used = reader.readline().decode('ascii').strip()
+            if used:
+                stats.extend(read_tar(reader, destination, used,
+                                      progress.add))
+                stats.extend([reader.bytes, used])
+
+        ret = self._call_reader(
+            self._script_command(queue, 'download_archive', job_id,
+                                 compression, *args),
+            extract)
+        if ret == 127:
+            return None
+        elif ret == 3:
+            raise JobNotFound
+        elif ret != 0:
+            raise RemoteCommandFailure(command='commands/download_archive',
+                                       ret=ret)
+        files, size, received, used = stats
+        logger.info("Downloaded %d files (%d bytes, %d bytes received with "
+                    "%s) as tar stream", files, size, received, used)
+        return files, size
+
+    def _download_options(self, files, kwargs):
+        """Checks the arguments to `download()`.
+
+        Returns a tuple ``(files, destination, directory, recursive)``, or
+        None if there is nothing to download.
+        """
+        if not files:
+            return None
         if isinstance(files, string_types):
             files = [files]
         directory = False
@@ -565,11 +2110,87 @@ class RemoteQueue(object):
             directory = True
         if kwargs:
             raise TypeError("Got unexpected keyword arguments")
+        return files, destination, directory, recursive
 
-        # Might raise JobNotFound
-        status, target, result = self.status(job_id)
+    def _download_plan(self, entries, destination, directory, recursive,
+                       include=None, exclude=None):
+        """Works out where to put the files listed by ``download_list``.
 
-        scp_client = self.get_scp_client()
+        Returns a list of ``(remote, local, size)`` tuples for the files,
+        `remote` being relative to the job's directory, and a list of the
+        local directories to create. If filters are given, only the files
+        matching them are kept, and no directories are created for them.
+        """
+        filtered = bool(include or exclude)
+        transfers = []
+        directories = []
+        for entry in entries:
+            kind, size, path = entry.split(' ', 2)
+            size = int(size)
+            if kind == 'n':
+                raise scp.SCPException("%s: No such file or directory" % path)
+            elif kind in ('f', 'd'):
+                base = path
+                if directory:
+                    root = destination / path
+                elif destination.is_dir():
+                    root = destination / path.rstrip('/').rsplit('/', 1)[-1]
+                else:
+                    root = destination
+                if kind == 'f':
+                    if match_filters(path, include, exclude):
+                        transfers.append((path, root, size))
+                elif not recursive:
+                    raise scp.SCPException("%s: not a regular file" % path)
+                elif not filtered:
+                    directories.append(root)
+            elif kind == 'D':
+                if not filtered:
+                    directories.append(root / path)
+            elif kind == 'F':
+                remote = '%s/%s' % (base.rstrip('/'), path)
+                if match_filters(remote, include, exclude):
+                    transfers.append((remote, root / path, size))
+        return transfers, directories
+
+    def _download_parallel(self, target, transfers, parallel, progress):
+        """Downloads files from the job's directory over several channels.
+        """
+        if not transfers:
+            return
+        for remote, local, size in transfers:
+            if not local.parent.is_dir():
+                local.parent.mkdir(parents=True)
+
+        start = time.time()
+
+        def fetch(transfer):
+            remote, local, size = transfer
+            logger.info("Downloading %s", target / remote)
+            sent = [0]
+
+            def file_progress(filename, size, file_sent):
+                progress.add(file_sent - sent[0])
+                sent[0] = file_sent
+
+            scp_client = scp.SCPClient(self.get_client().get_transport(),
+                                       progress=file_progress)
+            try:
+                scp_client.get(str(target / remote), str(local))
+            finally:
+                scp_client.close()
+
+        results = parallel_map(fetch, transfers, parallel)
+        for _, error in results:
+            if error is not None:
+                raise error
+        logger.info("Downloaded %d files, %d bytes in %.1fs", len(transfers),
+                    sum(size for _, _, size in transfers), time.time() - start)
+
+    def _download_files(self, scp_client, target,
+                        files, destination, directory, recursive):
+        """Downloads files from the job's directory using SCP.
+        """
         for filename in files:
             logger.info("Downloading %s", target / filename)
             if directory:
@@ -581,6 +2202,7 @@ class RemoteQueue(object):
                                str(destination),
                                recursive=recursive)
 
+    @_retry_stale_location
     def kill(self, job_id):
         """Kills a job on the server.
         """
@@ -590,16 +2212,20 @@ class RemoteQueue(object):
         if queue is None:
             raise QueueDoesntExist
 
-        ret, output = self._call('%s %s' % (
-                                 shell_escape(queue / 'commands/kill'),
-                                 job_id),
-                                 False)
+        self._forget_status(job_id)
+        ret = self._call_script(queue, 'kill', (job_id,), None)
+        self._kill_result(ret)
+
+    def _kill_result(self, ret):
+        """Interprets the result of the ``kill`` script.
+        """
         if ret == 3:
             raise JobNotFound
         elif ret != 0:
             raise RemoteCommandFailure(command='commands/kill',
                                        ret=ret)
 
+    @_retry_stale_location
     def delete(self, job_id):
         """Deletes a job from the server.
         """
@@ -609,10 +2235,13 @@ class RemoteQueue(object):
         if queue is None:
             raise QueueDoesntExist
 
-        ret, output = self._call('%s %s' % (
-                                 shell_escape(queue / 'commands/delete'),
-                                 job_id),
-                                 False)
+        self._forget_status(job_id)
+        ret = self._call_script(queue, 'delete', (job_id,), None)
+        self._delete_result(ret)
+
+    def _delete_result(self, ret):
+        """Interprets the result of the ``delete`` script.
+        """
         if ret == 3:
             raise JobNotFound
         elif ret == 2:
@@ -621,37 +2250,169 @@ class RemoteQueue(object):
             raise RemoteCommandFailure(command='commands/delete',
                                        ret=ret)
 
-    def list(self):
+    def list(self, status=None, max_age=None, prefix=None, after=None,
+             limit=None):
         """Lists the jobs on the server.
+
+        Lazily generates ``(job_id, info)`` pairs, in order of job ID; the
+        server is only contacted once iteration starts. `info` is a
+        dictionary with the ``status`` and ``directory`` of the job and,
+        depending on the status and the runtime, its ``exit_code``, ``pid`` or
+        ``pbs_id``, and the ``created``, ``submitted``, ``started`` and
+        ``finished`` times (as UNIX timestamps).
+
+        The filters are applied on the server:
+
+        :param status: Only list jobs with this status, or one of these if a
+        list is given.
+        :param max_age: Only list jobs created or submitted in the last
+        `max_age` seconds.
+        :param prefix: Only list jobs whose identifier starts with this.
+        :param after: Only list the jobs that come after this identifier. To
+        go through the jobs in pages, pass the identifier of the last job of
+        the previous page.
+        :param limit: The maximum number of jobs to list.
+        """
+        filters = self._list_filters(status, max_age, prefix, after, limit)
+        return self._list_jobs(filters, status, prefix, after, limit)
+
+    def _list_jobs(self, filters, status, prefix, after, limit):
+        """Generates the jobs for `list()`.
         """
         queue = self._get_queue()
         if queue is None:
             raise QueueDoesntExist
 
-        output = self.check_output('%s' %
-                                   shell_escape(queue / 'commands/list'))
+        if self._get_agent(queue) is not None:
+            # The agent can't be used by anything else until we are done, so
+            # this reads the whole output first
+            try:
+                lines = self._list_agent(queue, filters)
+            except _StaleLocation:
+                queue = self._get_queue()
+                if queue is None:
+                    raise QueueDoesntExist
+                lines = self._list_agent(queue, filters)
+        else:
+            lines = self._list_lines(queue, filters)
+        for job in self._filter_list(self._parse_list(lines),
+                                     status, prefix, after, limit):
+            yield job
+
+    def _list_agent(self, queue, filters):
+        """Reads the whole output of the ``list`` script through the agent.
+        """
+        lines = []
+        ret = self._call_script(queue, 'list', filters, lines.append)
+        if ret != 0:
+            raise RemoteCommandFailure(command='commands/list', ret=ret)
+        return lines
+
+    def _list_filters(self, status, max_age, prefix, after, limit):
+        """Builds the arguments of the ``list`` script.
+        """
+        filters = []
+        if status is not None:
+            if isinstance(status, string_types):
+                status = [status]
+            if not status or not all(s and s.isalpha() for s in status):
+                raise ValueError("Invalid status filter")
+            filters.append('status=%s' % ','.join(status))
+        if max_age is not None:
+            filters.append('max_age=%d' % int(max_age))
+        if prefix is not None:
+            check_jobid(prefix)
+            filters.append('prefix=%s' % prefix)
+        if after is not None:
+            check_jobid(after)
+            filters.append('after=%s' % after)
+        if limit is not None:
+            filters.append('limit=%d' % int(limit))
+        return filters
+
+    def _filter_list(self, jobs, status, prefix, after, limit):
+        """Applies the filters again on the client.
+
+        Old runtimes ignore the filters, this makes sure they are respected
+        (except for `max_age`).
+        """
+        if isinstance(status, string_types):
+            status = [status]
+        count = 0
+        for job_id, info in jobs:
+            if limit is not None and count >= limit:
+                break
+            if ((status is not None and info['status'] not in status) or
+                    (prefix is not None and not job_id.startswith(prefix)) or
+                    (after is not None and job_id <= after)):
+                continue
+            count += 1
+            yield job_id, info
+
+    def _list_lines(self, queue, filters):
+        """Streams the output of the ``list`` script.
 
+        If the queue turns out to not be at its cached location, this looks
+        it up again and restarts.
+        """
+        try:
+            for line in self.check_output_lines(
+                    self._script_command(queue, 'list', *filters)):
+                yield line
+        except _StaleLocation:
+            # The script wasn't found, so no line was generated
+            queue = self._get_queue()
+            if queue is None:
+                raise QueueDoesntExist
+            for line in self.check_output_lines(
+                    self._script_command(queue, 'list', *filters)):
+                yield line
+
+    _INTEGER_FIELDS = frozenset(['exit_code', 'pid', 'priority', 'created',
+                                 'submitted', 'started', 'finished'])
+
+    def _parse_list(self, lines):
+        """Parses the output of the ``list`` script.
+
+        Generates ``(job_id, info)`` pairs, `info` being a dictionary, or None
+        for jobs that don't exist.
+        """
         job_id, info = None, None
-        for line in output.splitlines():
+        for line in lines:
             line = line.decode('utf-8')
             if line.startswith('    '):
                 key, value = line[4:].split(': ', 1)
+                if key in self._INTEGER_FIELDS:
+                    try:
+                        value = int(value)
+                    except ValueError:
+                        pass
+                elif key == 'directory':
+                    value = PosixPath(value)
                 info[key] = value
             else:
                 if job_id is not None:
-                    yield job_id, info
+                    yield job_id, self._record_info(info)
                 job_id = line
                 info = {}
         if job_id is not None:
-            yield job_id, info
+            yield job_id, self._record_info(info)
+
+    @staticmethod
+    def _record_info(info):
+        if info.get('status') == 'not found':
+            return None
+        return info
 
+    @_retry_stale_location
     def cleanup(self, kill=False):
         queue = self._get_queue()
 
         if queue is not None:
             # Kill jobs
             for job_id, info in self.list():
-                if info['status'] == 'running':
+                if info['status'] in (RemoteQueue.JOB_RUNNING,
+                                      RemoteQueue.JOB_QUEUED):
                     if not kill:
                         raise JobStillRunning("Can't cleanup, some jobs are "
                                               "still running")
@@ -662,9 +2423,11 @@ class RemoteQueue(object):
             # Remove queue
             logger.info("Removing queue at %s", queue)
             self.check_call('rm -rf -- %s' % shell_escape(queue))
+        self._forget_location()
 
         # Remove links
         for link in self._links:
+            self._forget_location(link)
             self.check_call('rm -rf -- %s' % shell_escape(link))
 
         return True
@@ -0,0 +1,248 @@
+"""Transfer of job directories as tar streams.
+
+Copying a directory with SCP takes a protocol exchange per file, which is slow
+for directories containing many small files. Instead, a tar archive can be
+streamed over a single channel to or from a ``tar`` process on the server.
+"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import fnmatch
+import hashlib
+import logging
+import os
+import tarfile
+
+from tej.utils import shell_escape
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger('tej')
+
+
+# Number of files from which a directory gets sent as a tar stream when the
+# transfer mode is not specified
+TAR_THRESHOLD = 64
+
+# Minimum size of the files that go through the server's cache
+CACHE_MIN_SIZE = 1 << 20
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+
+
+def directory_stats(directory):
+    """Counts the files in a local directory and their total size.
+    """
+    files = size = 0
+    for dirpath, dirnames, filenames in os.walk(str(directory)):
+        for filename in filenames:
+            files += 1
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return files, size
+
+
+class CountingWriter(object):
+    """File-like object handing data to a function, and counting bytes.
+    """
+    def __init__(self, write):
+        self._write = write
+        self.bytes = 0
+
+    def write(self, data):
+        self._write(data)
+        self.bytes += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ChunkReader(object):
+    """File-like object reading from an iterator of chunks of bytes.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+        self.bytes = 0
+
+    def _fill(self, size):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+            self.bytes += len(chunk)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self):
+        while b'\n' not in self._buffer:
+            length = len(self._buffer)
+            self._fill(length + 1)
+            if len(self._buffer) == length:
+                break
+        pos = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        data, self._buffer = self._buffer[:pos], self._buffer[pos:]
+        return data
+
+
+def write_tar(fileobj, directory, compression, names=None, arcnames=None):
+    """Writes a directory as a tar archive to a file object.
+
+    :param names: A list of the paths of the files to include, relative to
+    `directory`. If None, the whole directory is included.
+    :param arcnames: The names to give the files in the archive, in the same
+    order as `names`. Defaults to `names`.
+    :returns: A tuple ``(files, size)`` with the number of files and their
+    total (uncompressed) size.
+    """
+    stats = [0, 0]
+
+    def count(tarinfo):
+        if tarinfo.isfile():
+            stats[0] += 1
+            stats[1] += tarinfo.size
+        return tarinfo
+
+    if compression == 'zstd':
+        compressor = zstandard.ZstdCompressor().stream_writer(fileobj)
+        tar = tarfile.open(fileobj=compressor, mode='w|', dereference=True)
+    else:
+        compressor = None
+        tar = tarfile.open(fileobj=fileobj,
+                           mode='w|gz' if compression == 'gzip' else 'w|',
+                           dereference=True)
+    try:
+        directory = str(directory)
+        if names is None:
+            for name in sorted(os.listdir(directory)):
+                tar.add(os.path.join(directory, name), arcname=name,
+                        filter=count)
+        else:
+            if arcnames is None:
+                arcnames = names
+            for name, arcname in zip(names, arcnames):
+                tar.add(os.path.join(directory, name), arcname=arcname,
+                        recursive=False, filter=count)
+    finally:
+        tar.close()
+        if compressor is not None:
+            compressor.flush(zstandard.FLUSH_FRAME)
+    return stats[0], stats[1]
+
+
+def read_tar(fileobj, directory, compression, callback=None):
+    """Extracts a tar archive read from a file object into a directory.
+
+    Only regular files and directories are extracted, and members with names
+    that would end up outside of `directory` are skipped.
+
+    :param callback: A function called with the size of each file once it
+    has been extracted.
+    :returns: A tuple ``(files, size)`` with the number of files and their
+    total size.
+    """
+    if compression == 'zstd':
+        fileobj = zstandard.ZstdDecompressor().stream_reader(fileobj)
+        mode = 'r|'
+    elif compression == 'gzip':
+        mode = 'r|gz'
+    else:
+        mode = 'r|'
+    directory = str(directory)
+    files = size = 0
+    tar = tarfile.open(fileobj=fileobj, mode=mode)
+    try:
+        for member in tar:
+            name = member.name
+            if (name.startswith('/') or '..' in name.split('/') or
+                    not (member.isfile() or member.isdir())):
+                logger.warning("Not extracting %s from archive", name)
+                continue
+            if hasattr(tarfile, 'data_filter'):
+                tar.extract(member, directory, filter='data')
+            else:
+                tar.extract(member, directory)
+            if member.isfile():
+                files += 1
+                size += member.size
+                if callback is not None:
+                    callback(member.size)
+    finally:
+        tar.close()
+    return files, size
+
+
+def match_filters(path, include=None, exclude=None):
+    """Checks a path against include and exclude patterns.
+
+    The patterns are shell-style, ``*`` also matching ``/``. A path is
+    selected if it matches one of `include` (or if `include` is empty) and
+    none of `exclude`.
+    """
+    if include and not any(fnmatch.fnmatchcase(path, pattern)
+                           for pattern in include):
+        return False
+    if exclude and any(fnmatch.fnmatchcase(path, pattern)
+                       for pattern in exclude):
+        return False
+    return True
+
+
+def hash_file(path):
+    """Computes the SHA-256 hash of a file, as an hexadecimal string.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        chunk = fp.read(1 << 20)
+        while chunk:
+            h.update(chunk)
+            chunk = fp.read(1 << 20)
+    return h.hexdigest()
+
+
+def list_directory(directory):
+    """Lists the content of a directory, recursively.
+
+    Returns a list of the directories and a list of the files, as paths
+    relative to `directory` using ``/`` as separator.
+    """
+    directory = str(directory)
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        rel = os.path.relpath(dirpath, directory)
+        if rel == os.curdir:
+            rel = ''
+        else:
+            rel = rel.replace(os.sep, '/') + '/'
+        dirs.extend(rel + name for name in sorted(dirnames))
+        files.extend(rel + name for name in sorted(filenames))
+    return dirs, files
+
+
+def extract_command(target, compression):
+    """Builds the shell command extracting a tar stream into `target`.
+    """
+    target = shell_escape(target)
+    if compression == 'zstd':
+        extract = 'zstd -dc | tar -xf -'
+    elif compression == 'gzip':
+        extract = 'tar -xzf -'
+    else:
+        extract = 'tar -xf -'
+    return 'mkdir -p %s && cd %s && %s' % (target, target, extract)
@@ -4,6 +4,7 @@
 from __future__ import unicode_literals
 
 import sys
+import threading
 
 from rpaths import PosixPath
 
@@ -50,3 +51,34 @@ def shell_escape(s):
                           .replace('$', '\\$'))
     else:
         return s
+
+
+def parallel_map(func, items, workers):
+    """Calls `func` on each item, using up to `workers` threads.
+
+    Returns a list of ``(result, exception)`` pairs, in the same order as
+    `items`; `exception` is None if the call succeeded.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    indices = iter(irange(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(indices, None)
+            if i is None:
+                return
+            try:
+                results[i] = func(items[i]), None
+            except Exception as e:
+                results[i] = None, e
+
+    threads = [threading.Thread(target=worker)
+               for _ in irange(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 import functools
+import json
 import logging
 import os
 import re
@@ -151,6 +152,13 @@ def functional_tests():
     finally:
         destdir.rmtree()
 
+    logging.info("Show job output")
+    output = check_output(tej + ['logs', destination, '--id', job_id])
+    assert output == b'stdout here\n'
+    output = check_output(tej + ['logs', destination, '--id', job_id,
+                                 '--follow', '--offset', '7'])
+    assert output == b'here\n'
+
     logging.info("List jobs")
     output = check_output(tej + ['list', destination])
     assert output == ('%s finished\n' % job_id).encode('ascii')
@@ -216,6 +224,39 @@ def functional_tests():
     output = check_output(tej + ['status', destination, '--id', job_id])
     assert output == b'not found\n'
 
+    logging.info("Submit several jobs")
+    jobdirs = [Path.tempdir(prefix='tej-tests-') for _ in range(3)]
+    try:
+        for i, jobdir in enumerate(jobdirs):
+            with jobdir.open('w', 'start.sh', newline='\n') as fp:
+                fp.write('#!/bin/sh\n'
+                         'echo "job %d"\n' % i)
+        job_ids = check_output(tej + ['submit-many', destination,
+                                      '--transfer', 'tar'] +
+                               [jobdir.path for jobdir in jobdirs])
+        job_ids = job_ids.decode('ascii').split()
+        assert len(job_ids) == 3
+    finally:
+        for jobdir in jobdirs:
+            jobdir.rmtree()
+    output = check_output(tej + ['wait', destination, '--timeout', '30'] +
+                          job_ids)
+    assert sorted(output.splitlines()) == sorted(
+        ('%s finished 0' % job_id).encode('ascii') for job_id in job_ids)
+    output = check_output(tej + ['list', destination])
+    assert sorted(output.splitlines()) == sorted(
+        ('%s finished' % job_id).encode('ascii') for job_id in job_ids)
+    output = check_output(tej + ['status-many', destination] + job_ids +
+                          ['nonexistent'])
+    records = [json.loads(line.decode('utf-8'))
+               for line in output.splitlines()]
+    assert [r['id'] for r in records] == job_ids + ['nonexistent']
+    assert all(r['status'] == 'finished' and r['exit_code'] == 0
+               for r in records[:-1])
+    assert records[-1]['status'] == 'not found'
+    for job_id in job_ids:
+        check_call(tej + ['delete', destination, '--id', job_id])
+
     RemoteQueue(destination, 'tej 2/link').cleanup()
     assert not Path('~/tej 2/link').expand_user().exists()
     assert not Path('~/tej 2/queue').expand_user().exists()
@@ -0,0 +1,175 @@
+from __future__ import unicode_literals
+
+import sys
+import unittest
+
+from rpaths import PosixPath
+
+from tests.test_channel import FakeChannel, make_queue
+
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from tej.aio import AsyncRemoteQueue
+    from tej.errors import JobNotFound
+
+
+class SlowExitChannel(FakeChannel):
+    """Channel whose exit status arrives after EOF.
+    """
+    def exit_status_ready(self):
+        return False
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio needs Python 3.5")
+class TestAsync(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.channels = []
+        self.commands = []
+        self.queue = AsyncRemoteQueue('ssh://me@host', '/q', loop=self.loop)
+        sync = make_queue(None)
+        sync.status_cache = None
+        sync._queue = PosixPath('/q')
+
+        def open_channel(cmd):
+            self.commands.append(cmd)
+            return self.channels.pop(0)
+        sync._open_channel = open_channel
+        self.sync = sync
+        self.queue._sync = sync
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_call(self):
+        """Stdout is captured and stderr logged until EOF."""
+        chan = FakeChannel([('out', b'hello\n'), ('err', b'warn'),
+                            ('out', b'world\r\n'), ('err', b'ing\n')],
+                           exit_status=4)
+        self.channels.append(chan)
+        self.assertEqual(self.run_coro(self.queue._call('cmd', True, b'in')),
+                         (4, b'hello\nworld'))
+        self.assertEqual(self.commands, ['/bin/sh -c cmd'])
+        self.assertEqual(bytes(chan.sent), b'in')
+        self.assertTrue(chan.write_shut)
+        self.assertTrue(chan.closed)
+        self.assertEqual(self.sync.server_err.messages, ['warning'])
+
+    def test_call_no_output(self):
+        """Output is discarded, and a late exit status is waited for."""
+        chan = SlowExitChannel([('out', b'ignored\n')], exit_status=1)
+        self.channels.append(chan)
+        self.assertEqual(self.run_coro(self.queue._call('cmd', False)),
+                         (1, b''))
+        self.assertTrue(chan.closed)
+
+    def test_call_raw(self):
+        """The final line terminator is kept by _call_raw()."""
+        self.channels.append(FakeChannel([('out', b'a\n')]))
+        self.assertEqual(self.run_coro(self.queue._call_raw('cmd', True)),
+                         (0, b'a\n'))
+
+    def test_status(self):
+        self.channels.append(FakeChannel([('out', b'/q/jobs/j/stage\n'),
+                                          ('out', b'queued\n')],
+                                         exit_status=2))
+        self.assertEqual(self.run_coro(self.queue.status('j')),
+                         ('queued', PosixPath('/q/jobs/j/stage'), None))
+        self.channels.append(FakeChannel([('out', b'/q/jobs/j/stage\n3\n')]))
+        self.assertEqual(self.run_coro(self.queue.status('j')),
+                         ('finished', PosixPath('/q/jobs/j/stage'), '3'))
+        self.channels.append(FakeChannel([], exit_status=3))
+        self.assertRaises(JobNotFound,
+                          self.run_coro, self.queue.status('j'))
+        self.assertEqual(self.commands[0],
+                         '/bin/sh -c "/q/commands/status j"')
+
+    def test_list(self):
+        self.channels.append(FakeChannel([
+            ('out', b'job1\n    status: finished\n    exit_code: 2\n'),
+            ('out', b'job2\n    status: running\n')]))
+        self.assertEqual(
+            self.run_coro(self.queue.list(status='finished')),
+            [('job1', {'status': 'finished', 'exit_code': 2})])
+
+    def test_wait(self):
+        self.channels.append(FakeChannel(
+            [('out', b'j1\n    status: finished\n    exit_code: 0\n'),
+             ('out', b'j2\n    status: running\n')],
+            exit_status=2))
+        self.assertEqual(
+            self.run_coro(self.queue.wait(['j1', 'j2'], timeout=10)),
+            (False, [('j1', {'status': 'finished', 'exit_code': 0}),
+                     ('j2', {'status': 'running'})]))
+        self.assertEqual(self.channels, [])
+
+    def test_tail_events(self):
+        self.channels.append(FakeChannel([('out', b'running\n10\n'),
+                                          ('out', b'line\n')]))
+        self.assertEqual(self.run_coro(self.queue.tail('j', offset=10)),
+                         (b'line\n', 15, 'running'))
+        self.channels.append(FakeChannel([
+            ('out', b'0\n1500000000 started j 12\n150')]))
+        events, offset = self.run_coro(self.queue.events())
+        self.assertEqual([(e.event, e.job_id) for e in events],
+                         [('started', 'j')])
+        self.assertEqual(offset, 24)
+        self.assertEqual(self.commands,
+                         ['/bin/sh -c "/q/commands/tail j stdout 10"',
+                          '/bin/sh -c "/q/commands/events 0"'])
+
+    def test_submit_many(self):
+        uploaded = []
+
+        def upload(sync, directory, target, transfer, cache, base_job):
+            if directory == 'dir2':
+                raise IOError("upload failed")
+            uploaded.append((directory, target))
+        self.queue._upload = upload
+        self.channels.extend([
+            FakeChannel([('out', b'0 j1 /q/jobs/j1/stage\n'),
+                         ('out', b'4 j3\n0 j2 /q/jobs/j2/stage\n')]),
+            FakeChannel([]),
+            FakeChannel([('out', b'0 j1\n')])])
+        results = self.run_coro(self.queue.submit_many(
+            [('j1', 'dir1', None), ('j2', 'dir2', 'run.sh'),
+             ('j3', 'dir3', None)],
+            priority=3))
+        self.assertEqual([(job_id, type(error).__name__)
+                          for job_id, error in results],
+                         [('j1', 'NoneType'), ('j2', 'OSError'),
+                          ('j3', 'JobAlreadyExists')])
+        self.assertEqual(uploaded, [('dir1', PosixPath('/q/jobs/j1/stage'))])
+        self.assertEqual(self.commands[1:],
+                         ['/bin/sh -c "/q/commands/delete j2"',
+                          '/bin/sh -c "/q/commands/submit_jobs 3"'])
+        self.assertEqual(self.channels, [])
+
+    def test_status_many(self):
+        self.channels.append(FakeChannel([
+            ('out', b'j1\n    status: finished\n    exit_code: 1\n'),
+            ('out', b'j2\n    status: not found\n')]))
+        self.assertEqual(self.run_coro(self.queue.status_many(['j2', 'j1'])),
+                         [('j2', None),
+                          ('j1', {'status': 'finished', 'exit_code': 1})])
+        self.assertEqual(self.commands,
+                         ['/bin/sh -c /q/commands/status_many'])
+
+    def test_status_many_fallback(self):
+        """Older runtimes get the status of each job."""
+        self.channels.extend([
+            FakeChannel([], exit_status=127),
+            FakeChannel([('out', b'/q/jobs/j1/stage\n')], exit_status=2),
+            FakeChannel([], exit_status=3),
+            FakeChannel([], exit_status=1)])
+        self.assertEqual(
+            self.run_coro(self.queue.status_many(['j1', 'j2', 'j3'])),
+            [('j1', {'status': 'running',
+                     'directory': PosixPath('/q/jobs/j1/stage')}),
+             ('j2', None),
+             ('j3', {'status': 'incomplete'})])
+        self.assertEqual(self.channels, [])
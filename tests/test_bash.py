@@ -1,5 +1,12 @@
+import hashlib
+import io
+import os
+import signal
 from rpaths import Path
 import subprocess
+import tarfile
+import threading
+import time
 import unittest
 
 
@@ -53,3 +60,985 @@ format_timedelta "$1"
                          b'2:42:42\n')
         self.assertEqual(self.call_function(25200),
                          b'7:00:00\n')
+
+
+class QueueTestCase(unittest.TestCase):
+    runtime = 'default'
+
+    def setUp(self):
+        self.queue = Path.tempdir(prefix='tej-tests-')
+        (Path(__file__).parent.parent /
+         'tej/remotes' / self.runtime).copytree(self.queue / 'q')
+        self.queue = self.queue / 'q'
+        subprocess.check_call(['/bin/sh',
+                               (self.queue / 'commands/setup').path])
+
+    def tearDown(self):
+        # Lets the jobs started by the scheduler finish using the queue
+        self.wait_until(self.scheduler_idle, 10)
+        self.queue.parent.rmtree()
+
+    def scheduler_idle(self):
+        active = self.queue / 'active'
+        return (not (self.queue / 'scheduler.lock').exists() and
+                not (active.is_dir() and active.listdir()))
+
+    def wait_until(self, condition, timeout=5):
+        """Polls `condition` until it returns True or `timeout` expires.
+        """
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def run_command(self, command, *args, **kwargs):
+        p = subprocess.Popen(
+            ['/bin/sh', (self.queue / 'commands' / command).path] +
+            list(args),
+            cwd=self.queue.path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+        stdout, _ = p.communicate(kwargs.get('stdin', b''))
+        return p.wait(), stdout
+
+
+class TestAgent(QueueTestCase):
+    def test_agent(self):
+        p = subprocess.Popen(
+            ['/bin/sh', (self.queue / 'commands/agent').path, 'TOKEN'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate(b'new_job "job 1"\n'
+                                       b'new_job "job 1"\n'
+                                       b'status nonexistent\n'
+                                       b'rm -rf /\n')
+        self.assertEqual(p.wait(), 0)
+        stage = (self.queue / 'jobs/job 1/stage').absolute().path
+        self.assertEqual(stdout,
+                         b'TOKEN ready\n' +
+                         stage + b'\n\nTOKEN 0\n'
+                         b'\nTOKEN 4\n'
+                         b'\nTOKEN 3\n'
+                         b'\nTOKEN 127\n')
+        self.assertIn(b"Unknown command 'rm'", stderr)
+
+
+class TestBlobs(QueueTestCase):
+    def test_blobs(self):
+        data = b'some data\n'
+        h = hashlib.sha256(data).hexdigest().encode('ascii')
+        other = hashlib.sha256(b'other').hexdigest().encode('ascii')
+
+        # Nothing in the cache yet
+        self.assertEqual(self.run_command('missing_blobs',
+                                          stdin=h + b'\n' + other + b'\n'),
+                         (0, h + b'\n' + other + b'\n'))
+
+        # Add a blob
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            info = tarfile.TarInfo(h.decode('ascii'))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        self.assertEqual(self.run_command('add_blobs', 'none',
+                                          stdin=buf.getvalue())[0],
+                         0)
+        self.assertEqual(self.run_command('missing_blobs',
+                                          stdin=h + b'\n' + other + b'\n'),
+                         (0, other + b'\n'))
+
+        # Link it into a job
+        ret, stage = self.run_command('new_job', 'job')
+        self.assertEqual(ret, 0)
+        stage = stage.rstrip(b'\n')
+        self.assertEqual(
+            self.run_command('link_blobs', stage,
+                             stdin=h + b' sub dir/file\n' +
+                             other + b' missing\n'),
+            (0, b'missing\n'))
+        with (Path(stage) / 'sub dir/file').open('rb') as fp:
+            self.assertEqual(fp.read(), data)
+
+        # Deleting the job removes the blob
+        self.assertEqual(self.run_command('delete', 'job')[0], 0)
+        self.assertEqual(self.run_command('missing_blobs', stdin=h + b'\n'),
+                         (0, h + b'\n'))
+
+
+class TestManifest(QueueTestCase):
+    def test_copy(self):
+        ret, stage = self.run_command('new_job', 'base')
+        self.assertEqual(ret, 0)
+        stage = Path(stage.rstrip(b'\n'))
+        stage.mkdir()
+        with stage.open('wb', 'a file') as fp:
+            fp.write(b'hello\n')
+        with stage.mkdir('sub').open('wb', 'data') as fp:
+            fp.write(b'x' * 1000)
+
+        ret, output = self.run_command('manifest', 'base')
+        self.assertEqual(ret, 0)
+        self.assertEqual(
+            sorted((line.split(b' ')[0], line.split(b' ', 2)[2])
+                   for line in output.splitlines()),
+            [(b'1000', b'sub/data'), (b'6', b'a file')])
+        self.assertEqual(self.run_command('manifest', 'nonexistent')[0], 3)
+
+        self.assertEqual(
+            self.run_command('hash_files', 'base',
+                             stdin=b'a file\nmissing\n'),
+            (0, hashlib.sha256(b'hello\n').hexdigest().encode('ascii') +
+             b' a file\n'))
+
+        ret, target = self.run_command('new_job', 'new')
+        self.assertEqual(ret, 0)
+        target = target.rstrip(b'\n')
+        self.assertEqual(
+            self.run_command('copy_files', 'base', target,
+                             stdin=b'sub/data\nmissing\n'),
+            (0, b'missing\n'))
+        with (Path(target) / 'sub/data').open('rb') as fp:
+            self.assertEqual(fp.read(), b'x' * 1000)
+
+
+class TestSubmitArchive(QueueTestCase):
+    def test_submit(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            script = b'#!/bin/sh\necho "hello" > output\n'
+            info = tarfile.TarInfo('start.sh')
+            info.size = len(script)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(script))
+        archive = buf.getvalue()
+
+        self.assertEqual(self.run_command('submit_archive', 'job',
+                                          'start.sh', 'gzip',
+                                          stdin=archive),
+                         (0, b'gzip\n'))
+        self.assertEqual(self.run_command('submit_archive', 'job',
+                                          'start.sh', 'gzip',
+                                          stdin=archive)[0],
+                         4)
+        for _ in range(50):
+            if self.run_command('status', 'job')[0] == 0:
+                break
+            time.sleep(0.1)
+        with (self.queue / 'jobs/job/stage/output').open('rb') as fp:
+            self.assertEqual(fp.read(), b'hello\n')
+
+        # Invalid archive
+        self.assertEqual(self.run_command('submit_archive', 'other',
+                                          'start.sh', 'bzip2',
+                                          stdin=b'garbage'),
+                         (1, b'none\n'))
+        self.assertFalse((self.queue / 'jobs/other').exists())
+
+
+class TestStatusMany(QueueTestCase):
+    def test_status_many(self):
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        with (self.queue / 'jobs/other').mkdir().open('w', 'status') as fp:
+            fp.write('finished\n3\n1500000000\n1500000060\n')
+        ret, output = self.run_command('status_many',
+                                       stdin=b'job\nnonexistent\nother\n')
+        self.assertEqual(ret, 0)
+        jobs = (self.queue / 'jobs').absolute().path
+        created = output.splitlines()[2]
+        self.assertTrue(created.startswith(b'    created: '))
+        self.assertEqual(
+            output,
+            b'job\n'
+            b'    status: created\n' +
+            created + b'\n'
+            b'    directory: ' + jobs + b'/job/stage\n'
+            b'nonexistent\n'
+            b'    status: not found\n'
+            b'other\n'
+            b'    status: finished\n'
+            b'    exit_code: 3\n'
+            b'    started: 1500000000\n'
+            b'    finished: 1500000060\n'
+            b'    directory: ' + jobs + b'/other/stage\n')
+
+
+class TestList(QueueTestCase):
+    def setUp(self):
+        super(TestList, self).setUp()
+        now = int(time.time())
+        jobs = [('job 1', 'finished\n0\n%d\n%d\n' % (now - 100, now - 50)),
+                ('job2', 'running\n1234\n%d\n\n' % (now - 10)),
+                ('job3', 'created\n\n%d\n\n' % (now - 5)),
+                ('other', 'finished\n1\n%d\n%d\n' % (now - 1000, now - 900))]
+        for job_id, status in jobs:
+            job = (self.queue / 'jobs' / job_id).mkdir()
+            with job.open('w', 'status') as fp:
+                fp.write(status)
+
+    def list(self, *filters):
+        ret, output = self.run_command('list', *filters)
+        self.assertEqual(ret, 0)
+        return [line for line in output.splitlines()
+                if not line.startswith(b' ')]
+
+    def test_list(self):
+        ret, output = self.run_command('list')
+        self.assertEqual(ret, 0)
+        lines = output.splitlines()
+        self.assertEqual(lines[:3], [b'job 1', b'    status: finished',
+                                     b'    exit_code: 0'])
+        self.assertEqual(self.list(),
+                         [b'job 1', b'job2', b'job3', b'other'])
+
+    def test_filters(self):
+        self.assertEqual(self.list('status=finished'), [b'job 1', b'other'])
+        self.assertEqual(self.list('status=running,created'),
+                         [b'job2', b'job3'])
+        self.assertEqual(self.list('max_age=60'), [b'job2', b'job3'])
+        self.assertEqual(self.list('prefix=job'), [b'job 1', b'job2', b'job3'])
+        self.assertEqual(self.list('after=job2', 'limit=1'), [b'job3'])
+        self.assertEqual(self.list('limit=2'), [b'job 1', b'job2'])
+        self.assertEqual(self.run_command('list', 'invalid')[0], 1)
+
+
+class TestWait(QueueTestCase):
+    def write_status(self, job_id, status):
+        job = self.queue / 'jobs' / job_id
+        if not job.exists():
+            job.mkdir()
+        with job.open('w', 'status.tmp') as fp:
+            fp.write(status)
+        (job / 'status.tmp').rename(job / 'status')
+
+    def test_wait(self):
+        self.write_status('done', 'finished\n0\n1500000000\n1500000060\n')
+        self.write_status('running', 'running\n1234\n1500000000\n\n')
+
+        # Already finished
+        ret, output = self.run_command('wait', 'all', '', stdin=b'done\n')
+        self.assertEqual(ret, 0)
+        self.assertTrue(output.startswith(b'done\n    status: finished\n'))
+        self.assertEqual(self.run_command('wait', 'any', '5',
+                                          stdin=b'running\ndone\n')[0],
+                         0)
+
+        # Timeout
+        start = time.time()
+        ret, output = self.run_command('wait', 'all', '1',
+                                       stdin=b'running\ndone\n')
+        self.assertEqual(ret, 2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertIn(b'running\n    status: running\n', output)
+
+        # Nonexistent job
+        self.assertEqual(self.run_command('wait', 'all', '',
+                                          stdin=b'done\nnonexistent\n')[0],
+                         3)
+
+        # Finishes while waiting
+        thread = threading.Timer(
+            0.5,
+            lambda: self.write_status('running',
+                                      'finished\n1\n1500000000\n'
+                                      '1500000060\n'))
+        thread.start()
+        try:
+            ret, output = self.run_command('wait', 'all', '10',
+                                           stdin=b'running\ndone\n')
+        finally:
+            thread.join()
+        self.assertEqual(ret, 0)
+        self.assertIn(b'running\n    status: finished\n    exit_code: 1\n',
+                      output)
+
+
+class TestEvents(QueueTestCase):
+    def test_events(self):
+        self.assertEqual(self.run_command('events', '0'), (0, b'0\n'))
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        self.assertEqual(self.run_command('delete', 'job')[0], 0)
+        ret, output = self.run_command('events', '0')
+        self.assertEqual(ret, 0)
+        lines = output.splitlines()
+        self.assertEqual(lines[0], b'0')
+        self.assertEqual([line.split(b' ', 1)[1] for line in lines[1:]],
+                         [b'created job', b'deleted job'])
+
+        # From an offset
+        offset = len(lines[1]) + 1
+        ret, output = self.run_command('events', '%d' % offset)
+        self.assertEqual(output, b'%d\n' % offset + lines[2] + b'\n')
+
+        # Past the end
+        ret, output = self.run_command('events', '100000')
+        self.assertEqual(output.splitlines()[0], b'0')
+
+
+class TestLog(QueueTestCase):
+    def read_log(self):
+        with (self.queue / 'tej.log').open('rb') as fp:
+            return [line.split(b' ', 1)[1] for line in fp.read().splitlines()]
+
+    def test_levels(self):
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        self.assertEqual(self.run_command('status', 'job')[0], 1)
+        self.assertEqual(self.run_command('new_job', 'job')[0], 4)
+        stage = (self.queue / 'jobs/job/stage').absolute().path
+        self.assertEqual(self.read_log()[1:],
+                         [b'info new_job job=job directory=' + stage,
+                          b'warning new_job job=job exists'])
+
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('log_level = debug\n')
+        self.assertEqual(self.run_command('status', 'job')[0], 1)
+        self.assertEqual(self.read_log()[-1],
+                         b'debug status job=job status=created arg=')
+
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('log_level=none\n')
+        self.run_command('list')
+        self.run_command('delete', 'job')
+        self.assertEqual(len(self.read_log()), 4)
+
+    def test_rotation(self):
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('log_max_size=200\nlog_keep=2\n')
+        for i in range(20):
+            self.assertEqual(self.run_command('new_job', 'job%d' % i)[0], 0)
+        self.assertTrue((self.queue / 'tej.log.1').is_file())
+        self.assertTrue((self.queue / 'tej.log.2').is_file())
+        self.assertFalse((self.queue / 'tej.log.3').exists())
+        for name in ('tej.log', 'tej.log.1', 'tej.log.2'):
+            self.assertLess((self.queue / name).size(), 400)
+        self.assertTrue(self.read_log()[-1].startswith(b'info new_job '
+                                                       b'job=job19 '))
+
+
+class TestDownloadList(QueueTestCase):
+    def test_list(self):
+        self.assertEqual(self.run_command('download_list', 'job', '1', 'a'),
+                         (3, b''))
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        stage = (self.queue / 'jobs/job/stage').mkdir()
+        stage.mkdir('out').mkdir('sub')
+        with stage.open('wb', 'out/sub/data') as fp:
+            fp.write(b'12345')
+        with stage.open('wb', 'result') as fp:
+            fp.write(b'42\n')
+        ret, output = self.run_command('download_list', 'job', '1',
+                                       'result', 'out', 'missing')
+        self.assertEqual(ret, 0)
+        self.assertEqual(output.splitlines(),
+                         [b'created', stage.absolute().path,
+                          b'f 3 result',
+                          b'd 0 out', b'D 0 sub', b'F 5 sub/data',
+                          b'n 0 missing'])
+        ret, output = self.run_command('download_list', 'job', '0', 'out')
+        self.assertEqual(output.splitlines()[2:], [b'd 0 out'])
+
+
+class TestDownloadArchive(QueueTestCase):
+    def test_archive(self):
+        self.assertEqual(self.run_command('download_archive', 'job', 'none',
+                                          '--', 'a'),
+                         (3, b''))
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        stage = (self.queue / 'jobs/job/stage').mkdir()
+        stage.mkdir('out').mkdir('sub')
+        for name in ('out/a.csv', 'out/b.log', 'out/sub/c.csv', 'result'):
+            with stage.open('wb', name) as fp:
+                fp.write(b'data')
+
+        def names(*args):
+            ret, output = self.run_command('download_archive', 'job', 'none',
+                                           *args)
+            self.assertEqual(ret, 0)
+            compression, archive = output.split(b'\n', 1)
+            self.assertEqual(compression, b'none')
+            with tarfile.open(fileobj=io.BytesIO(archive), mode='r:') as tar:
+                return sorted(tar.getnames())
+
+        self.assertEqual(names('--', 'out', 'result'),
+                         ['out/a.csv', 'out/b.log', 'out/sub/c.csv',
+                          'result'])
+        self.assertEqual(names('include=*.csv', '--', 'out', 'result'),
+                         ['out/a.csv', 'out/sub/c.csv'])
+        self.assertEqual(names('include=*.csv', 'include=result',
+                               'exclude=*/sub/*', '--', 'out', 'result'),
+                         ['out/a.csv', 'result'])
+
+        # A failure of tar is reported, even though the archive is compressed
+        bindir = self.queue.parent.mkdir('bin')
+        with bindir.open('w', 'tar') as fp:
+            fp.write('#!/bin/sh\ncat >/dev/null\necho partial\nexit 2\n')
+        (bindir / 'tar').chmod(0o755)
+        path = os.environ['PATH']
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        os.environ['PATH'] = '%s:%s' % (bindir.path.decode('utf-8'), path)
+        self.assertEqual(self.run_command('download_archive', 'job', 'gzip',
+                                          '--', 'out')[0],
+                         1)
+        self.assertEqual(self.queue.listdir('.download_archive.*'), [])
+
+
+class TestTail(QueueTestCase):
+    def test_tail(self):
+        self.assertEqual(self.run_command('tail', 'job', 'stdout', '0'),
+                         (3, b''))
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        self.assertEqual(self.run_command('tail', 'job', 'stdout', '0'),
+                         (0, b'created\n0\n'))
+        stage = (self.queue / 'jobs/job/stage').mkdir()
+        with stage.open('wb', '_stdout') as fp:
+            fp.write(b'hello\nworld\n')
+        self.assertEqual(self.run_command('tail', 'job', 'stdout', '0'),
+                         (0, b'created\n0\nhello\nworld\n'))
+        self.assertEqual(self.run_command('tail', 'job', 'stdout', '6', '3'),
+                         (0, b'created\n6\nwor'))
+        self.assertEqual(self.run_command('tail', 'job', 'stdout', '12'),
+                         (0, b'created\n12\n'))
+        # Past the end, file was replaced
+        self.assertEqual(self.run_command('tail', 'job', 'stdout', '100'),
+                         (0, b'created\n0\nhello\nworld\n'))
+        self.assertEqual(self.run_command('tail', 'job', 'other', '0')[0], 1)
+
+
+class TestScheduler(QueueTestCase):
+    def submit(self, job_id, priority=None, *resources):
+        ret, stage = self.run_command('new_job', job_id)
+        self.assertEqual(ret, 0)
+        stage = Path(stage.rstrip(b'\n'))
+        stage.mkdir()
+        with stage.open('w', 'start.sh') as fp:
+            fp.write('while ! [ -e ../../../go ]; do sleep 0.1; done\n')
+        args = [job_id, stage.path, 'start.sh']
+        if priority is not None:
+            args.append(priority)
+        args.extend(resources)
+        self.assertEqual(self.run_command('submit', *args)[0], 0)
+
+    def status(self, job_id):
+        ret, output = self.run_command('status', job_id)
+        return ret, output.splitlines()[1:]
+
+    def read_pid(self, job_id):
+        with (self.queue / 'jobs' / job_id).open('r', 'status') as fp:
+            status, pid = fp.read().split('\n')[:2]
+        return pid if status == 'running' else None
+
+    def wait_finished(self, job_id):
+        for i in range(100):
+            ret, output = self.status(job_id)
+            if ret == 0:
+                return output
+            time.sleep(0.1)
+        self.fail("Job %s didn't finish" % job_id)
+
+    def test_slots(self):
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('max_slots=1\n')
+        self.submit('first')
+        self.submit('low', '-5')
+        self.submit('high', '5')
+        self.submit('gone')
+        self.assertEqual(self.status('first')[0], 2)
+        self.assertEqual(self.status('high'), (2, [b'queued']))
+        self.assertEqual(self.status('low'), (2, [b'queued']))
+        ret, output = self.run_command('list')
+        self.assertIn(b'high\n    status: queued\n    priority: 5\n', output)
+
+        # Killing a queued job
+        self.assertEqual(self.run_command('kill', 'gone')[0], 0)
+        self.assertEqual(self.status('gone'), (0, [b'-1']))
+        self.assertEqual(self.run_command('delete', 'low')[0], 2)
+
+        # Jobs start in order of priority
+        (self.queue / 'go').open('w').close()
+        self.assertEqual(self.wait_finished('first'), [b'0'])
+        self.assertEqual(self.wait_finished('high'), [b'0'])
+        self.assertEqual(self.wait_finished('low'), [b'0'])
+        with (self.queue / 'events.log').open('rb') as fp:
+            events = [line.split(b' ')[1:3] for line in fp.read().splitlines()]
+        started = [job_id for event, job_id in events if event == b'started']
+        self.assertEqual(started, [b'first', b'high', b'low'])
+        self.assertEqual([event for event, job_id in events
+                          if job_id == b'first'],
+                         [b'created', b'submitted', b'started', b'finished'])
+        self.assertEqual((self.queue / 'pending').listdir('[0-9]*'), [])
+        self.assertEqual((self.queue / 'active').listdir(), [])
+
+    def test_resources(self):
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('max_slots=3\ncpu_affinity=1\n')
+        self.submit('big', '0', 'cpus=2', 'memory=1gb')
+        self.submit('small', '0', 'cpus=2')
+        self.submit('one')
+        self.assertEqual(self.status('big')[0], 2)
+        self.assertEqual(self.status('small'), (2, [b'queued']))
+        self.assertEqual(self.status('one'), (2, [b'queued']))
+        with (self.queue / 'jobs/big/resources').open() as fp:
+            self.assertEqual(fp.read(), 'cpus=2\nmemory=1gb\n')
+        # Pinned to CPUs 0 and 1, if this machine has them
+        try:
+            pinned = subprocess.call(['taskset', '-c', '0,1', 'true'],
+                                     stderr=subprocess.PIPE) == 0
+        except OSError:
+            pinned = False
+        with (self.queue / 'active/big').open() as fp:
+            self.assertEqual(fp.read().split('\n')[:2],
+                             ['2', '0,1'] if pinned else ['2', ''])
+
+        # Invalid resources
+        ret, stage = self.run_command('new_job', 'bad')
+        Path(stage.rstrip(b'\n')).mkdir()
+        self.assertEqual(self.run_command('submit', 'bad',
+                                          stage.rstrip(b'\n'), 'start.sh',
+                                          '0', 'cpus=many')[0],
+                         1)
+        self.assertEqual(self.run_command('status', 'bad')[0], 1)
+
+        (self.queue / 'go').open('w').close()
+        for job_id in ('big', 'small', 'one'):
+            self.assertEqual(self.wait_finished(job_id), [b'0'])
+
+    def test_lost(self):
+        """Slots of jobs that are gone or never started are freed."""
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('max_slots=1\nstart_timeout=5\n')
+        # Dispatched long ago, but start never ran
+        ret, stage = self.run_command('new_job', 'ghost')
+        self.assertEqual(ret, 0)
+        Path(stage.rstrip(b'\n')).mkdir()
+        with (self.queue / 'jobs/ghost').open('w', 'status') as fp:
+            fp.write('running\n\n1500000000\n\n')
+        with (self.queue / 'active').open('w', 'ghost') as fp:
+            fp.write('1\n\n')
+        self.submit('one')
+        self.assertEqual(self.status('ghost'), (0, [b'-2']))
+        self.assertEqual(self.status('one'), (2, []))
+
+        # Start and the job are killed
+        def start_pid():
+            with (self.queue / 'active').open('r', 'one') as fp:
+                lines = fp.read().split('\n')
+            return len(lines) > 2 and lines[2]
+        self.assertTrue(self.wait_until(
+            lambda: start_pid() and self.read_pid('one')))
+        pids = [int(start_pid()), int(self.read_pid('one'))]
+        for pid in pids:
+            os.kill(pid, signal.SIGKILL)
+
+        def gone(pid):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return True
+            return False
+        self.assertTrue(self.wait_until(lambda: all(map(gone, pids))))
+        self.submit('two')
+        self.assertEqual(self.status('one'), (0, [b'-2']))
+        self.assertEqual(self.status('two'), (2, []))
+        with (self.queue / 'events.log').open('rb') as fp:
+            self.assertIn(b' finished ghost -2\n', fp.read())
+
+        (self.queue / 'go').open('w').close()
+        self.assertEqual(self.wait_finished('two'), [b'0'])
+
+    def test_unlimited(self):
+        self.submit('one')
+        self.submit('two')
+        self.assertEqual(self.status('one'), (2, []))
+        self.assertEqual(self.status('two'), (2, []))
+        self.assertTrue(self.wait_until(
+            lambda: all(self.read_pid(job_id) for job_id in ('one', 'two'))))
+        (self.queue / 'go').open('w').close()
+        self.wait_finished('one')
+        self.wait_finished('two')
+
+    def test_invalid_priority(self):
+        self.assertEqual(self.run_command('new_job', 'job')[0], 0)
+        self.assertEqual(self.run_command('submit', 'job',
+                                          (self.queue / 'jobs/job/stage').path,
+                                          'start.sh', 'high')[0],
+                         1)
+
+
+class PbsQueueTestCase(QueueTestCase):
+    runtime = 'pbs'
+
+    def setUp(self):
+        super(PbsQueueTestCase, self).setUp()
+        self.bindir = self.queue.parent.mkdir('bin')
+        path = os.environ['PATH']
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        os.environ['PATH'] = '%s:%s' % (self.bindir.path.decode('utf-8'),
+                                        path)
+
+    def scheduler_idle(self):
+        # There is no scheduler, the active directory lists the jobs given to
+        # PBS
+        return True
+
+    def fake_command(self, name, script):
+        """Installs a fake PBS command, recording its arguments in NAME.log.
+        """
+        with self.bindir.open('w', name) as fp:
+            fp.write('#!/bin/sh\n'
+                     'echo "$*" >> %s/%s.log\n' % (
+                         self.queue.parent.path.decode('utf-8'), name))
+            fp.write(script)
+        (self.bindir / name).chmod(0o755)
+
+    def read_command_log(self, name):
+        log = self.queue.parent / ('%s.log' % name)
+        if not log.exists():
+            return []
+        with log.open('rb') as fp:
+            return fp.read().splitlines()
+
+    def read_status(self, job_id):
+        with (self.queue / 'jobs' / job_id / 'status').open('rb') as fp:
+            return fp.read().splitlines()
+
+    def read_pbs_id(self, job_id):
+        with (self.queue / 'jobs' / job_id / 'pbs_id').open('rb') as fp:
+            return fp.read().rstrip(b'\n')
+
+    def write_status(self, job_id, *lines):
+        job = self.queue / 'jobs' / job_id
+        if not job.exists():
+            job.mkdir().mkdir('stage')
+        with job.open('w', 'status') as fp:
+            fp.write(''.join('%s\n' % line for line in lines))
+
+
+class TestPbsArray(PbsQueueTestCase):
+    def setUp(self):
+        super(TestPbsArray, self).setUp()
+        self.fake_command('qsub',
+                          'case "$1" in\n'
+                          '    --version) echo "Version: 6.1.2" ;;\n'
+                          '    -t|-J) echo "7[].server" ;;\n'
+                          '    *) echo "8.server" ;;\n'
+                          'esac\n')
+
+    def new_job(self, job_id):
+        ret, stage = self.run_command('new_job', job_id)
+        self.assertEqual(ret, 0)
+        stage = Path(stage.rstrip(b'\n'))
+        stage.mkdir()
+        with stage.open('w', 'start.sh') as fp:
+            fp.write('echo hello\n')
+
+    def test_array(self):
+        for job_id in ('j1', 'j2', 'j3', 'j4'):
+            self.new_job(job_id)
+        ret, output = self.run_command(
+            'submit_jobs',
+            stdin=b'j1 start.sh\nj3 other.sh\nj2 start.sh\n'
+                  b'j4 start.sh\nmissing start.sh\n')
+        self.assertEqual(ret, 0)
+        self.assertEqual(sorted(output.splitlines()),
+                         [b'0 j1', b'0 j2', b'0 j3', b'0 j4', b'1 missing'])
+        self.assertEqual(self.read_command_log('qsub')[1:],
+                         [b'tej_job.sh', b'-t 0-2 tej_array.sh'])
+        for job_id, pbs_id in [('j1', b'7[0].server'), ('j2', b'7[1].server'),
+                               ('j4', b'7[2].server'), ('j3', b'8.server')]:
+            self.assertEqual(self.read_status(job_id)[:2], [b'submitted', b''])
+            self.assertEqual(self.read_pbs_id(job_id), pbs_id)
+        ret, output = self.run_command('list')
+        self.assertIn(b'j1\n    status: submitted\n    pbs_id: 7[0].server\n',
+                      output)
+
+        # Runs an element of the array
+        array, = (self.queue / 'arrays').listdir()
+        env = dict(os.environ, PBS_ARRAYID='1')
+        subprocess.check_call(['/bin/sh', (array / 'tej_array.sh').path],
+                              env=env)
+        self.assertEqual(self.read_status('j2')[:2], [b'finished', b'0'])
+        self.assertEqual(self.read_status('j1')[0], b'submitted')
+        with (self.queue / 'jobs/j2/stage/_stdout').open('rb') as fp:
+            self.assertEqual(fp.read(), b'hello\n')
+        self.assertEqual(sorted(p.unicodename for p in
+                                (self.queue / 'active').listdir('j*')),
+                         ['j1', 'j3', 'j4'])
+
+        # The job file exits with the job's code, which PBS reports
+        with (self.queue / 'jobs/j4/stage').open('w', 'start.sh') as fp:
+            fp.write('exit 3\n')
+        env = dict(os.environ, PBS_ARRAYID='2')
+        self.assertEqual(
+            subprocess.call(['/bin/sh', (array / 'tej_array.sh').path],
+                            env=env),
+            3)
+        self.assertEqual(self.read_status('j4')[:2], [b'finished', b'3'])
+
+        # Array files are removed once the jobs are deleted
+        for job_id in ('j1', 'j2', 'j4'):
+            (self.queue / 'jobs' / job_id).rmtree()
+        self.assertEqual(self.run_command('submit_jobs')[0], 0)
+        self.assertEqual((self.queue / 'arrays').listdir(), [])
+
+    def test_started_early(self):
+        """An element that starts before qsub returns keeps its status."""
+        self.fake_command('qsub',
+                          'case "$1" in\n'
+                          '    --version) echo "Version: 6.1.2" ;;\n'
+                          '    -t|-J) PBS_ARRAYID=1 PBS_JOBID="7[1].server" '
+                          'sh tej_array.sh >/dev/null; echo "7[].server" ;;\n'
+                          'esac\n')
+        for job_id in ('j1', 'j2', 'j3'):
+            self.new_job(job_id)
+        ret, output = self.run_command(
+            'submit_jobs', stdin=b'j1 start.sh\nj2 start.sh\nj3 start.sh\n')
+        self.assertEqual((ret, output), (0, b'0 j1\n0 j2\n0 j3\n'))
+        self.assertEqual(self.read_status('j1')[0], b'submitted')
+        self.assertEqual(self.read_pbs_id('j1'), b'7[0].server')
+        self.assertEqual(self.read_status('j2')[:2], [b'finished', b'0'])
+        self.assertEqual(self.read_status('j3')[0], b'submitted')
+        self.assertEqual(self.read_pbs_id('j3'), b'7[2].server')
+        with (self.queue / 'events.log').open('rb') as fp:
+            started, = [line for line in fp.read().splitlines()
+                        if b' started ' in line]
+        self.assertTrue(started.endswith(b' started j2 7[1].server'))
+        self.assertFalse((self.queue / 'jobs/j1/status.created').exists())
+
+    def test_qsub_failure(self):
+        """Jobs are marked as created again if qsub fails."""
+        self.fake_command('qsub',
+                          'case "$1" in\n'
+                          '    --version) echo "Version: 6.1.2" ;;\n'
+                          '    *) exit 1 ;;\n'
+                          'esac\n')
+        for job_id in ('j1', 'j2', 'j3'):
+            self.new_job(job_id)
+        ret, output = self.run_command(
+            'submit_jobs', stdin=b'j1 start.sh\nj2 start.sh\nj3 x.sh\n')
+        self.assertEqual((ret, output), (0, b'1 j1\n1 j2\n1 j3\n'))
+        for job_id in ('j1', 'j2', 'j3'):
+            self.assertEqual(self.read_status(job_id)[0], b'created')
+            self.assertFalse(
+                (self.queue / 'jobs' / job_id / 'status.created').exists())
+
+    def test_resources(self):
+        for job_id in ('j1', 'j2', 'j3'):
+            self.new_job(job_id)
+        self.assertEqual(self.run_command('submit_jobs', '0', 'cpus=0',
+                                          stdin=b'j1 start.sh\n'),
+                         (1, b''))
+        ret, output = self.run_command(
+            'submit_jobs', '0', 'cpus=4', 'walltime=1:00:00', 'queue=long',
+            'directive=-l software=matlab', 'directive=#PBS -m abe',
+            stdin=b'j1 start.sh\nj2 start.sh\n')
+        self.assertEqual((ret, output), (0, b'0 j1\n0 j2\n'))
+        directives = (b'#PBS -l nodes=1:ppn=4\n'
+                      b'#PBS -l walltime=1:00:00\n'
+                      b'#PBS -q long\n'
+                      b'#PBS -l software=matlab\n'
+                      b'#PBS -m abe\n')
+        array, = (self.queue / 'arrays').listdir()
+        with (array / 'tej_array.sh').open('rb') as fp:
+            self.assertIn(directives, fp.read())
+        with (self.queue / 'jobs/j2/tej_job.sh').open('rb') as fp:
+            self.assertIn(directives, fp.read())
+
+        stage = (self.queue / 'jobs/j3/stage').path
+        self.assertEqual(self.run_command('submit', 'j3', stage, 'start.sh',
+                                          '0', 'memory=2gb')[0],
+                         0)
+        with (self.queue / 'jobs/j3/tej_job.sh').open('rb') as fp:
+            self.assertIn(b'#PBS -l nodes=1\n#PBS -l mem=2gb\n#PBS -N j3\n',
+                          fp.read())
+
+    def test_disabled(self):
+        with (self.queue / 'tej.conf').open('a') as fp:
+            fp.write('pbs_array=no\n')
+        for job_id in ('j1', 'j2'):
+            self.new_job(job_id)
+        ret, output = self.run_command(
+            'submit_jobs', '3',
+            stdin=b'j1 start.sh\nj2 start.sh\n')
+        self.assertEqual((ret, output), (0, b'0 j1\n0 j2\n'))
+        self.assertEqual(self.read_command_log('qsub'),
+                         [b'tej_job.sh', b'tej_job.sh'])
+        with (self.queue / 'jobs/j1/tej_job.sh').open('rb') as fp:
+            self.assertIn(b'#PBS -p 3\n', fp.read())
+
+
+class TestPbsKill(PbsQueueTestCase):
+    def setUp(self):
+        super(TestPbsKill, self).setUp()
+        self.fake_command('qdel', '')
+
+    def test_kill(self):
+        self.write_status('j1', 'running', '7[1].server', '1500000000',
+                          '1500000010', '')
+        self.assertEqual(self.run_command('kill', 'j1')[0], 0)
+        self.assertEqual(self.read_command_log('qdel'), [b'7[1].server'])
+        self.assertEqual(self.read_status('j1')[:4],
+                         [b'finished', b'-1', b'1500000000', b'1500000010'])
+
+    def test_in_flight(self):
+        """Killing a job that qsub didn't return for waits for its ID."""
+        self.write_status('j1', 'submitted', '', '1500000000', '', '')
+
+        def record():
+            with (self.queue / 'jobs/j1').open('w', 'pbs_id') as fp:
+                fp.write('8.server\n')
+        timer = threading.Timer(1, record)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(self.run_command('kill', 'j1')[0], 0)
+        self.assertEqual(self.read_command_log('qdel'), [b'8.server'])
+        self.assertEqual(self.read_status('j1')[:2], [b'finished', b'-1'])
+
+
+class TestPbsReconcile(PbsQueueTestCase):
+    def setUp(self):
+        super(TestPbsReconcile, self).setUp()
+        self.fake_command('qstat',
+                          'cat <<END\n'
+                          'Job Id: 10.server.example.org\n'
+                          '    Job_Name = waiting\n'
+                          '    job_state = Q\n'
+                          'Job Id: 11.server.example.org\n'
+                          '    job_state = C\n'
+                          '    exit_status = -11\n'
+                          'qstat: Unknown Job Id Error 12.server.example.org\n'
+                          'qstat: 7[1].server Job has finished, use -x or -H '
+                          'to obtain historical job information\n'
+                          'END\n'
+                          'exit 153\n')
+        self.write_status('waiting', 'submitted', '10.server', '1500000000',
+                          '', '')
+        self.write_status('walltime', 'running', '11.server', '1500000000',
+                          '1500000010', '')
+        self.write_status('lost', 'running', '12.server', '1500000000',
+                          '1500000010', '')
+        self.write_status('element', 'submitted', '7[1].server',
+                          '1500000000', '', '')
+        self.write_status('done', 'finished', '0', '1500000000',
+                          '1500000010', '1500000020')
+
+    def test_reconcile(self):
+        # Array IDs are not expanded as patterns
+        (self.queue / '71.server').open('w').close()
+        ret, output = self.run_command('list')
+        self.assertEqual(ret, 0)
+        self.assertEqual(self.read_command_log('qstat'),
+                         [b'-f 7[1].server 12.server 10.server 11.server'])
+        self.assertEqual(self.read_status('waiting')[0], b'submitted')
+        self.assertEqual(self.read_status('walltime')[:4],
+                         [b'finished', b'-11', b'1500000000', b'1500000010'])
+        self.assertEqual(self.read_status('lost')[:2], [b'finished', b'-2'])
+        self.assertEqual(self.read_status('element')[:2],
+                         [b'finished', b'-2'])
+        self.assertEqual(self.read_status('done')[:2], [b'finished', b'0'])
+        self.assertIn(b'lost\n    status: finished\n    exit_code: -2\n',
+                      output)
+        self.assertEqual(self.run_command('status', 'element'),
+                         (0, (self.queue / 'jobs/element/stage')
+                          .absolute().path + b'\n-2\n'))
+        # Only the jobs still submitted or running get checked from now on
+        self.assertEqual(sorted(p.unicodename for p in
+                                (self.queue / 'active').listdir()),
+                         ['.index', 'waiting'])
+
+        # Not checked again before the interval
+        self.run_command('status_many', stdin=b'waiting\n')
+        self.assertEqual(len(self.read_command_log('qstat')), 1)
+
+        with (self.queue / 'tej.conf').open('a') as fp:
+            fp.write('qstat_interval=0\n')
+        self.run_command('status_many', stdin=b'waiting\n')
+        self.assertEqual(self.read_command_log('qstat')[1:],
+                         [b'-f 10.server'])
+
+    def test_no_qstat(self):
+        (self.bindir / 'qstat').remove()
+        self.assertEqual(self.run_command('list')[0], 0)
+        self.assertEqual(self.read_status('lost')[0], b'running')
+
+
+class TestLimits(QueueTestCase):
+    def run_job(self, script, *resources):
+        ret, stage = self.run_command('new_job', 'job')
+        self.assertEqual(ret, 0)
+        stage = Path(stage.rstrip(b'\n'))
+        stage.mkdir()
+        with stage.open('w', 'start.sh') as fp:
+            fp.write(script)
+        self.assertEqual(self.run_command('submit', 'job', stage.path,
+                                          'start.sh', '0', *resources)[0],
+                         0)
+        for i in range(100):
+            ret, output = self.run_command('status', 'job')
+            if ret == 0:
+                break
+            time.sleep(0.1)
+        self.assertEqual(output.splitlines()[1:], [b'0'])
+        with stage.open('rb', '_stdout') as fp:
+            return fp.read()
+
+    def test_ulimit(self):
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('limits=ulimit\n')
+        self.assertEqual(
+            self.run_job('nice; ulimit -v; ionice -p $$\n'
+                         'taskset -p $$ | sed "s/.*: //"\n',
+                         'nice=5', 'memory=512mb', 'ionice=best-effort:6',
+                         'cpuset=0', 'cpu_limit=2'),
+            b'5\n524288\nbest-effort: prio 6\n1\n')
+
+    def test_ionice_unprivileged(self):
+        """The realtime I/O class is replaced when it is not permitted."""
+        try:
+            ionice = subprocess.check_output(
+                ['/bin/sh', '-c', 'command -v ionice']).rstrip(b'\n')
+        except subprocess.CalledProcessError:
+            self.skipTest("ionice is not installed")
+        bindir = self.queue.parent.mkdir('bin')
+        with bindir.open('w', 'ionice') as fp:
+            fp.write('#!/bin/sh\n'
+                     'case " $* " in *" -c 1 "*) exit 1 ;; esac\n'
+                     'exec %s "$@"\n' % ionice.decode('utf-8'))
+        (bindir / 'ionice').chmod(0o755)
+        path = os.environ['PATH']
+        self.addCleanup(os.environ.__setitem__, 'PATH', path)
+        os.environ['PATH'] = '%s:%s' % (bindir.path.decode('utf-8'), path)
+        self.assertEqual(self.run_job('%s -p $$\n' % ionice.decode('utf-8'),
+                                      'ionice=realtime:2'),
+                         b'best-effort: prio 2\n')
+
+    def test_invalid_cpuset(self):
+        """CPUs that can't be used are rejected when submitting."""
+        try:
+            subprocess.check_call(['taskset', '-c', '0', 'true'])
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("taskset is not usable")
+        ret, stage = self.run_command('new_job', 'job')
+        stage = Path(stage.rstrip(b'\n'))
+        stage.mkdir()
+        self.assertEqual(self.run_command('submit', 'job', stage.path,
+                                          'start.sh', '0', 'cpuset=4096')[0],
+                         1)
+        self.assertEqual(self.run_command('status', 'job')[0], 1)
+
+    def test_cgroup(self):
+        cgroup_root = self.queue.parent.mkdir('cgroup')
+        with (self.queue / 'tej.conf').open('w') as fp:
+            fp.write('limits=cgroup\ncgroup_root=%s\n' %
+                     cgroup_root.path.decode('utf-8'))
+        self.assertEqual(self.run_job('echo hi\n',
+                                      'memory=1mb', 'cpu_limit=0.5'),
+                         b'hi\n')
+        cgroup = cgroup_root / 'tej-job'
+        with cgroup.open('rb', 'memory.max') as fp:
+            self.assertEqual(fp.read(), b'1048576\n')
+        with cgroup.open('rb', 'cpu.max') as fp:
+            self.assertEqual(fp.read(), b'50000 100000\n')
+        with cgroup.open('rb', 'cgroup.procs') as fp:
+            self.assertTrue(fp.read().rstrip(b'\n').isdigit())
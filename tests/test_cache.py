@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+from rpaths import Path
+import time
+import unittest
+
+from tej.cache import LocationCache, StatusCache
+
+
+class TestLocationCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='tej-tests-')
+        self.filename = str(self.tmp / 'sub/queues.json')
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def test_persistence(self):
+        cache = LocationCache(self.filename)
+        self.assertIsNone(cache.get('ssh://me@host', '~/.tej'))
+        cache.set('ssh://me@host', '~/.tej', '/home/me/queue', '0.2',
+                  'default', ['~/.tej'])
+
+        cache = LocationCache(self.filename)
+        self.assertEqual(cache.get('ssh://me@host', '~/.tej'),
+                         {'path': '/home/me/queue', 'version': '0.2',
+                          'runtime': 'default', 'links': ['~/.tej']})
+        self.assertIsNone(cache.get('ssh://me@other', '~/.tej'))
+        self.assertIsNone(cache.get('ssh://me@host', '~/queue'))
+
+        cache.invalidate('ssh://me@host', '~/.tej')
+        self.assertIsNone(LocationCache(self.filename).get('ssh://me@host',
+                                                           '~/.tej'))
+
+    def test_corrupted(self):
+        cache = LocationCache(self.filename)
+        cache.set('ssh://me@host', '~/.tej', '/queue', '0.2', 'default')
+        with open(self.filename, 'w') as fp:
+            fp.write('{"ssh://me')
+        self.assertIsNone(cache.get('ssh://me@host', '~/.tej'))
+        cache.set('ssh://me@host', '~/.tej', '/queue', '0.2', 'default')
+        self.assertEqual(cache.get('ssh://me@host', '~/.tej')['path'],
+                         '/queue')
+
+
+class TestStatusCache(unittest.TestCase):
+    def test_finished(self):
+        cache = StatusCache(running_ttl=0)
+        self.assertIsNone(cache.get('job1'))
+        cache.put('job1', ('finished', '/queue/jobs/job1', '0'))
+        cache.put('job2', ('running', '/queue/jobs/job2', None))
+        self.assertEqual(cache.get('job1'),
+                         ('finished', '/queue/jobs/job1', '0'))
+        self.assertIsNone(cache.get('job2'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+        cache.invalidate('job1')
+        self.assertIsNone(cache.get('job1'))
+        self.assertEqual(len(cache), 0)
+
+    def test_running(self):
+        cache = StatusCache(running_ttl=0.2)
+        cache.put('job1', ('running', '/queue/jobs/job1', None))
+        self.assertEqual(cache.get('job1'),
+                         ('running', '/queue/jobs/job1', None))
+        time.sleep(0.3)
+        self.assertIsNone(cache.get('job1'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
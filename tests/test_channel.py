@@ -0,0 +1,130 @@
+from __future__ import unicode_literals
+
+import socket
+import unittest
+
+import tej.submission
+from tej.errors import RemoteCommandFailure
+
+
+class FakeChannel(object):
+    """Fake paramiko channel, replaying a list of ``(stream, data)`` events.
+
+    `fileno()` is one end of a socketpair that is always readable, so that
+    both `select()` and an event loop's readers wake up for each event.
+    """
+    def __init__(self, events, exit_status=0):
+        self.events = list(events)
+        self.exit_status = exit_status
+        self.closed = False
+        self.sent = bytearray()
+        self.write_shut = False
+        self._sock, self._peer = socket.socketpair()
+        self._peer.send(b'x')
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _ready(self, stream):
+        return bool(self.events) and self.events[0][0] == stream
+
+    def recv_ready(self):
+        return self._ready('out')
+
+    def recv_stderr_ready(self):
+        return self._ready('err')
+
+    def recv(self, nbytes):
+        assert self.recv_ready()
+        return self.events.pop(0)[1]
+
+    def recv_stderr(self, nbytes):
+        assert self.recv_stderr_ready()
+        return self.events.pop(0)[1]
+
+    @property
+    def eof_received(self):
+        return not self.events
+
+    def exit_status_ready(self):
+        return not self.events
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def sendall(self, data):
+        self.sent.extend(data)
+
+    def shutdown_write(self):
+        self.write_shut = True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._sock.close()
+            self._peer.close()
+
+
+class RecordingLogger(tej.submission.ServerLogger):
+    def __init__(self):
+        tej.submission.ServerLogger.__init__(self)
+        self.messages = []
+
+    def message(self, data):
+        self.messages.append(data)
+
+
+def make_queue(chan):
+    queue = tej.submission.RemoteQueue.__new__(tej.submission.RemoteQueue)
+    queue.server_err = RecordingLogger()
+    queue.server_logger = lambda: queue.server_err
+    queue._open_channel = lambda cmd: chan
+    return queue
+
+
+class TestReadChannel(unittest.TestCase):
+    def test_interleaved(self):
+        """Stderr is collected while stdout chunks are generated."""
+        chan = FakeChannel([('err', b'warn'), ('out', b'a'),
+                            ('err', b'ing\n'), ('out', b'b'),
+                            ('err', b'done')])
+        queue = make_queue(chan)
+        server_err = RecordingLogger()
+        self.assertEqual(list(queue._read_channel(chan, server_err)),
+                         [b'a', b'b'])
+        self.assertEqual(server_err.data, [b'warn', b'ing\n', b'done'])
+        chan.close()
+
+    def test_lines(self):
+        """Lines are split across chunks, including a partial last line."""
+        chan = FakeChannel([('out', b'one\ntw'), ('err', b'oops\n'),
+                            ('out', b'o\r\n'), ('out', b'\nthree')])
+        queue = make_queue(chan)
+        self.assertEqual(list(queue.check_output_lines('cmd')),
+                         [b'one', b'two', b'', b'three'])
+        self.assertEqual(queue.server_err.messages, ['oops'])
+        self.assertTrue(chan.closed)
+
+    def test_failure(self):
+        """Lines are generated before the exit status is checked."""
+        chan = FakeChannel([('out', b'one\n'), ('err', b'failed'),
+                            ('out', b'two')], exit_status=1)
+        queue = make_queue(chan)
+        lines = queue.check_output_lines('cmd')
+        self.assertEqual(next(lines), b'one')
+        self.assertEqual(next(lines), b'two')
+        with self.assertRaises(RemoteCommandFailure) as cm:
+            next(lines)
+        self.assertEqual(cm.exception.ret, 1)
+        self.assertEqual(queue.server_err.messages, ['failed'])
+        self.assertTrue(chan.closed)
+
+    def test_call(self):
+        """The whole output and exit status are returned by _call()."""
+        chan = FakeChannel([('out', b'hello\n'), ('out', b'world\n')],
+                           exit_status=2)
+        queue = make_queue(chan)
+        self.assertEqual(queue._call('cmd', True, b'input'),
+                         (2, b'hello\nworld'))
+        self.assertEqual(bytes(chan.sent), b'input')
+        self.assertTrue(chan.write_shut)
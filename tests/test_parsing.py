@@ -1,11 +1,13 @@
 from __future__ import unicode_literals
 
+import datetime
 import getpass
 import unittest
 
+from rpaths import Path, PosixPath
 import tej.submission
 from tej.errors import InvalidDestination
-from tej.utils import irange, unicode_, shell_escape
+from tej.utils import irange, unicode_, parallel_map, shell_escape
 
 
 class TestUtils(unittest.TestCase):
@@ -20,6 +22,20 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(shell_escape("hello world"), '"hello world"')
         self.assertEqual(shell_escape('some"thing'), '"some\\"thing"')
 
+    def test_parallel_map(self):
+        def func(i):
+            if i == 3:
+                raise ValueError
+            return i * 2
+
+        results = parallel_map(func, irange(10), 4)
+        self.assertEqual([r for r, e in results],
+                         [0, 2, 4, None, 8, 10, 12, 14, 16, 18])
+        self.assertEqual([i for i, (r, e) in enumerate(results)
+                          if e is not None],
+                         [3])
+        self.assertEqual(parallel_map(func, [], 4), [])
+
 
 class TestDestination(unittest.TestCase):
     def test_parse(self):
@@ -73,3 +89,151 @@ class TestDestination(unittest.TestCase):
         self.assertEqual(string({'hostname': '127.0.0.1',
                                  'username': 'somebody'}),
                          'ssh://somebody@127.0.0.1')
+
+
+class TestList(unittest.TestCase):
+    def test_parse(self):
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        output = (b'job1\n'
+                  b'    status: finished\n'
+                  b'    exit_code: 2\n'
+                  b'    started: 1500000000\n'
+                  b'    directory: /tmp/queue/jobs/job1/stage\n'
+                  b'nonexistent\n'
+                  b'    status: not found\n'
+                  b'job2\n'
+                  b'    status: submitted\n'
+                  b'    pbs_id: 12.server\n')
+        self.assertEqual(
+            list(queue._parse_list(output.splitlines())),
+            [('job1', {'status': 'finished', 'exit_code': 2,
+                       'started': 1500000000,
+                       'directory': PosixPath('/tmp/queue/jobs/job1/stage')}),
+             ('nonexistent', None),
+             ('job2', {'status': 'submitted', 'pbs_id': '12.server'})])
+
+    def test_filter(self):
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        jobs = [('a1', {'status': 'finished'}),
+                ('a2', {'status': 'running'}),
+                ('b1', {'status': 'finished'})]
+
+        def filtered(status=None, prefix=None, after=None, limit=None):
+            return [job_id for job_id, info in queue._filter_list(
+                iter(jobs), status, prefix, after, limit)]
+
+        self.assertEqual(filtered(), ['a1', 'a2', 'b1'])
+        self.assertEqual(filtered(status='finished'), ['a1', 'b1'])
+        self.assertEqual(filtered(prefix='a', limit=1), ['a1'])
+        self.assertEqual(filtered(after='a1', status=['finished']), ['b1'])
+        self.assertEqual(queue._list_filters(['running', 'created'], 60,
+                                             'a', 'a1', 10),
+                         ['status=running,created', 'max_age=60', 'prefix=a',
+                          'after=a1', 'limit=10'])
+
+    def test_lazy(self):
+        """The server is only contacted once iteration starts."""
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        calls = []
+        queue._get_queue = lambda: calls.append('queue')
+        jobs = queue.list(status='running')
+        self.assertEqual(calls, [])
+        self.assertRaises(tej.submission.QueueDoesntExist, next, jobs)
+        self.assertEqual(calls, ['queue'])
+        self.assertRaises(ValueError, queue.list, status='not found')
+
+    def test_events(self):
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        JobEvent = tej.submission.JobEvent
+        output = (b'100\n'
+                  b'1500000000 started job1 1234\n'
+                  b'1500000010 finished job1 2\n'
+                  b'1500000011 dele')
+        self.assertEqual(
+            queue._parse_events(output),
+            ([JobEvent(1500000000, 'started', 'job1', '1234'),
+              JobEvent(1500000010, 'finished', 'job1', 2)],
+             100 + 56))
+        self.assertEqual(queue._parse_events(b'0\n'), ([], 0))
+
+    def test_status(self):
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        RemoteQueue = tej.submission.RemoteQueue
+        self.assertEqual(queue._status_result(0, b'/tmp/job\n2\n'),
+                         (RemoteQueue.JOB_DONE, PosixPath('/tmp/job'), '2'))
+        self.assertEqual(queue._status_result(2, b'/tmp/job\n'),
+                         (RemoteQueue.JOB_RUNNING, PosixPath('/tmp/job'),
+                          None))
+        self.assertEqual(queue._status_result(2, b'/tmp/job\nqueued\n'),
+                         (RemoteQueue.JOB_QUEUED, PosixPath('/tmp/job'),
+                          None))
+
+
+class TestResources(unittest.TestCase):
+    def test_args(self):
+        resource_args = tej.submission._resource_args
+        self.assertEqual(
+            resource_args({'cpus': 4, 'memory': 4 << 30, 'walltime': 5400,
+                           'queue': 'batch', 'directives': ['-m abe']}),
+            ['cpus=4', 'directive=-m abe', 'memory=4gb', 'queue=batch',
+             'walltime=1:30:00'])
+        self.assertEqual(
+            resource_args({'memory': '512MB', 'cpus': None,
+                           'walltime': datetime.timedelta(hours=30)}),
+            ['memory=512mb', 'walltime=30:00:00'])
+        self.assertEqual(resource_args({'memory': 1000}), ['memory=1000b'])
+        self.assertEqual(
+            resource_args({'cpuset': [0, 1, 4], 'nice': 5,
+                           'ionice': 'best-effort:7', 'cpu_limit': 1.5}),
+            ['cpu_limit=1.5', 'cpuset=0,1,4', 'ionice=best-effort:7',
+             'nice=5'])
+        for resources in ({'cpus': 0}, {'memory': '4 gigs'},
+                          {'walltime': '2h'}, {'queue': 'a b'},
+                          {'directives': ['a\nb']}, {'gpus': 1},
+                          {'cpuset': '0-'}, {'nice': 20}, {'ionice': 'idle:3'},
+                          {'cpu_limit': 0}):
+            self.assertRaises(ValueError, resource_args, resources)
+
+    def test_options(self):
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        self.assertEqual(queue._submit_options(None, None), ())
+        self.assertEqual(queue._submit_options(3, {'cpus': None}), ('3',))
+        self.assertEqual(queue._submit_options(None, {'cpus': 2}),
+                         ('0', 'cpus=2'))
+
+
+class TestDownload(unittest.TestCase):
+    def test_plan(self):
+        queue = tej.submission.RemoteQueue.__new__(
+            tej.submission.RemoteQueue)
+        entries = ['f 12 result.txt',
+                   'd 0 out/',
+                   'D 0 sub',
+                   'F 100 a',
+                   'F 200 sub/b']
+        transfers, directories = queue._download_plan(
+            entries, Path('/tmp/dest'), True, True)
+        self.assertEqual(transfers,
+                         [('result.txt', Path('/tmp/dest/result.txt'), 12),
+                          ('out/a', Path('/tmp/dest/out/a'), 100),
+                          ('out/sub/b', Path('/tmp/dest/out/sub/b'), 200)])
+        self.assertEqual(directories,
+                         [Path('/tmp/dest/out'), Path('/tmp/dest/out/sub')])
+
+        transfers, directories = queue._download_plan(
+            ['f 12 out/result.txt'], Path('/tmp/nonexistent/r.txt'),
+            False, True)
+        self.assertEqual(transfers, [('out/result.txt',
+                                      Path('/tmp/nonexistent/r.txt'), 12)])
+
+        transfers, directories = queue._download_plan(
+            entries, Path('/tmp/dest'), True, True, ['out/*'], ['*/sub/*'])
+        self.assertEqual(transfers,
+                         [('out/a', Path('/tmp/dest/out/a'), 100)])
+        self.assertEqual(directories, [])
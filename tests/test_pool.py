@@ -0,0 +1,159 @@
+from __future__ import unicode_literals
+
+import paramiko
+import threading
+import unittest
+
+from tej.pool import ConnectionPool
+from tej.submission import RemoteQueue
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.closed = False
+
+    def get_transport(self):
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport(object):
+    def __init__(self, active=True, error=None):
+        self.active = active
+        self.error = error
+
+    def set_keepalive(self, interval):
+        pass
+
+    def is_active(self):
+        return self.active
+
+    def open_session(self):
+        if self.error is not None:
+            raise self.error
+        return FakeChannel()
+
+
+class FakeChannel(object):
+    def exec_command(self, cmd):
+        self.cmd = cmd
+
+
+class TransportClient(FakeClient):
+    def __init__(self, transport):
+        FakeClient.__init__(self)
+        self.transport = transport
+
+    def get_transport(self):
+        return self.transport
+
+
+class TestPool(unittest.TestCase):
+    dest1 = {'hostname': 'host1', 'username': 'me'}
+    dest2 = {'hostname': 'host2', 'username': 'me'}
+
+    def test_sharing(self):
+        pool = ConnectionPool(max_transports=2, max_shares=2)
+        clients = [pool.acquire(self.dest1, FakeClient) for _ in range(5)]
+        self.assertEqual(len(set(map(id, clients))), 2)
+        self.assertEqual(len(pool), 2)
+        other = pool.acquire(dict(self.dest2), FakeClient)
+        self.assertNotIn(other, clients)
+        same = pool.acquire(dict(self.dest2), FakeClient)
+        self.assertIs(same, other)
+        self.assertEqual(len(pool), 3)
+
+    def test_concurrent_connect(self):
+        """Connections opened concurrently don't exceed max_transports."""
+        pool = ConnectionPool(max_transports=1)
+        clients = []
+
+        def connect():
+            client = FakeClient()
+            clients.append(client)
+            if len(clients) == 1:
+                # Another thread connects while this one is connecting
+                clients.append(pool.acquire(self.dest1, FakeClient))
+            return client
+
+        client = pool.acquire(self.dest1, connect)
+        self.assertEqual(len(pool), 1)
+        self.assertIs(client, clients[1])
+        self.assertTrue(clients[0].closed)
+        self.assertFalse(client.closed)
+
+    def test_groups(self):
+        pool = ConnectionPool()
+        c1 = pool.acquire(self.dest1, FakeClient, group=1)
+        c2 = pool.acquire(self.dest1, FakeClient, group=2)
+        self.assertIsNot(c1, c2)
+
+    def test_expire(self):
+        pool = ConnectionPool(idle_timeout=0)
+        client = pool.acquire(self.dest1, FakeClient)
+        self.assertIs(pool.acquire(self.dest1, FakeClient), client)
+        pool.release(client)
+        self.assertFalse(client.closed)
+        pool.release(client)
+        self.assertTrue(client.closed)
+        self.assertEqual(len(pool), 0)
+        self.assertIsNot(pool.acquire(self.dest1, FakeClient), client)
+
+    def test_discard(self):
+        pool = ConnectionPool()
+        client = pool.acquire(self.dest1, FakeClient)
+        pool.discard(client)
+        self.assertTrue(client.closed)
+        self.assertIsNot(pool.acquire(self.dest1, FakeClient), client)
+        pool.close_all()
+        self.assertEqual(len(pool), 0)
+
+
+class TestReconnect(unittest.TestCase):
+    dest = {'hostname': 'host1', 'username': 'me'}
+
+    def make_queue(self, first):
+        clients = [first]
+
+        def connect():
+            client = TransportClient(FakeTransport())
+            clients.append(client)
+            return client
+
+        queue = RemoteQueue.__new__(RemoteQueue)
+        queue.destination = self.dest
+        queue._pool = ConnectionPool()
+        queue._reconnect_lock = threading.Lock()
+        queue._new_connection = connect
+        queue._ssh = queue._pool.acquire(self.dest, lambda: first)
+        return queue, clients
+
+    def test_channel_error(self):
+        """A refused channel on a live connection doesn't reconnect."""
+        client = TransportClient(FakeTransport(
+            error=paramiko.ChannelException(1, "administratively prohibited")))
+        queue, clients = self.make_queue(client)
+        self.assertRaises(paramiko.ChannelException,
+                          queue._open_channel, 'true')
+        self.assertIs(queue._ssh, client)
+        self.assertFalse(client.closed)
+        self.assertEqual(len(clients), 1)
+
+    def test_dead_transport(self):
+        """A dead connection is discarded and replaced once."""
+        transport = FakeTransport(error=EOFError())
+        client = TransportClient(transport)
+        queue, clients = self.make_queue(client)
+        transport.active = False
+        chan = queue._open_channel('true')
+        self.assertEqual(chan.cmd, 'true')
+        self.assertTrue(client.closed)
+        self.assertEqual(len(clients), 2)
+        self.assertIs(queue._ssh, clients[1])
+
+        # Another thread noticing the same dead connection keeps the new one
+        queue._reconnect(client)
+        self.assertIs(queue._ssh, clients[1])
+        self.assertEqual(len(clients), 2)
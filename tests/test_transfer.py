@@ -0,0 +1,112 @@
+from __future__ import unicode_literals
+
+import hashlib
+import io
+from rpaths import Path
+import tarfile
+import unittest
+
+from tej.transfer import ChunkReader, CountingWriter, directory_stats, \
+    extract_command, hash_file, list_directory, match_filters, read_tar, \
+    write_tar
+
+
+class TestTar(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path.tempdir(prefix='tej-tests-')
+        with self.tmp.open('wb', 'start.sh') as fp:
+            fp.write(b'#!/bin/sh\necho hi\n')
+        with self.tmp.mkdir('sub').open('wb', 'data') as fp:
+            fp.write(b'x' * 1000)
+
+    def tearDown(self):
+        self.tmp.rmtree()
+
+    def test_stats(self):
+        self.assertEqual(directory_stats(self.tmp), (2, 1018))
+
+    def test_write(self):
+        for compression, mode in (('gzip', 'r:gz'), ('none', 'r:')):
+            buf = io.BytesIO()
+            writer = CountingWriter(buf.write)
+            self.assertEqual(write_tar(writer, self.tmp, compression),
+                             (2, 1018))
+            self.assertEqual(writer.bytes, len(buf.getvalue()))
+            buf.seek(0)
+            with tarfile.open(fileobj=buf, mode=mode) as tar:
+                self.assertEqual(sorted(tar.getnames()),
+                                 ['start.sh', 'sub', 'sub/data'])
+
+    def test_write_names(self):
+        buf = io.BytesIO()
+        self.assertEqual(write_tar(buf, self.tmp, 'none', ['sub/data']),
+                         (1, 1000))
+        buf.seek(0)
+        with tarfile.open(fileobj=buf, mode='r:') as tar:
+            self.assertEqual(tar.getnames(), ['sub/data'])
+
+    def test_write_arcnames(self):
+        buf = io.BytesIO()
+        self.assertEqual(write_tar(buf, self.tmp, 'none', ['sub/data'],
+                                   ['renamed']),
+                         (1, 1000))
+        buf.seek(0)
+        with tarfile.open(fileobj=buf, mode='r:') as tar:
+            self.assertEqual(tar.getnames(), ['renamed'])
+
+    def test_list(self):
+        self.assertEqual(list_directory(self.tmp),
+                         (['sub'], ['start.sh', 'sub/data']))
+        self.assertEqual(hash_file((self.tmp / 'sub/data').path),
+                         hashlib.sha256(b'x' * 1000).hexdigest())
+
+    def test_read(self):
+        buf = io.BytesIO()
+        write_tar(buf, self.tmp, 'gzip')
+        data = buf.getvalue()
+        reader = ChunkReader(data[i:i + 100]
+                             for i in range(0, len(data), 100))
+        out = self.tmp / 'out'
+        sizes = []
+        self.assertEqual(read_tar(reader, out, 'gzip', sizes.append),
+                         (2, 1018))
+        self.assertEqual(sorted(sizes), [18, 1000])
+        with (out / 'sub/data').open('rb') as fp:
+            self.assertEqual(fp.read(), b'x' * 1000)
+        self.assertEqual(reader.bytes, len(data))
+
+    def test_read_unsafe(self):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for name in ('../evil', '/abs', 'good'):
+                info = tarfile.TarInfo(name)
+                info.size = 2
+                tar.addfile(info, io.BytesIO(b'hi'))
+        buf.seek(0)
+        out = self.tmp / 'out'
+        self.assertEqual(read_tar(buf, out, 'none'), (1, 2))
+        self.assertEqual(out.listdir(), [out / 'good'])
+        self.assertFalse((self.tmp / 'evil').exists())
+
+    def test_chunk_reader(self):
+        reader = ChunkReader([b'gz', b'ip\nda', b'ta'])
+        self.assertEqual(reader.readline(), b'gzip\n')
+        self.assertEqual(reader.read(3), b'dat')
+        self.assertEqual(reader.read(), b'a')
+        self.assertEqual(reader.readline(), b'')
+
+    def test_filters(self):
+        self.assertTrue(match_filters('out/a.csv'))
+        self.assertTrue(match_filters('out/a.csv', ['*.csv']))
+        self.assertFalse(match_filters('out/a.csv', ['*.log']))
+        self.assertFalse(match_filters('out/a.csv', None, ['out/*']))
+        self.assertTrue(match_filters('out/a.csv', ['*.log', 'out/*'],
+                                      ['*/sub/*']))
+
+    def test_extract_command(self):
+        self.assertEqual(extract_command('/tmp/a b', 'gzip'),
+                         'mkdir -p "/tmp/a b" && cd "/tmp/a b" && '
+                         'tar -xzf -')
+        self.assertEqual(extract_command('/tmp/ab', 'zstd'),
+                         'mkdir -p /tmp/ab && cd /tmp/ab && '
+                         'zstd -dc | tar -xf -')